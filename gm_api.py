@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GM Console automation API - REST + WebSocket routes for CI bots and dashboards.
+gm_console.py mounts them on the NiceGUI (FastAPI) app, so they share port 9529.
+
+  GET  /api/clients                         connected devices
+  GET  /api/clients/{target}/gm_tree        GM tree + version of one device
+  GET  /api/gm_tree?target=                 merged tree of several devices, "available"/"devices" per node
+  GET  /api/logs?level=&device=&text=&since=&before=&limit=    newest-first page
+  GET  /api/log_pipeline                   log filters / rate limit / sampling / export settings and counters
+  POST /api/log_pipeline  {"min_level", "include", "exclude", "rate", "burst", "sample", "export"}   change some of them
+  GET  /api/metrics                         per-connection counters, RTT percentiles per device and script (JSON)
+  GET  /metrics                             the same, Prometheus text format
+  POST /api/exec     {"target", "cmd", "timeout"}
+  POST /api/exec_gm  {"target", "gm", "value", "timeout"}
+  POST /api/batch    {"target", "steps", "window", "stop_on_error", "timeout"}
+  WS   /api/ws?level=&device=&text=         live logs + client list, and the same commands
+
+`target` is null (all devices), a port, a device uid or a list of those. The POST routes
+stream NDJSON: one line per device as soon as that device has answered.
+"""
+
+import asyncio
+import json
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+
+from gm_core import BATCH_WINDOW, Client, ServerMgr, log_filter, parse_target, prometheus_text
+
+WS_QUEUE = 256          # messages buffered per WebSocket; log batches beyond that are dropped and counted
+LOG_PAGE_MAX = 5000     # largest page GET /api/logs returns
+REQUIRED = {"exec": "cmd", "exec_gm": "gm", "batch": "steps"}
+
+def client_info(c: Client) -> Dict[str, Any]:
+    return {"uid": c.uid, "cid": c.id, "device": c.device, "platform": c.platform, "port": c.port,
+            "framing": c.framing, "gm_version": c.gm_version, "gm_nodes": len(c.gm_index)}
+
+def _json(obj) -> Response:
+    # json.dumps directly: FastAPI's jsonable_encoder is far slower on large GM trees / log pages
+    return Response(json.dumps(obj, ensure_ascii=False, default=str), media_type="application/json")
+
+def _target(value):
+    """JSON bodies carry the target as-is; strings use the CLI syntax ("all", "12581", "a,b")."""
+    return parse_target(value) if isinstance(value, str) else value
+
+def _levels(text: Optional[str]):
+    return {x for x in text.split(",") if x} if text else None
+
+async def _body(request: Request) -> dict:
+    """The JSON object a POST carries; anything else is the caller's mistake (400)."""
+    try: body = await request.json()
+    except ValueError as e: raise HTTPException(400, f"bad json: {e}")
+    if not isinstance(body, dict): raise HTTPException(400, "expected a JSON object")
+    return body
+
+def _check(op, body):
+    if op not in REQUIRED: raise ValueError(f"unknown op {op!r}")
+    if REQUIRED[op] not in body: raise ValueError(f"{op} needs {REQUIRED[op]!r}")
+
+async def _run(mgr: ServerMgr, op, body):
+    """Yield (client, [(ok, result), ...]) per device, in completion order."""
+    steps = [body["cmd"]] if op == "exec" else [{"gm": body["gm"], "value": body.get("value")}] if op == "exec_gm" else body["steps"]
+    window, stop, timeout = body.get("window", BATCH_WINDOW), bool(body.get("stop_on_error")), body.get("timeout")
+    async def one(c):
+        res = await mgr.run_batch(steps, c.uid, window, stop, timeout)
+        return c, res.get(c.uid, [])
+    for fut in asyncio.as_completed([one(c) for c in mgr.resolve(_target(body.get("target")))]):
+        yield await fut
+
+def _row(op, c: Client, res):
+    row = {"uid": c.uid, "device": c.device, "ok": all(ok for ok, _ in res)}
+    if op == "batch": row["results"] = [{"ok": ok, "result": r} for ok, r in res]
+    else: row["result"] = res[0][1] if res else None
+    return row
+
+def mount(app: FastAPI, mgr: ServerMgr, prefix="/api"):
+    # every handler is async: FastAPI runs plain defs in a thread pool, off the loop that owns mgr
+    @app.get(f"{prefix}/clients")
+    async def clients():
+        return _json([client_info(c) for c in mgr.clients.values()])
+
+    @app.get(prefix + "/clients/{target}/gm_tree")
+    async def gm_tree(target: str):
+        found = mgr.resolve(parse_target(target))
+        if len(found) != 1: raise HTTPException(404, f"{target} matches {len(found)} devices")
+        c = found[0]
+        return _json({"uid": c.uid, "version": c.gm_version, "tree": c.gm_tree})
+
+    @app.get(f"{prefix}/gm_tree")
+    async def merged_tree(target: Optional[str] = None):
+        merged = mgr.merged_gm()
+        t = parse_target(target) if target else None
+        cids = None if t is None else {c.id for c in mgr.resolve(t)}
+        return _json({"stats": merged.stats(), "tree": merged.export(cids)})
+
+    @app.get(f"{prefix}/logs")
+    async def logs(level: Optional[str] = None, device: Optional[str] = None, text: Optional[str] = None,
+                   since: Optional[float] = None, before: Optional[int] = None, limit: int = 200):
+        recs = mgr.logs.query(_levels(level), device, text, since, None, before, max(1, min(limit, LOG_PAGE_MAX)))
+        return _json([r.as_dict() for r in recs])
+
+    @app.get(f"{prefix}/log_pipeline")
+    async def log_pipeline():
+        return _json(mgr.log_pipeline.config())
+
+    @app.post(f"{prefix}/log_pipeline")
+    async def configure_log_pipeline(request: Request):
+        body = await _body(request)
+        try: return _json(await mgr.log_pipeline.aconfigure(**body))
+        except ValueError as e: raise HTTPException(400, str(e))
+
+    @app.get(f"{prefix}/metrics")
+    async def metrics():
+        return _json({"clients": mgr.metrics(), "loop": mgr.loop_monitor.report(), "frame_errors": mgr.frame_errors,
+                      "gm_cache": mgr.gm_cache.stats(), "latency": mgr.latency_report()})
+
+    @app.get("/metrics")
+    async def prometheus():
+        return PlainTextResponse(prometheus_text(mgr), media_type="text/plain; version=0.0.4")
+
+    def command(op):
+        async def handler(request: Request):
+            body = await _body(request)
+            try: _check(op, body)
+            except ValueError as e: raise HTTPException(400, str(e))
+            if not mgr.resolve(_target(body.get("target"))): raise HTTPException(404, f"No device for {mgr.describe(_target(body.get('target')))}")
+            async def lines():
+                async for c, res in _run(mgr, op, body): yield json.dumps(_row(op, c, res), ensure_ascii=False, default=str) + "\n"
+            return StreamingResponse(lines(), media_type="application/x-ndjson")
+        return handler
+    for op in REQUIRED: app.post(f"{prefix}/{op}")(command(op))
+
+    @app.websocket(f"{prefix}/ws")
+    async def ws(sock: WebSocket):
+        """Server -> client: {"type": "logs" | "clients" | "result" | "done" | "error" | "dropped", ...}.
+        Client -> server: {"op": "exec" | "exec_gm" | "batch", "id", ...body} or
+        {"op": "filter", "level", "device", "text"} or {"op": "clients", "id"}."""
+        await sock.accept()
+        q = sock.query_params
+        match = [log_filter(_levels(q.get("level")), q.get("device"), q.get("text"))]
+        out: asyncio.Queue = asyncio.Queue(WS_QUEUE)
+        dropped = [0]
+        def on_logs(events):
+            rows = [e.data.as_dict() for e in events if match[0](e.data)]
+            if not rows: return
+            try: out.put_nowait({"type": "logs", "data": rows})
+            except asyncio.QueueFull: dropped[0] += len(rows)  # slow reader: shed logs, never replies
+        def on_registry(events):
+            try: out.put_nowait({"type": "clients", "data": [client_info(c) for c in mgr.clients.values()]})
+            except asyncio.QueueFull: pass
+        async def handle(msg):
+            op, mid = msg.get("op"), msg.get("id")
+            try:
+                if op == "filter":
+                    match[0] = log_filter(_levels(msg.get("level")), msg.get("device"), msg.get("text")); return
+                if op == "clients":
+                    await out.put({"type": "clients", "id": mid, "data": [client_info(c) for c in mgr.clients.values()]}); return
+                _check(op, msg)
+                async for c, res in _run(mgr, op, msg): await out.put({"type": "result", "id": mid, "data": _row(op, c, res)})
+                await out.put({"type": "done", "id": mid})
+            except Exception as e: await out.put({"type": "error", "id": mid, "error": str(e) or type(e).__name__})
+        async def writer():
+            while True:
+                msg = await out.get()
+                if dropped[0]:
+                    await sock.send_text(json.dumps({"type": "dropped", "count": dropped[0]})); dropped[0] = 0
+                await sock.send_text(json.dumps(msg, ensure_ascii=False, default=str))
+        unsubs = [mgr.events.subscribe("log", on_logs),
+                  mgr.events.subscribe(("client_added", "client_removed", "client_meta"), on_registry)]
+        tasks = {asyncio.ensure_future(writer())}
+        try:
+            while True:
+                try: msg = json.loads(await sock.receive_text())
+                except ValueError as e:
+                    await out.put({"type": "error", "id": None, "error": f"bad json: {e}"}); continue
+                t = asyncio.ensure_future(handle(msg if isinstance(msg, dict) else {}))
+                tasks.add(t); t.add_done_callback(tasks.discard)
+        except WebSocketDisconnect: pass
+        finally:
+            for u in unsubs: u()
+            for t in tasks: t.cancel()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GM Console load harness
+Simulated RuntimeGMClient devices and a benchmark runner for ServerMgr.
+
+  python gm_bench.py sim   --port 12581 -n 20 --logs 50     # drive a running console
+  python gm_bench.py bench -n 50 --tree 2000 --json         # in-process ServerMgr, no UI
+  python gm_bench.py codec --tree 2000 --log-lines 20000    # zlib stream vs plain frames, offline
+  python gm_bench.py bench -n 200 --workers 4               # socket reads and parsing in shard processes
+
+The bench phases report connect rate, broadcast delivery / round-trip latency,
+pipelined batch throughput, log ingest throughput and Python heap growth. They run headless on one asyncio
+loop, so numbers are comparable between runs on the same machine and not absolute. Run bench with and
+without --compress to compare bytes on the wire (wire_*) and CPU time (cpu_s) of both transports.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+import zlib
+from typing import Any, Dict, List, Optional
+
+from gm_core import ServerMgr
+
+# ============================================================================
+# Simulated game client
+# ============================================================================
+
+def gen_tree(size, fanout=8, prefix="gm"):
+    """A GM tree of `size` nodes: folders of `fanout` entries mixing Btn / Toggle / Input."""
+    kinds = ("Btn", "Toggle", "Input")
+    count = [0]
+    def level(depth):
+        out = []
+        while len(out) < fanout and count[0] < size:
+            i = count[0]; count[0] += 1
+            if depth < 4 and i % fanout == 0 and count[0] < size:
+                out.append({"id": f"{prefix}_{i}", "name": f"Folder {i}", "type": "SubBox", "children": level(depth+1)})
+            else:
+                out.append({"id": f"{prefix}_{i}", "name": f"Command {i}", "type": kinds[i % 3]})
+        return out
+    tree = []
+    while count[0] < size: tree.extend(level(0))
+    return tree
+
+class SimClient:
+    """One fake device: HELLO, GM_LIST, optional LOG stream, RESULT replies to EXEC / EXEC_GM."""
+    def __init__(self, idx, host="127.0.0.1", port=12581, tree_size=200, log_rate=0.0, framing="line", reply_delay=0.0, compress=False):
+        self.idx = idx; self.host = host; self.port = port
+        self.tree_size = tree_size; self.log_rate = log_rate
+        self.framing = framing; self.reply_delay = reply_delay; self.compress = compress
+        self.zout = None
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.tasks: List[asyncio.Task] = []
+        self.received = 0; self.replied = 0; self.logs_sent = 0
+        self.bytes_out = 0; self.bytes_in = 0
+        self.wire_out = 0; self.wire_in = 0  # socket bytes, smaller than bytes_* when compressed
+
+    def _pack(self, pkt) -> bytes:
+        body = json.dumps(pkt, ensure_ascii=False).encode()
+        return len(body).to_bytes(4, "big") + body if self.framing == "len" else body + b"\n"
+
+    def send(self, pkt, flush=True):
+        data = self._pack(pkt); self.bytes_out += len(data)
+        if self.zout: data = self.zout.compress(data) + (self.zout.flush(zlib.Z_SYNC_FLUSH) if flush else b"")
+        self.wire_out += len(data)
+        self.writer.write(data)
+
+    def _inflate(self):
+        raw, out = self.reader, asyncio.StreamReader(limit=64 << 20)
+        async def pump():
+            z = zlib.decompressobj()
+            try:
+                while True:
+                    data = await raw.read(1 << 16)
+                    if not data: break
+                    self.wire_in += len(data); out.feed_data(z.decompress(data))
+            except (ConnectionError, OSError): pass
+            finally: out.feed_eof()
+        self.tasks.append(asyncio.create_task(pump()))
+        self.reader = out
+
+    async def _recv(self):
+        if self.framing == "len":
+            n = int.from_bytes(await self.reader.readexactly(4), "big")
+            data = await self.reader.readexactly(n); self.bytes_in += n + 4
+            if not self.zout: self.wire_in += n + 4
+        else:
+            data = await self.reader.readline()
+            if not data: raise asyncio.IncompleteReadError(b"", None)
+            self.bytes_in += len(data)
+            if not self.zout: self.wire_in += len(data)
+        return json.loads(data)
+
+    async def start(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=64 << 20)
+        hello = {"type": "HELLO", "device": f"Sim-{self.idx:03d}", "device_id": f"sim-{self.idx}", "platform": "Simulator", "result": True}
+        if self.framing == "len": hello["framing"] = ["len"]
+        if self.compress: hello["compress"] = ["zlib"]
+        self.framing = "line"; self.send(hello)
+        if "framing" in hello or "compress" in hello:  # both start after HELLO_ACK
+            ack = await self._recv()
+            self.framing = ack.get("framing", "line")
+            if ack.get("compress") == "zlib": self.zout = zlib.compressobj(1); self._inflate()
+        if self.tree_size: self.send({"type": "GM_LIST", "version": 1, "data": gen_tree(self.tree_size)})
+        await self.writer.drain()
+        self.tasks.append(asyncio.create_task(self._serve()))
+        if self.log_rate > 0: self.tasks.append(asyncio.create_task(self._stream_logs()))
+
+    async def _serve(self):
+        try:
+            while True:
+                pkt = await self._recv(); self.received += 1
+                if pkt.get("type") == "PING": self.send({"type": "PONG", "t": pkt.get("t")}); continue
+                if pkt.get("type") not in ("EXEC", "EXEC_GM"): continue
+                if self.reply_delay: await asyncio.sleep(self.reply_delay)
+                self.send({"type": "RESULT", "seq": pkt.get("seq", pkt.get("id")), "ok": True, "result": self.idx})
+                self.replied += 1
+        except (asyncio.IncompleteReadError, ConnectionError, OSError): pass
+
+    async def _stream_logs(self):
+        tick = 0.02; carry = 0.0
+        while True:
+            carry += self.log_rate * tick
+            for _ in range(int(carry)): self.log(f"tick {self.logs_sent}")
+            carry -= int(carry)
+            try: await self.writer.drain()
+            except (ConnectionError, OSError): return
+            await asyncio.sleep(tick)
+
+    def log(self, msg, level="info", flush=True):
+        self.send({"type": "LOG", "level": level, "msg": msg}, flush); self.logs_sent += 1
+
+    async def flood(self, lines, chunk=500):
+        """Send `lines` LOG packets as fast as the socket accepts them (one compression flush per chunk)."""
+        for i in range(lines):
+            last = i % chunk == chunk - 1 or i == lines - 1
+            self.log(f"flood {i} from sim {self.idx}", flush=last)
+            if last: await self.writer.drain()
+        await self.writer.drain()
+
+    async def close(self):
+        for t in self.tasks: t.cancel()
+        if self.writer:
+            self.writer.close()
+            try: await self.writer.wait_closed()
+            except (ConnectionError, OSError): pass
+
+# ============================================================================
+# Benchmark runner
+# ============================================================================
+
+def _pct(samples, q):
+    s = sorted(samples)
+    return s[min(len(s)-1, int(q*len(s)))] if s else 0.0
+
+async def _until(pred, timeout, step=0.005):
+    end = time.perf_counter() + timeout
+    while not pred():
+        if time.perf_counter() > end: return False
+        await asyncio.sleep(step)
+    return True
+
+async def run_bench(clients=20, tree=500, rounds=20, log_lines=2000, port=23581, framing="line", compress=False, workers=None) -> Dict[str, Any]:
+    mgr = ServerMgr()
+    if workers is not None:
+        from gm_shard import ShardPool
+        mgr.shards = ShardPool(mgr, workers)
+    ok, msg = await mgr.add_listener(port)
+    if not ok: raise RuntimeError(msg)
+    sims = [SimClient(i, port=port, tree_size=tree, framing=framing, compress=compress) for i in range(clients)]
+    res: Dict[str, Any] = {"clients": clients, "tree": tree, "framing": framing, "compress": compress, "workers": workers}
+    cpu = time.process_time()
+    try:
+        # 1. connect + HELLO + GM_LIST
+        t0 = time.perf_counter()
+        await asyncio.gather(*(s.start() for s in sims))
+        await _until(lambda: sum(1 for c in mgr.clients.values() if c.uid.startswith("sim-")) == clients, 30)
+        t1 = time.perf_counter()
+        await _until(lambda: all(c.gm_tree for c in mgr.clients.values()), 60)
+        t2 = time.perf_counter()
+        res["connect_per_s"] = clients / (t1 - t0)
+        res["gm_list_ingest_ms"] = (t2 - t0) * 1000
+
+        # 2. broadcast: delivery (queued + drained) and full round trip (all RESULTs back)
+        deliver, rtt = [], []
+        for _ in range(rounds):
+            s = time.perf_counter()
+            report = await mgr.broadcast("return 1")
+            deliver.append((time.perf_counter() - s) * 1000)
+            await _until(lambda: not mgr.pending, 10, step=0.0005)
+            rtt.append((time.perf_counter() - s) * 1000)
+            res["broadcast_failures"] = res.get("broadcast_failures", 0) + sum(1 for ok, _ in report.values() if not ok)
+        res.update(broadcast_deliver_p50_ms=_pct(deliver, .5), broadcast_deliver_p95_ms=_pct(deliver, .95),
+                   broadcast_rtt_p50_ms=_pct(rtt, .5), broadcast_rtt_p95_ms=_pct(rtt, .95))
+
+        # 3. pipelined batch: per-device command sequence through run_batch
+        steps = ["return 1"] * (rounds * 10)
+        s = time.perf_counter()
+        report = await mgr.run_batch(steps)
+        res["batch_cmds_per_s"] = clients * len(steps) / (time.perf_counter() - s)
+        res["batch_failures"] = sum(1 for r in report.values() for ok, _ in r if not ok)
+
+        # 4. log ingest throughput
+        start_seq = mgr.logs.next_seq; total = clients * log_lines
+        s = time.perf_counter()
+        await asyncio.gather(*(c.flood(log_lines) for c in sims))
+        await _until(lambda: mgr.logs.next_seq - start_seq >= total, 120)
+        res["log_ingest_per_s"] = (mgr.logs.next_seq - start_seq) / (time.perf_counter() - s)
+
+        # 5. heap growth over a second flood (tracing only here; it slows everything down)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start_seq = mgr.logs.next_seq
+        await asyncio.gather(*(c.flood(log_lines) for c in sims))
+        await _until(lambda: mgr.logs.next_seq - start_seq >= total, 120)
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        res["heap_growth_kb"] = (after - before) / 1024
+        res["heap_peak_kb"] = (peak - before) / 1024
+        res["frame_errors"] = dict(mgr.frame_errors)
+        lag = mgr.loop_monitor.lag.snapshot()
+        res.update(loop_lag_p99_ms=lag["p99"], loop_lag_max_ms=lag["max"], loop_stalls=len(mgr.loop_monitor.stalls))
+        res["bytes_to_console"] = sum(c.bytes_out for c in sims)
+        res["bytes_from_console"] = sum(c.bytes_in for c in sims)
+        res["wire_to_console"] = sum(c.wire_out for c in sims)
+        res["wire_from_console"] = sum(c.wire_in for c in sims)
+        res["cpu_s"] = time.process_time() - cpu  # console and simulated devices together (not shard workers)
+    finally:
+        await asyncio.gather(*(s.close() for s in sims))
+        await mgr.remove_listener(port)
+    return res
+
+def run_codec(tree=2000, log_lines=20000) -> Dict[str, Any]:
+    """Size and CPU cost of the zlib stream against today's plain frames, without sockets:
+    one GM_LIST, and a LOG burst flushed every 50 packets (about one writer batch)."""
+    tree_frame = (json.dumps({"type": "GM_LIST", "version": 1, "data": gen_tree(tree)}, ensure_ascii=False) + "\n").encode()
+    logs = [(json.dumps({"type": "LOG", "level": "info", "msg": f"[Battle] unit {i % 97} took {i % 13 * 7} damage, hp {1000 - i % 1000}"}) + "\n").encode()
+            for i in range(log_lines)]
+    res: Dict[str, Any] = {}
+    for name, frames, every in (("tree", [tree_frame], 1), ("logs", logs, 50)):
+        plain = sum(map(len, frames)); res[f"{name}_plain_bytes"] = plain
+        for level in (1, 6):
+            z, out = zlib.compressobj(level), []
+            t = time.process_time()
+            for i, f in enumerate(frames):
+                out.append(z.compress(f))
+                if i % every == every - 1 or i == len(frames) - 1: out.append(z.flush(zlib.Z_SYNC_FLUSH))
+            packed_ms = (time.process_time() - t) * 1000
+            wire = b"".join(out)
+            t = time.process_time(); zlib.decompressobj().decompress(wire)
+            res[f"{name}_zlib{level}_bytes"] = len(wire); res[f"{name}_zlib{level}_ratio"] = plain / len(wire)
+            res[f"{name}_zlib{level}_compress_ms"] = packed_ms
+            res[f"{name}_zlib{level}_decompress_ms"] = (time.process_time() - t) * 1000
+    return res
+
+def print_report(res):
+    width = max(map(len, res))
+    for k, v in res.items():
+        print(f"{k:<{width}}  {v:,.2f}" if isinstance(v, float) else f"{k:<{width}}  {v}")
+
+async def run_sim(args):
+    sims = [SimClient(i, args.host, args.port, args.tree, args.logs, args.framing, compress=args.compress) for i in range(args.clients)]
+    await asyncio.gather(*(s.start() for s in sims))
+    print(f"{len(sims)} simulated devices on {args.host}:{args.port} (Ctrl+C to stop)")
+    try:
+        while True:
+            await asyncio.sleep(5)
+            print(f"received {sum(s.received for s in sims)}  replied {sum(s.replied for s in sims)}  logs {sum(s.logs_sent for s in sims)}")
+    finally:
+        await asyncio.gather(*(s.close() for s in sims))
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="GM Console load harness")
+    sub = ap.add_subparsers(dest="mode", required=True)
+    sim = sub.add_parser("sim", help="connect simulated devices to a running console")
+    sim.add_argument("--host", default="127.0.0.1"); sim.add_argument("--port", type=int, default=12581)
+    sim.add_argument("-n", "--clients", type=int, default=10)
+    sim.add_argument("--tree", type=int, default=200, help="GM_LIST nodes per device")
+    sim.add_argument("--logs", type=float, default=0.0, help="LOG lines per second per device")
+    sim.add_argument("--framing", choices=("line", "len"), default="line")
+    sim.add_argument("--compress", action="store_true", help="offer zlib stream compression in HELLO")
+    bench = sub.add_parser("bench", help="benchmark an in-process ServerMgr")
+    bench.add_argument("-n", "--clients", type=int, default=20)
+    bench.add_argument("--tree", type=int, default=500)
+    bench.add_argument("--rounds", type=int, default=20, help="broadcast rounds")
+    bench.add_argument("--log-lines", type=int, default=2000, help="LOG lines flooded per device")
+    bench.add_argument("--port", type=int, default=23581)
+    bench.add_argument("--framing", choices=("line", "len"), default="line")
+    bench.add_argument("--compress", action="store_true", help="simulated devices negotiate zlib stream compression")
+    bench.add_argument("--workers", type=int, metavar="N", help="run the console with N shard worker processes (0 = one per spare core)")
+    codec = sub.add_parser("codec", help="compare zlib stream and plain frames offline (bytes, CPU)")
+    codec.add_argument("--tree", type=int, default=2000)
+    codec.add_argument("--log-lines", type=int, default=20000)
+    for p in (bench, codec): p.add_argument("--json", action="store_true", help="print a single JSON object (for CI)")
+    args = ap.parse_args(argv)
+    try:
+        if args.mode == "sim": asyncio.run(run_sim(args)); return
+        if args.mode == "codec": res = run_codec(args.tree, args.log_lines)
+        else: res = asyncio.run(run_bench(args.clients, args.tree, args.rounds, args.log_lines, args.port, args.framing, args.compress, args.workers))
+    except KeyboardInterrupt: return
+    if args.json: print(json.dumps(res))
+    else: print_report(res)
+
+if __name__ == "__main__":
+    main()
@@ -5,207 +5,33 @@ GM Console v7.1 - Dialog Input Fix
 Fixes:
 1. UI Bug: Fixed "New Script" dialog input label clipping. 
    Switched from Quasar Labels to Placeholders to fit the custom 32px height constraint.
+
+NiceGUI front-end only; the networking core lives in gm_core.py.
 """
 
 import asyncio
 import json
-import socket
 import os
 import sys
-from datetime import datetime
-from dataclasses import dataclass, field
-from typing import Dict, List, Any
+import time
+from collections import OrderedDict
 from nicegui import ui, app
-
-# Windows asyncio exception handler
-def _windows_exception_handler(loop, context):
-    exception = context.get('exception')
-    if isinstance(exception, ConnectionResetError):
-        return
-    loop.default_exception_handler(context)
-
-# ============================================================================
-# Logic Components (Backend - Unchanged)
-# ============================================================================
-
-class CustomGmManager:
-    def __init__(self):
-        self.file_path = os.path.join(os.path.dirname(__file__), "custom_gm.json")
-        self.commands = self.load()
-    def load(self):
-        if not os.path.exists(self.file_path): return []
-        try:
-            with open(self.file_path, 'r', encoding='utf-8') as f: return json.load(f)
-        except: return []
-    def save(self):
-        try:
-            with open(self.file_path, 'w', encoding='utf-8') as f:
-                json.dump(self.commands, f, indent=2, ensure_ascii=False)
-        except: pass
-    def add(self, name, cmd):
-        self.commands.append({"name": name, "cmd": cmd})
-        self.save()
-    def delete(self, index):
-        if 0 <= index < len(self.commands):
-            self.commands.pop(index)
-            self.save()
-    def edit(self, index, name, cmd):
-        if 0 <= index < len(self.commands):
-            self.commands[index] = {"name": name, "cmd": cmd}
-            self.save()
+from gm_core import CustomGmManager, GMSearchIndex, GMTreeCache, ServerMgr, DEFAULT_PORT, _windows_exception_handler
+import gm_api
 
 custom_mgr = CustomGmManager()
 
-@dataclass
-class Client:
-    id: str
-    port: int
-    writer: asyncio.StreamWriter
-    device: str = "Unknown"
-    platform: str = "Unknown"
-    gm_tree: List[Any] = field(default_factory=list) 
-    ui_states: Dict[str, Any] = field(default_factory=dict)
-
-@dataclass
-class Log:
-    time: datetime
-    level: str
-    msg: str
-
-class ServerMgr:
-    def __init__(self):
-        self.listeners = {} 
-        self.clients = {}   
-        self.logs = []
-        self.cmd_id = 1000
-        self.on_update = None 
-        self.on_log = None
-        self.on_client_data_update = None
-    
-    async def add_listener(self, port):
-        if port in self.listeners: return False, f"Port {port} active"
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            sock.bind(("0.0.0.0", port))
-            sock.close()
-        except Exception as e: return False, f"Bind Error: {e}"
-        
-        try:
-            srv = await asyncio.start_server(lambda r,w: self._h(r,w,port), "0.0.0.0", port, reuse_address=True)
-            self.listeners[port] = srv
-            if self.on_update: self.on_update()
-            return True, "Success"
-        except Exception as e: return False, str(e)
-
-    async def remove_listener(self, port):
-        if port in self.listeners:
-            s = self.listeners.pop(port)
-            s.close()
-            try: await s.wait_closed()
-            except: pass
-        
-        to_remove = [cid for cid, c in self.clients.items() if c.port == port]
-        for cid in to_remove:
-            c = self.clients.pop(cid, None)
-            if c:
-                try: c.writer.close(); await c.writer.wait_closed()
-                except: pass
-        
-        if self.on_update: self.on_update()
-
-    async def _h(self, r, w, port):
-        addr = w.get_extra_info("peername")
-        cid = f"{addr[0]}:{addr[1]}"
-        for ocid in [k for k,v in self.clients.items() if v.port == port]:
-            oc = self.clients.pop(ocid)
-            try: oc.writer.close()
-            except: pass
-
-        self.clients[cid] = Client(id=cid, port=port, writer=w)
-        if self.on_update: self.on_update()
-        
-        try:
-            while True:
-                line = await r.readline()
-                if not line: break
-                try:
-                    pkt = json.loads(line.decode().strip())
-                    self._process(cid, pkt)
-                except: pass
-        except: pass
-        finally:
-            if cid in self.clients: del self.clients[cid]
-            if self.on_update: self.on_update()
-
-    def _process(self, cid, pkt):
-        t = pkt.get("type")
-        c = self.clients.get(cid)
-        if not c: return
-
-        if t == "HELLO":
-            c.device = pkt.get("device","Unknown")
-            c.platform = pkt.get("platform","Unknown")
-            if self.on_update: self.on_update()
-        elif t == "LOG":
-            l = Log(datetime.now(), pkt.get("level","info"), pkt.get("msg",""))
-            self.logs.append(l)
-            if self.on_log: self.on_log(l)
-        elif t == "GM_LIST":
-            c.gm_tree = pkt.get("data", [])
-            if self.on_client_data_update: self.on_client_data_update(cid)
-
-    async def send_to_port(self, port, cmd):
-        if port is None: 
-            await self.broadcast(cmd)
-            return True, "Broadcast Sent"
-            
-        client = next((c for c in self.clients.values() if c.port == port), None)
-        if not client: return False, f"No device on Port {port}"
-        
-        try:
-            data = json.dumps({"type":"EXEC","id":self.cmd_id,"cmd":cmd}, ensure_ascii=False)+"\n"
-            client.writer.write(data.encode())
-            await client.writer.drain()
-            return True, f"Sent to {client.device}"
-        except Exception as e: return False, str(e)
-
-    async def send_gm_to_port(self, port, gm_id, val=None):
-        if port is None:
-            await self.broadcast_gm(gm_id, val)
-            return True, "Broadcast GM Sent"
-
-        client = next((c for c in self.clients.values() if c.port == port), None)
-        if not client: return False, f"No device on Port {port}"
-        
-        if val is not None:
-            client.ui_states[gm_id] = val
-        
-        try:
-            data = json.dumps({"type":"EXEC_GM","id":gm_id,"value":val}, ensure_ascii=False)+"\n"
-            client.writer.write(data.encode())
-            await client.writer.drain()
-            return True, f"GM Sent to {client.device}"
-        except Exception as e: return False, str(e)
-
-    async def broadcast(self, cmd):
-        for cid, c in self.clients.items():
-            try:
-                c.writer.write((json.dumps({"type":"EXEC","id":self.cmd_id,"cmd":cmd}, ensure_ascii=False)+"\n").encode())
-                await c.writer.drain()
-            except: pass
-
-    async def broadcast_gm(self, gm_id, val=None):
-        for cid, c in self.clients.items():
-            try:
-                c.writer.write((json.dumps({"type":"EXEC_GM","id":gm_id,"value":val}, ensure_ascii=False)+"\n").encode())
-                await c.writer.drain()
-            except: pass
-
 mgr = ServerMgr()
-state = {"sel_port": None} 
+gm_api.mount(app, mgr)  # REST + WebSocket automation on the same port (/api/...)
+state = {"target": None}  # None = all devices, int = every device on a port, str = one device uid
 ui_settings = {"custom_cols": 5} 
 
+LOG_FLUSH_INTERVAL = 0.25  # seconds between sidebar flushes; at most one websocket update per tick
+LOG_VIEW_ROWS = 300        # rows held by the sidebar's virtual list
+TILE_PAGE = 60             # GM tiles created per page as the grid scrolls
+TILE_POOL = 240            # off-screen GM tiles kept alive for reuse
+SESSION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions")  # header REC button writes here
+
 # ============================================================================
 # UI Components
 # ============================================================================
@@ -363,6 +189,13 @@ def main():
             background: linear-gradient(145deg, var(--bg-surface) 0%, var(--accent-dim) 100%);
         }
 
+        /* Partial: some targeted devices lack this command (merged multi-device view) */
+        .control-tile.partial { border-color: rgba(245, 158, 11, 0.45); border-style: dashed; }
+        .tile-avail {
+            position: absolute; top: 4px; right: 8px; z-index: 1;
+            font-size: 9px; font-weight: 700; font-family: 'Fira Code', monospace; color: #f59e0b;
+        }
+
         .tile-head {
             font-size: 11px;
             font-weight: 600;
@@ -409,7 +242,8 @@ def main():
     ''')
 
     list_container = None
-    log_container = None
+    log_table = None
+    log_badge = None
     target_label = None
     
     refresh_gm_panel_callback = None 
@@ -418,18 +252,18 @@ def main():
     # --- UI UPDATE LOGIC ---
     def update_target_label():
         if not target_label: return
-        p = state["sel_port"]
-        if p is None:
+        t = state["target"]
+        clients = mgr.resolve(t)
+        if t is None:
             target_label.text = 'BROADCAST_LINK // ACTIVE'
-            target_label.classes('text-[var(--accent)]', remove='text-amber-500 text-[var(--text-sec)]')
+            target_label.classes('text-[var(--accent)]', remove='text-amber-500 text-[var(--text-sec)] text-emerald-500')
+        elif clients:
+            where = f'{clients[0].device.upper()} [:{clients[0].port}]' if isinstance(t, str) else f'PORT_{t} // {len(clients)} DEVICES'
+            target_label.text = f'LINK_ESTABLISHED: {where}'
+            target_label.classes('text-emerald-500', remove='text-[var(--text-sec)] text-[var(--accent)] text-amber-500')
         else:
-            client = next((c for c in mgr.clients.values() if c.port == p), None)
-            if client:
-                target_label.text = f'LINK_ESTABLISHED: {client.device.upper()} [:{p}]'
-                target_label.classes('text-emerald-500', remove='text-[var(--text-sec)] text-[var(--accent)] text-amber-500')
-            else:
-                target_label.text = f'LINK_LOST: PORT_{p}'
-                target_label.classes('text-amber-500', remove='text-[var(--text-sec)] text-[var(--accent)] text-emerald-500')
+            target_label.text = f'LINK_LOST: {"PORT_" + str(t) if isinstance(t, int) else t}'
+            target_label.classes('text-amber-500', remove='text-[var(--text-sec)] text-[var(--accent)] text-emerald-500')
 
     def refresh_list():
         if not list_container: return
@@ -438,29 +272,30 @@ def main():
         
         with list_container:
             # Broadcast Card
-            is_all_sel = state["sel_port"] is None
+            is_all_sel = state["target"] is None
             bc_classes = 'control-tile active' if is_all_sel else 'control-tile opacity-60'
             
-            with ui.row().classes(f'w-full p-3 mb-3 {bc_classes} items-center justify-center gap-2').on('click', lambda: select_port(None)):
+            with ui.row().classes(f'w-full p-3 mb-3 {bc_classes} items-center justify-center gap-2').on('click', lambda: select_target(None)):
                 ui.icon('hub', size='xs').classes('text-[var(--text-pri)]')
                 ui.label('BROADCAST_MESH').classes('text-xs font-bold tech-font text-[var(--text-pri)]')
 
-            # Active Ports
+            # Active Ports: the card targets every device on the port, each row a single device
             active_ports = sorted(mgr.listeners.keys())
             for port in active_ports:
-                connected_client = next((c for c in mgr.clients.values() if c.port == port), None)
-                is_selected = (state["sel_port"] == port)
+                devices = sorted(mgr.by_port.get(port, {}).values(), key=lambda c: (c.device, c.uid))
+                is_selected = (state["target"] == port)
                 card_cls = 'control-tile active' if is_selected else 'control-tile'
                 
-                with ui.column().classes(f'w-full p-0 mb-2 {card_cls} group').on('click', lambda p=port: select_port(p)):
+                with ui.column().classes(f'w-full p-0 mb-2 {card_cls} group gap-0').on('click', lambda p=port: select_target(p)):
                     # Header
                     with ui.row().classes('w-full justify-between items-center px-3 py-2 border-b border-[var(--border-subtle)] bg-[var(--bg-base)]/30'):
-                        ui.label(f':{port}').classes('text-[10px] font-mono text-[var(--text-pri)] opacity-70')
+                        ui.label(f':{port}' + (f' // {len(devices)}' if len(devices) > 1 else '')).classes('text-[10px] font-mono text-[var(--text-pri)] opacity-70')
                         
                         async def close_port(p=port):
                             await mgr.remove_listener(p)
-                            if state["sel_port"] == p: 
-                                state["sel_port"] = None
+                            t = state["target"]
+                            if t == p or (isinstance(t, str) and not mgr.resolve(t)):
+                                state["target"] = None
                                 if refresh_gm_panel_callback: refresh_gm_panel_callback()
                             ui.notify(f'Terminated Port {p}', type='info')
                             refresh_list()
@@ -468,22 +303,74 @@ def main():
                         ui.icon('power_settings_new', size='xs').classes('opacity-0 group-hover:opacity-100 cursor-pointer hover:text-red-500 transition-opacity text-[var(--text-sec)]').on('click.stop', close_port)
 
                     # Body
-                    with ui.row().classes('w-full px-3 py-2 items-center gap-3'):
-                        if connected_client:
+                    for dc in devices:
+                        row_cls = 'bg-[var(--accent-dim)]' if state["target"] == dc.uid else ''
+                        with ui.row().classes(f'w-full px-3 py-2 items-center gap-3 no-wrap {row_cls}').on('click.stop', lambda u=dc.uid: select_target(u)):
                             ui.element('div').classes('w-1.5 h-1.5 rounded-full bg-emerald-500 shadow-[0_0_8px_rgba(16,185,129,0.8)]')
                             with ui.column().classes('gap-0 flex-1 min-w-0'):
-                                ui.label(connected_client.device).classes('tile-head truncate')
-                                ui.label(connected_client.platform).classes('tile-meta opacity-50')
-                        else:
+                                ui.label(dc.device).classes('tile-head truncate')
+                                ui.label(dc.platform).classes('tile-meta opacity-50')
+                    if not devices:
+                        with ui.row().classes('w-full px-3 py-2 items-center gap-3'):
                             ui.element('div').classes('w-1.5 h-1.5 rounded-full bg-amber-500 animate-pulse')
                             ui.label('AWAITING_SIGNAL...').classes('text-[9px] font-bold text-amber-500 tech-font tracking-wider')
 
-    def select_port(port):
-        state["sel_port"] = port
+    def select_target(target):
+        state["target"] = target
         refresh_list()
         if refresh_gm_panel_callback: refresh_gm_panel_callback()
 
-    mgr.on_update = refresh_list
+    def on_registry_events(events):
+        if list_container.is_deleted: return unsubscribe_list()
+        refresh_list()
+    unsubscribe_list = mgr.events.subscribe(("listener", "client_added", "client_removed", "client_meta"), on_registry_events)
+
+    # --- LOG SIDEBAR: polls mgr.logs on a timer so ingest never touches the UI directly ---
+    log_view = {"seq": max(mgr.logs.first_seq, mgr.logs.next_seq - LOG_VIEW_ROWS), "rows": [], "dropped": 0, "collapsed": 0, "filter": ""}
+
+    def log_row(r):
+        return {'id': r.seq, 't': r.time.strftime('%H:%M:%S'), 'lv': r.level, 'dev': r.device, 'msg': r.msg, 'n': 1}
+
+    def update_log_badge():
+        v = log_view
+        log_badge.text = f'{v["dropped"]} DROPPED // {v["collapsed"]} COLLAPSED'
+        log_badge.set_visibility(bool(v["dropped"] or v["collapsed"]))
+
+    def flush_logs():
+        v = log_view
+        if not log_table or v["filter"]: return
+        top = mgr.logs.next_seq
+        if top == v["seq"]: return
+        start = max(v["seq"], mgr.logs.first_seq, top - LOG_VIEW_ROWS)
+        v["dropped"] += start - v["seq"]
+        fresh = []
+        last = v["rows"][0] if v["rows"] else None
+        for q in range(start, top):
+            r = mgr.logs.get(q)
+            if last and last['msg'] == r.msg and last['lv'] == r.level and last['dev'] == r.device:
+                last['n'] += 1; last['t'] = r.time.strftime('%H:%M:%S'); v["collapsed"] += 1
+                continue
+            last = log_row(r); fresh.append(last)
+        fresh.reverse()
+        v["rows"] = (fresh + v["rows"])[:LOG_VIEW_ROWS]
+        v["seq"] = top
+        log_table.rows = v["rows"]; log_table.update()
+        update_log_badge()
+
+    def clear_logs():
+        log_view.update(seq=mgr.logs.next_seq, rows=[], dropped=0, collapsed=0)
+        log_table.rows = []; log_table.update()
+        update_log_badge()
+
+    def filter_logs(e):
+        v = log_view
+        v["filter"] = (e.value or '').strip()
+        if v["filter"]:
+            v["rows"] = [log_row(r) for r in mgr.logs.query(text=v["filter"], limit=LOG_VIEW_ROWS)]
+        else:
+            v.update(seq=max(mgr.logs.first_seq, mgr.logs.next_seq - LOG_VIEW_ROWS), rows=[])
+        log_table.rows = v["rows"]; log_table.update()
+        flush_logs()
 
     # ==========================================================================
     # Layout Structure
@@ -503,6 +390,15 @@ def main():
                 ui.element('div').classes('w-2 h-2 rounded-full bg-emerald-500 animate-pulse')
                 ui.label().bind_text_from(mgr.listeners, lambda l: f'{len(l)} NODES ONLINE').classes('text-[10px] font-bold font-mono text-[var(--text-pri)]')
              
+             def toggle_recording():
+                 if mgr.recorder:
+                     ui.notify(f"Session saved: {mgr.stop_recording()}")
+                 else:
+                     os.makedirs(SESSION_DIR, exist_ok=True)
+                     path = os.path.join(SESSION_DIR, time.strftime('session-%Y%m%d-%H%M%S.gmrec'))
+                     ui.notify(f"Recording to {mgr.start_recording(path)}")
+                 rec_btn.classes(replace='text-red-500 animate-pulse' if mgr.recorder else 'btn-ghost')
+             rec_btn = ui.button(on_click=toggle_recording, icon='fiber_manual_record').props('flat round dense size=sm').classes('text-red-500 animate-pulse' if mgr.recorder else 'btn-ghost').tooltip('Record session (replay: python gm_core.py session ...)')
              ui.button(on_click=lambda: ui.run_javascript('document.body.classList.toggle("theme-light")'), icon='contrast').props('flat round dense size=sm').classes('btn-ghost')
 
     # --- BODY ---
@@ -551,7 +447,7 @@ def main():
                         ui.button('FLUSH_BUFFER', on_click=lambda: txt.set_value('')).props('flat dense size=xs').classes('text-[var(--text-sec)] font-mono hover:text-[var(--text-pri)]')
                         async def run_lua():
                             if not txt.value: return
-                            success, msg = await mgr.send_to_port(state["sel_port"], txt.value)
+                            success, msg = await mgr.send(state["target"], txt.value)
                             if success: ui.notify('Command Executed', type='positive')
                             else: ui.notify(msg, type='warning')
                         ui.button('EXECUTE', on_click=run_lua, icon='play_arrow').props('unelevated dense size=sm').classes('btn-action px-4')
@@ -561,6 +457,7 @@ def main():
                 with ui.tabs().classes('w-full text-[var(--text-sec)] border-b border-[var(--border-subtle)] bg-[var(--bg-base)]/50').props('dense active-color="accent" indicator-color="accent" align="left"') as tabs:
                     ui.tab('LuaGM', label='LuaGM').classes('font-bold tech-font tracking-wider text-xs px-6')
                     ui.tab('CustomGM', label='CustomGM').classes('font-bold tech-font tracking-wider text-xs px-6')
+                    ui.tab('Perf', label='Perf').classes('font-bold tech-font tracking-wider text-xs px-6')
                     ui.space()
                     
                     with ui.row().classes('items-center gap-3 mr-6'):
@@ -575,7 +472,7 @@ def main():
 
                         async def reload_gm():
                             c = "RuntimeGMClient.ReloadGM(true)"; 
-                            await mgr.send_to_port(state["sel_port"], c)
+                            await mgr.send(state["target"], c)
                             ui.notify("Sync Signal Sent")
                         ui.button(icon='sync', on_click=reload_gm).props('flat round dense size=sm').classes('text-[var(--text-sec)] hover:text-[var(--accent)]')
 
@@ -586,15 +483,28 @@ def main():
                         gm_area = ui.column().classes('w-full gap-4')
                         class GMExplorer:
                             def __init__(self):
-                                self.root = []; self.path = []; self.search = ""; self.client_context = None
+                                self.root = []; self.path = []; self.search = ""; self.found = {}; self.client_context = None
+                                self.frame = None; self.view = []; self.shown = 0
+                                # several devices targeted: the merged tree, with availability per node
+                                self.merged = None; self.group = []; self.weights = []; self.total = 0; self.mver = -1; self.msearch = (None, -1)
+                                # (node id, search path) -> card, LRU. Cards outside the grid wait hidden in self.pool for reuse.
+                                self.cache = OrderedDict()
                             def load_context(self):
-                                p = state["sel_port"]
-                                gm_area.clear()
-                                if p is None:
+                                t = state["target"]
+                                gm_area.clear(); self.frame = None; self.cache.clear(); self.shown = 0; self.merged = None
+                                group = sorted(mgr.resolve(t), key=lambda c: (c.device, c.uid))
+                                if t is None and not group:
                                     with gm_area: ui.label("SELECT TARGET NODE TO INITIALIZE UPLINK").classes('w-full text-center text-[var(--text-sec)] italic py-12 font-mono text-xs opacity-50')
                                     return
-                                client = next((c for c in mgr.clients.values() if c.port == p), None)
+                                client = group[0] if group else None
                                 self.client_context = client
+                                if len(group) > 1:
+                                    self.merged = mgr.merged_gm(); self.sync_group(group)
+                                    self.root = self.merged.tree
+                                    if not self.total:
+                                        with gm_area: ui.label("SYNCING DATA PACKETS...").classes('w-full text-center text-[var(--text-sec)] py-12 font-mono text-xs animate-pulse')
+                                    else: self.render()
+                                    return
                                 if not client:
                                     with gm_area:
                                         with ui.column().classes('w-full items-center justify-center py-12 opacity-30 gap-3'):
@@ -606,83 +516,256 @@ def main():
                                     with gm_area: ui.label("SYNCING DATA PACKETS...").classes('w-full text-center text-[var(--text-sec)] py-12 font-mono text-xs animate-pulse')
                                 else: self.render()
                             
+                            def sync_group(self, group):
+                                self.group = group
+                                self.weights = self.merged.weights(None if state["target"] is None else {c.id for c in group})
+                                self.total = sum(n for _, n in self.weights); self.mver = self.merged.version
+
+                            def refresh_merged(self):
+                                """Device joined, left or changed its tree: recount, and redraw only if something moved."""
+                                group = sorted(mgr.resolve(state["target"]), key=lambda c: (c.device, c.uid))
+                                if len(group) < 2: return self.load_context()
+                                ver = self.mver; self.merged.refresh(mgr.clients.values())
+                                if ver == self.merged.version and [c.id for c in group] == [c.id for c in self.group]: return
+                                had = self.total; self.sync_group(group); self.client_context = group[0]
+                                if not had or not self.total: return self.load_context()
+                                if ver != self.mver and any(id(n) not in self.merged.key_of for n in self.path):
+                                    self.path = []; return self.render()
+                                self.render_grid(keep=True)
+
+                            def badge(self, n):
+                                """(available, of) for a node some targeted devices lack, else None."""
+                                if not self.merged: return None
+                                k = self.merged.available(n, self.weights)
+                                return (k, self.total) if k < self.total else None
+
+                            def ctx_for(self, nid):
+                                """The device whose state a tile shows: the first targeted one that has the node."""
+                                if not self.merged: return self.client_context
+                                return next((c for c in self.group if nid in c.gm_index), self.client_context)
+
+                            def target_of(self, nid):
+                                """Where a tile's action goes: only devices that have the node when some lack it."""
+                                if not self.merged or all(nid in c.gm_index for c in self.group): return state["target"]
+                                return [c.uid for c in self.group if nid in c.gm_index]
+
                             def nav(self, idx): self.path = [] if idx == -1 else self.path[:idx+1]; self.render()
-                            def enter(self, node): self.path.append(node); self.render()
+                            def enter(self, node):
+                                parents = self.found.get(id(node)) if self.search.strip() else None
+                                if parents is None: self.path.append(node)
+                                else:  # a search hit: jump to where it lives and leave the search
+                                    self.path = [*parents, node]; self.search = ""; self.search_box.value = ""
+                                self.render()
                             
                             def render(self):
-                                gm_area.clear()
-                                with gm_area:
-                                    # Breadcrumb
-                                    with ui.row().classes('w-full items-center input-slot px-3 py-1.5 gap-2'):
-                                        ui.button(icon='home', on_click=lambda: self.nav(-1)).props('flat dense round size=xs').classes('text-[var(--text-sec)] hover:text-[var(--text-pri)]')
-                                        for i, n in enumerate(self.path):
-                                            ui.icon('chevron_right', size='xs').classes('text-[var(--text-sec)] opacity-40')
-                                            ui.button(n['name'], on_click=lambda x=i: self.nav(x)).props('flat dense no-caps size=sm').classes('text-[var(--accent)] font-mono text-xs font-bold hover:underline')
-                                        ui.space()
-                                        ui.input(placeholder='FILTER_CMD').props('dense borderless input-class="text-[var(--text-pri)] text-right font-mono text-xs"').classes('clean-input w-40').bind_value(self, 'search').on('input', self.render)
+                                if self.frame is None:
+                                    with gm_area:
+                                        # Breadcrumb
+                                        with ui.row().classes('w-full items-center input-slot px-3 py-1.5 gap-2') as self.frame:
+                                            self.crumbs = ui.row().classes('items-center gap-2')
+                                            ui.space()
+                                            self.search_box = ui.input(placeholder='FILTER_CMD', value=self.search, on_change=self.on_search).props('dense borderless debounce=250 input-class="text-[var(--text-pri)] text-right font-mono text-xs"').classes('clean-input w-40')
+                                        
+                                        # Grid: only the first `shown` entries of the view exist as elements
+                                        with ui.scroll_area().classes('w-full').style('height: calc(100vh - 420px); min-height: 320px') as self.scroller:
+                                            self.grid = ui.grid().classes('w-full gap-3')
+                                            with ui.row().classes('w-full justify-center py-3') as self.more:
+                                                self.more_btn = ui.button('LOAD MORE', on_click=self.show_more).props('flat dense no-caps size=sm').classes('text-[var(--text-sec)] font-mono text-xs hover:text-[var(--accent)]')
+                                        self.pool = ui.element('div').classes('hidden')
+                                    self.scroller.on('scroll', self.on_scroll, ['verticalPercentage'], throttle=0.2)
+                                self.grid.style(f'grid-template-columns: repeat({ui_settings["custom_cols"]}, minmax(0, 1fr))')
+                                self.crumbs.clear()
+                                with self.crumbs:
+                                    ui.button(icon='home', on_click=lambda: self.nav(-1)).props('flat dense round size=xs').classes('text-[var(--text-sec)] hover:text-[var(--text-pri)]')
+                                    for i, n in enumerate(self.path):
+                                        ui.icon('chevron_right', size='xs').classes('text-[var(--text-sec)] opacity-40')
+                                        ui.button(n['name'], on_click=lambda x=i: self.nav(x)).props('flat dense no-caps size=sm').classes('text-[var(--accent)] font-mono text-xs font-bold hover:underline')
+                                self.render_grid()
+
+                            def on_search(self, e):
+                                self.search = e.value or ""; self.render_grid()
+
+                            def on_scroll(self, e):
+                                if e.args.get('verticalPercentage', 0) > 0.85: self.show_more()
+
+                            def show_more(self):
+                                if self.shown < len(self.view): self.fill(self.shown + TILE_PAGE)
+
+                            def render_grid(self, keep=False):
+                                if self.search.strip():
+                                    hits = self.search_index().search(self.search)
+                                    self.found = {id(n): parents for n, parents in hits}
+                                    self.view = [(n, ' / '.join(str(p.get('name', '')) for p in parents) or None) for n, parents in hits]
+                                else:
+                                    self.view = [(n, None) for n in (self.path[-1].get('children', []) if self.path else self.root)]
+                                if self.merged and state["target"] is not None:
+                                    self.view = [x for x in self.view if self.merged.available(x[0], self.weights)]  # held only outside the group
+                                self.fill(max(TILE_PAGE, self.shown) if keep else TILE_PAGE)
+                                if not keep: self.scroller.scroll_to(percent=0)
+
+                            def fill(self, upto):
+                                """Reconcile the grid with view[:upto], moving cached cards into place instead of rebuilding."""
+                                upto = min(upto, len(self.view))
+                                want = [c for c in (self.card(n, where) for n, where in self.view[:upto]) if c]
+                                kids = self.grid.default_slot.children
+                                for i, card in enumerate(want):
+                                    if i >= len(kids) or kids[i] is not card: card.move(self.grid, target_index=i)
+                                for card in list(kids[len(want):]):
+                                    if getattr(card, 'gm_key', None) in self.cache: card.move(self.pool)
+                                    else: self.grid.remove(card)
+                                self.shown = upto
+                                self.more.set_visibility(upto < len(self.view))
+                                self.more_btn.text = f'LOAD MORE // {upto}/{len(self.view)}'
+                                parked = [k for k, c in self.cache.items() if c.parent_slot.parent is self.pool]
+                                for key in parked[:max(0, len(self.cache) - len(want) - TILE_POOL)]:
+                                    self.pool.remove(self.cache.pop(key))
+
+                            def search_index(self):
+                                if not self.merged: return mgr.search_index(self.client_context)
+                                if self.msearch[1] != self.merged.version: self.msearch = (GMSearchIndex(self.merged.tree), self.merged.version)
+                                return self.msearch[0]
+
+                            def card(self, n, where):
+                                badge = self.badge(n)
+                                nid = n.get('id'); key = (nid, where, badge) if nid is not None else None
+                                card = self.cache.get(key) if key else None
+                                if card is not None and card.gm_node is not n: card.parent_slot.parent.remove(self.cache.pop(key)); card = None  # node rebuilt by a tree change
+                                if card is None:
+                                    with self.pool: card = self.tile(n, where, badge)
+                                    if card is None: return None
+                                    card.gm_key = key; card.gm_node = n
+                                    if key: self.cache[key] = card
+                                else:
+                                    self.cache.move_to_end(key)
+                                    self.sync_control(card, nid)
+                                return card
+
+                            def sync_control(self, card, nid):
+                                """A reused Toggle / Input shows the state as it is now (API, batch, resume or ack may have moved it)."""
+                                box, c = getattr(card, 'gm_control', None), self.ctx_for(nid)
+                                if box is None or c is None or (c.id, nid) in mgr.controls: return  # in flight: keep the user's value
+                                want = c.ui_states.get(nid, False if isinstance(box, ui.switch) else "")
+                                if box.value != want: box.value = want  # tgl() ignores it: equals ui_states
+
+                            def tile(self, n, where=None, badge=None):
+                                """Build one node's card in the current context and register it by id."""
+                                typ, name, nid = n.get('type'), n.get('name'), n.get('id')
+                                
+                                # --- UNIFIED TILE STYLING ---
+                                
+                                if typ == 'Toggle':
+                                    async def tgl(e, i=nid):
+                                        c = self.ctx_for(i)
+                                        if c and e.value == c.ui_states.get(i, False) and (c.id, i) not in mgr.controls: return  # a revert below
+                                        res = await mgr.set_gm(self.target_of(i), i, e.value)
+                                        if c and c.id in res and not res[c.id][0]:
+                                            ui.notify(f'{name}: {res[c.id][1]}', type='warning')
+                                            e.sender.value = c.ui_states.get(i, False)  # show what the device actually has
+                                    initial_val = self.ctx_for(nid).ui_states.get(nid, False)
+                                    
+                                    with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-between') as card:
+                                        with ui.row().classes('w-full justify-between items-start no-wrap'):
+                                            ui.label(name).classes('tile-head leading-tight break-words pr-2')
+                                            box = ui.switch(value=initial_val, on_change=tgl).props('dense size=xs color=cyan').classes('min-w-[30px]')
+                                        ui.label('SWITCH_STATE').classes('tile-meta mt-auto self-start opacity-50')
+                                
+                                elif typ == 'Input':
+                                    # commit on Enter (always sent) or blur (only if changed), never per keystroke
+                                    async def inp(box, i=nid, force=False):
+                                        c = self.ctx_for(i)
+                                        if not force and c and box.value == c.ui_states.get(i, "") and (c.id, i) not in mgr.controls: return
+                                        res = await mgr.set_gm(self.target_of(i), i, box.value)
+                                        if c and c.id in res and not res[c.id][0]: ui.notify(f'{name}: {res[c.id][1]}', type='warning')
+                                    initial_val = self.ctx_for(nid).ui_states.get(nid, "")
                                     
-                                    # Grid
-                                    nodes = self.path[-1]['children'] if self.path else self.root
-                                    if self.search:
-                                        res = []; 
-                                        def find(ns):
-                                            for n in ns:
-                                                if self.search.lower() in n.get('name','').lower(): res.append(n)
-                                                if 'children' in n: find(n['children'])
-                                        find(self.root); nodes = res
+                                    with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-between gap-2') as card:
+                                        ui.label(name).classes('tile-head truncate w-full')
+                                        box = ui.input(value=initial_val).props('dense borderless input-class="text-xs text-center font-mono"').classes('w-full input-slot clean-input')
+                                        box.on('keydown.enter', lambda b=box: inp(b, force=True)).on('blur', lambda b=box: inp(b))
+                                
+                                elif typ == 'Btn':
+                                    async def clk(i=nid):
+                                        await mgr.send_gm(self.target_of(i), i)
+                                        ui.notify(f'Triggered: {name}')
                                     
-                                    cols = ui_settings['custom_cols']
-                                    with ui.grid().classes('w-full gap-3').style(f'grid-template-columns: repeat({cols}, minmax(0, 1fr))'):
-                                        for n in nodes:
-                                            typ, name, nid = n.get('type'), n.get('name'), n.get('id')
-                                            
-                                            # --- UNIFIED TILE STYLING ---
-                                            
-                                            if typ == 'Toggle':
-                                                async def tgl(e, i=nid):
-                                                    await mgr.send_gm_to_port(state["sel_port"], i, e.value)
-                                                initial_val = self.client_context.ui_states.get(nid, False)
-                                                
-                                                with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-between'):
-                                                    with ui.row().classes('w-full justify-between items-start no-wrap'):
-                                                        ui.label(name).classes('tile-head leading-tight break-words pr-2')
-                                                        ui.switch(value=initial_val, on_change=tgl).props('dense size=xs color=cyan').classes('min-w-[30px]')
-                                                    ui.label('SWITCH_STATE').classes('tile-meta mt-auto self-start opacity-50')
-                                            
-                                            elif typ == 'Input':
-                                                async def inp(e, i=nid):
-                                                    await mgr.send_gm_to_port(state["sel_port"], i, e.value)
-                                                initial_val = self.client_context.ui_states.get(nid, "")
-                                                
-                                                with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-between gap-2'):
-                                                    ui.label(name).classes('tile-head truncate w-full')
-                                                    ui.input(value=initial_val, on_change=inp).props('dense borderless input-class="text-xs text-center font-mono"').classes('w-full input-slot clean-input')
-                                            
-                                            elif typ == 'Btn':
-                                                async def clk(i=nid):
-                                                    await mgr.send_gm_to_port(state["sel_port"], i)
-                                                    ui.notify(f'Triggered: {name}')
-                                                
-                                                with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-between group').on('click', clk):
-                                                    ui.label(name).classes('tile-head leading-tight group-hover:text-[var(--accent)] transition-colors')
-                                                    with ui.row().classes('w-full justify-between items-end mt-auto'):
-                                                        ui.label('EXEC_CMD').classes('tile-meta opacity-40')
-                                                        ui.icon('touch_app', size='xs').classes('text-[var(--text-sec)] group-hover:text-[var(--accent)] transition-colors')
-                                            
-                                            elif typ == 'SubBox':
-                                                with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-center items-center gap-2 group').on('click', lambda x=n: self.enter(x)):
-                                                    ui.icon('folder_open', size='sm').classes('text-[var(--text-sec)] group-hover:text-[var(--accent)] transition-colors')
-                                                    ui.label(name).classes('tile-head text-center group-hover:text-[var(--text-pri)]')
+                                    with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-between group').on('click', clk) as card:
+                                        ui.label(name).classes('tile-head leading-tight group-hover:text-[var(--accent)] transition-colors')
+                                        with ui.row().classes('w-full justify-between items-end mt-auto'):
+                                            ui.label('EXEC_CMD').classes('tile-meta opacity-40')
+                                            ui.icon('touch_app', size='xs').classes('text-[var(--text-sec)] group-hover:text-[var(--accent)] transition-colors')
+                                
+                                elif typ == 'SubBox':
+                                    with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-center items-center gap-2 group').on('click', lambda x=n: self.enter(x)) as card:
+                                        ui.icon('folder_open', size='sm').classes('text-[var(--text-sec)] group-hover:text-[var(--accent)] transition-colors')
+                                        ui.label(name).classes('tile-head text-center group-hover:text-[var(--text-pri)]')
+                                else: return None
+                                if typ in ('Toggle', 'Input'): card.gm_control = box
+                                tip = [where] if where else []
+                                if badge:
+                                    # diff highlight: some targeted devices lack this node
+                                    lacking = set(self.merged.missing(n))
+                                    names = [c.device for c in self.group if c.id in lacking]
+                                    tip.append(f"missing on {len(names)}: {', '.join(names[:8])}{' ...' if len(names) > 8 else ''}")
+                                    card.classes('partial')
+                                    with card: ui.label(f'{badge[0]}/{badge[1]}').classes('tile-avail')
+                                if tip:
+                                    with card: ui.tooltip('\n'.join(tip)).classes('whitespace-pre-line')
+                                return card
+
+                            def apply_patch(self, changed):
+                                """Drop the cards a GM_PATCH touched and reconcile; untouched tiles are kept as-is."""
+                                if self.merged: return self.refresh_merged()
+                                if not self.client_context or not self.client_context.gm_tree: return self.load_context()
+                                if self.frame is None: return self.render()
+                                crumbs = False
+                                for kind, node, parent in changed:
+                                    for key in [k for k in self.cache if k[0] == node.get('id')]:
+                                        card = self.cache.pop(key); card.parent_slot.parent.remove(card)
+                                    hit = next((i for i, x in enumerate(self.path) if x is node), None)
+                                    if hit is not None:
+                                        if kind == 'remove': self.path = self.path[:hit]
+                                        crumbs = True
+                                if crumbs: self.render()
+                                else: self.render_grid(keep=True)
                         
                         explorer = GMExplorer()
                         def refresh_gm_proxy(): explorer.load_context()
                         refresh_gm_panel_callback = refresh_gm_proxy
-                        mgr.on_client_data_update = lambda cid: refresh_gm_proxy() if state["sel_port"] else None
+                        def on_gm_events(events):
+                            if gm_area.is_deleted: return unsubscribe_gm()
+                            t = state["target"]
+                            if explorer.merged: return explorer.refresh_merged()
+                            ctx = explorer.client_context
+                            # a new/removed device can change which client the current target shows
+                            if any(e.kind != "gm_tree_changed" for e in events):
+                                group = mgr.resolve(t)
+                                first = min(group, key=lambda c: (c.device, c.uid), default=None)
+                                if first is not ctx or len(group) > 1: return explorer.load_context()
+                            mine = [e for e in events if e.kind == "gm_tree_changed" and ctx and e.cid == ctx.id]
+                            if not mine: return
+                            if any(e.data is None for e in mine): return explorer.load_context()
+                            explorer.apply_patch([op for e in mine for op in e.data])
+                        unsubscribe_gm = mgr.events.subscribe(("gm_tree_changed", "client_added", "client_removed", "client_meta"), on_gm_events)
                         explorer.load_context()
 
                     with ui.tab_panel('CustomGM').classes('p-0'):
+                        cust_view = {"folder": None}
+                        def split_tags(text): return [t for t in (text or '').replace('#', ' ').replace(',', ' ').split() if t]
+                        def export_lib():
+                            lib = custom_mgr.export_library([it['id'] for it in custom_mgr.find(cust_view["folder"])])
+                            ui.download(json.dumps(lib, ensure_ascii=False, indent=2).encode('utf-8'), 'gm_library.json')
+                        async def import_lib(e):
+                            data = await e.file.read() if hasattr(e, 'file') else e.content.read()  # NiceGUI 3 / 2 upload events
+                            try: n = custom_mgr.import_library(json.loads(data), (imp_folder.value or '').strip() or None)
+                            except ValueError as err: ui.notify(f"Import failed: {err}", type='negative'); return
+                            ui.notify(f"Imported {n} scripts"); imp_dlg.close(); r_cust()
+
                         with ui.row().classes('w-full mb-3 justify-between items-center'):
                             ui.button('NEW SCRIPT', icon='add', on_click=lambda: add_dlg.open()).props('unelevated dense size=sm').classes('btn-action px-3 text-xs')
+                            with ui.row().classes('gap-1 items-center'):
+                                folder_sel = ui.select([], value=None, on_change=lambda e: (cust_view.update(folder=e.value), r_cust())).props('dense borderless clearable options-dense placeholder=ALL_FOLDERS').classes('w-40 clean-input')
+                                ui.button(icon='file_download', on_click=export_lib).props('flat dense round size=sm').classes('text-[var(--text-sec)]').tooltip('Export library')
+                                ui.button(icon='file_upload', on_click=lambda: imp_dlg.open()).props('flat dense round size=sm').classes('text-[var(--text-sec)]').tooltip('Import library')
                             
                             # --- FIXED DIALOG INPUTS ---
                             with ui.dialog() as add_dlg, ui.card().classes('w-96 p-4 gap-4 glass-panel border border-[var(--border-subtle)]'):
@@ -690,39 +773,58 @@ def main():
                                 # FIX: Removed first argument (Label) and used placeholder prop instead
                                 n_in = ui.input(placeholder='PROTOCOL_NAME').props('dense borderless').classes('w-full clean-input input-slot px-2')
                                 c_in = ui.textarea(placeholder='PAYLOAD_LUA').props('borderless').classes('w-full clean-textarea input-slot px-2')
-                                ui.button('SAVE', on_click=lambda: (custom_mgr.add(n_in.value, c_in.value), add_dlg.close(), r_cust())).classes('btn-action w-full')
+                                with ui.row().classes('w-full gap-2 no-wrap'):
+                                    f_in = ui.input(placeholder='FOLDER (a/b)').props('dense borderless').classes('flex-1 clean-input input-slot px-2')
+                                    t_in = ui.input(placeholder='TAGS').props('dense borderless').classes('flex-1 clean-input input-slot px-2')
+                                ui.button('SAVE', on_click=lambda: (custom_mgr.add(n_in.value, c_in.value, (f_in.value or '').strip(), split_tags(t_in.value)), add_dlg.close(), r_cust())).classes('btn-action w-full')
                             
                             # --- EDIT DIALOG ---
-                            edit_idx = [0]
+                            edit_id = [None]
                             with ui.dialog() as edit_dlg, ui.card().classes('w-96 p-4 gap-4 glass-panel border border-[var(--border-subtle)]'):
                                 ui.label('EDIT PROTOCOL').classes('font-bold text-[var(--text-pri)] tech-font')
                                 e_n_in = ui.input(placeholder='PROTOCOL_NAME').props('dense borderless').classes('w-full clean-input input-slot px-2')
                                 e_c_in = ui.textarea(placeholder='PAYLOAD_LUA').props('borderless').classes('w-full clean-textarea input-slot px-2')
+                                with ui.row().classes('w-full gap-2 no-wrap'):
+                                    e_f_in = ui.input(placeholder='FOLDER (a/b)').props('dense borderless').classes('flex-1 clean-input input-slot px-2')
+                                    e_t_in = ui.input(placeholder='TAGS').props('dense borderless').classes('flex-1 clean-input input-slot px-2')
                                 with ui.row().classes('w-full gap-2'):
-                                    ui.button('SAVE', on_click=lambda: (custom_mgr.edit(edit_idx[0], e_n_in.value, e_c_in.value), edit_dlg.close(), r_cust())).classes('btn-action flex-1')
+                                    ui.button('SAVE', on_click=lambda: (custom_mgr.edit(edit_id[0], e_n_in.value, e_c_in.value, (e_f_in.value or '').strip(), split_tags(e_t_in.value)), edit_dlg.close(), r_cust())).classes('btn-action flex-1')
                                     ui.button('CANCEL', on_click=lambda: edit_dlg.close()).classes('btn-action flex-1')
+
+                            # --- IMPORT DIALOG ---
+                            with ui.dialog() as imp_dlg, ui.card().classes('w-96 p-4 gap-4 glass-panel border border-[var(--border-subtle)]'):
+                                ui.label('IMPORT LIBRARY').classes('font-bold text-[var(--text-pri)] tech-font')
+                                imp_folder = ui.input(placeholder='INTO_FOLDER (optional)').props('dense borderless').classes('w-full clean-input input-slot px-2')
+                                ui.upload(on_upload=import_lib, auto_upload=True).props('accept=.json,.jsonl flat bordered').classes('w-full')
                         
                         c_grid = ui.grid().classes('w-full gap-3')
                         def r_cust():
+                            folder_sel.options = custom_mgr.folders()
+                            if cust_view["folder"] not in folder_sel.options: cust_view["folder"] = None; folder_sel.value = None
+                            folder_sel.update()
                             c_grid.clear()
                             cols = ui_settings['custom_cols']
                             c_grid.style(f'grid-template-columns: repeat({cols}, minmax(0, 1fr))')
                             with c_grid:
-                                for idx, item in enumerate(custom_mgr.commands):
+                                for item in custom_mgr.find(cust_view["folder"]):
                                     with ui.card().classes('control-tile p-3 h-24 flex flex-col justify-between group'):
                                         async def run_c(c=item['cmd'], name=item['name']):
-                                            success, msg = await mgr.send_to_port(state["sel_port"], c)
+                                            success, msg = await mgr.send(state["target"], c)
                                             if success: ui.notify(f"Sent: {name}")
                                         with ui.column().classes('w-full h-full cursor-pointer justify-between gap-1').on('click', run_c):
                                             ui.label(item['name']).classes('tile-head line-clamp-2')
                                             ui.label(item['cmd']).classes('tile-meta font-mono truncate w-full opacity-60')
-                                        def open_edit(current_item=item, current_idx=idx):
+                                        if item['folder'] or item['tags']:
+                                            ui.tooltip(' '.join([item['folder']] * bool(item['folder']) + [f"#{t}" for t in item['tags']]))
+                                        def open_edit(current_item=item):
                                             e_n_in.set_value(current_item['name'])
                                             e_c_in.set_value(current_item['cmd'])
-                                            edit_idx[0] = current_idx
+                                            e_f_in.set_value(current_item['folder'])
+                                            e_t_in.set_value(' '.join(current_item['tags']))
+                                            edit_id[0] = current_item['id']
                                             edit_dlg.open()
-                                        def open_delete(current_idx=idx):
-                                            custom_mgr.delete(current_idx)
+                                        def open_delete(current_id=item['id']):
+                                            custom_mgr.delete(current_id)
                                             r_cust()
                                         with ui.row().classes('absolute top-1 right-1 gap-1 opacity-0 group-hover:opacity-100'):
                                             ui.button(icon='edit', on_click=open_edit).props('flat dense round size=xs color-amber').classes('hover:text-amber-300')
@@ -731,31 +833,102 @@ def main():
                         refresh_custom_panel_callback = r_cust
                         r_cust()
 
+                    with ui.tab_panel('Perf').classes('p-0'):
+                        perf_head = ui.label('').classes('text-[10px] font-mono text-[var(--text-sec)] mb-2')
+                        kb = lambda n: f"{n/1024:,.1f}K" if n < 1 << 20 else f"{n/(1 << 20):,.1f}M"
+                        perf_cols = [
+                            {'name': 'device', 'label': 'DEVICE', 'field': 'device', 'align': 'left', 'sortable': True},
+                            {'name': 'port', 'label': 'PORT', 'field': 'port', 'sortable': True},
+                            {'name': 'rx', 'label': 'IN pkts / bytes', 'field': 'rx'},
+                            {'name': 'tx', 'label': 'OUT pkts / bytes', 'field': 'tx'},
+                            {'name': 'err', 'label': 'ERR', 'field': 'err', 'sortable': True},
+                            {'name': 'queue', 'label': 'QUEUE / PEAK', 'field': 'queue'},
+                            {'name': 'drain', 'label': 'DRAIN p95', 'field': 'drain', 'sortable': True},
+                            {'name': 'rtt', 'label': 'RTT p50 / p95', 'field': 'rtt'},
+                            {'name': 'pend', 'label': 'PEND', 'field': 'pend', 'sortable': True},
+                            {'name': 'rc', 'label': 'RECONN', 'field': 'rc', 'sortable': True},
+                            {'name': 'seen', 'label': 'SEEN', 'field': 'seen', 'sortable': True},
+                        ]
+                        perf_table = ui.table(columns=perf_cols, rows=[], row_key='cid').props('dense flat hide-bottom').classes('w-full font-mono text-xs bg-transparent')
+                        def log_drops():
+                            n = mgr.log_pipeline.counts
+                            dropped = n['filtered'] + n['rate_limited'] + n['sampled']
+                            return f' (DROPPED {dropped:,})' if dropped else ''
+                        def refresh_perf():
+                            if tabs.value != 'Perf': return  # nothing to redraw while the panel is hidden
+                            lag = mgr.loop_monitor.lag.snapshot()
+                            perf_head.text = (f'{len(mgr.clients)} CLIENTS // LOOP LAG p50 {lag["p50"]:.1f} ms  p99 {lag["p99"]:.1f} ms  '
+                                              f'// STALLS {mgr.loop_monitor.stall_count} // LOGS {mgr.logs.next_seq:,}{log_drops()} // /metrics')
+                            perf_table.rows = [{'cid': r['cid'], 'device': f"{r['device']} ({r['uid']})", 'port': r['port'],
+                                                'rx': f"{r['pkts_in']:,} / {kb(r['bytes_in'])}" + (f" ({kb(r['wire_in'])} {r['compress']})" if r['compress'] else ''),
+                                                'tx': f"{r['pkts_out']:,} / {kb(r['bytes_out'])}" + (f" ({kb(r['wire_out'])} {r['compress']})" if r['compress'] else ''),
+                                                'err': r['parse_errors'], 'queue': f"{r['queue']} / {r['queue_peak']}", 'drain': round(r['drain_p95_ms'], 2),
+                                                'rtt': f"{r['rtt_p50_ms']:.1f} / {r['rtt_p95_ms']:.1f}", 'pend': r['pending'], 'rc': r['reconnects'],
+                                                'seen': f"{r['last_seen_s']:.1f}s"} for r in mgr.metrics()]
+                            perf_table.update()
+                        ui.timer(1.0, refresh_perf)
+
         # --- RIGHT SIDEBAR (LOGS) ---
         with ui.column().classes('w-[280px] h-full glass-panel border-r-0 border-y-0 flex-none flex flex-col'):
             with ui.row().classes('h-[42px] px-3 items-center justify-between border-b border-[var(--border-subtle)] bg-[var(--bg-base)]/30 w-full'):
                 ui.label('SYSTEM_LOGS').classes('text-[10px] font-bold text-[var(--text-sec)] tech-font tracking-widest')
-                ui.button(icon='delete_outline', on_click=lambda: log_container.clear()).props('flat dense round size=xs').classes('text-[var(--text-sec)] hover:text-red-400')
-            log_container = ui.column().classes('w-full flex-1 overflow-y-auto gap-0 p-0')
+                ui.button(icon='delete_outline', on_click=clear_logs).props('flat dense round size=xs').classes('text-[var(--text-sec)] hover:text-red-400')
+            with ui.row().classes('w-full px-3 py-1 items-center gap-2 border-b border-[var(--border-subtle)]'):
+                ui.input(placeholder='FILTER_LOG', on_change=filter_logs).props('dense borderless debounce=300').classes('flex-1 clean-input')
+                log_badge = ui.label('').classes('text-[9px] font-bold font-mono text-amber-500')
+                log_badge.set_visibility(False)
+            # Virtual-scroll table: only rows in the viewport exist in the DOM
+            log_table = ui.table(columns=[{'name': 'msg', 'label': '', 'field': 'msg', 'align': 'left'}], rows=[], row_key='id') \
+                .props('dense flat square hide-header hide-bottom virtual-scroll :virtual-scroll-item-size="18" :rows-per-page-options="[0]"') \
+                .classes('w-full flex-1 min-h-0 bg-transparent text-[var(--text-pri)]')
+            log_table.add_slot('body', r'''
+                <q-tr :props="props">
+                    <q-td class="font-mono text-[10px] leading-tight whitespace-pre-wrap break-all" style="height: auto">
+                        <span class="opacity-40">{{ props.row.t }}</span>
+                        <span :class="props.row.lv == 'error' ? 'text-red-400' : props.row.lv == 'warn' ? 'text-amber-400' : 'opacity-60'"> {{ props.row.lv.toUpperCase() }}</span>
+                        <span class="opacity-40"> {{ props.row.dev }}</span>
+                        {{ props.row.msg }}
+                        <span v-if="props.row.n > 1" class="text-[var(--accent)] font-bold"> x{{ props.row.n }}</span>
+                    </q-td>
+                </q-tr>
+            ''')
+            ui.timer(LOG_FLUSH_INTERVAL, flush_logs)
+
+listen_ports = [DEFAULT_PORT]
 
 async def startup():
     if sys.platform == 'win32': asyncio.get_running_loop().set_exception_handler(_windows_exception_handler)
-    await mgr.add_listener(12581)
+    for p in listen_ports: await mgr.add_listener(p)
 
 async def cleanup():
+    mgr.stop_recording()
     for port in list(mgr.listeners.keys()): await mgr.remove_listener(port)
+    mgr.log_pipeline.close()
+    await custom_mgr.aclose()
 
 app.on_startup(startup)
 app.on_shutdown(cleanup)
 
 def kill_web_ui_port(port):
+    # Windows-only (netstat | findstr / taskkill): clears a zombie console still holding the web port
+    if sys.platform != 'win32': return
     try:
         import subprocess
-        r = subprocess.check_output(f'netstat -ano | findstr :{port}', shell=True).decode()
+        r = subprocess.check_output(f'netstat -ano | findstr :{port}', shell=True, timeout=5).decode()
         for pid in {line.split()[-1] for line in r.splitlines() if 'LISTENING' in line}:
             if pid != str(os.getpid()): os.system(f'taskkill /F /PID {pid} >nul 2>&1')
     except: pass
 
-if __name__ in {"__main__", "__mp_main__"}:
-    kill_web_ui_port(9529)
-    ui.run(title="GM Core 7.1", host="0.0.0.0", port=9529, reload=False, favicon='💠')
\ No newline at end of file
+def run(web_port=9529, listen=(DEFAULT_PORT,), workers=None, gm_cache=None, logs=None):
+    listen_ports[:] = listen
+    if gm_cache: mgr.gm_cache = GMTreeCache(path=gm_cache)
+    if logs: mgr.log_pipeline.configure(**logs)  # ValueError for a bad --log-* option, before anything listens
+    if workers is not None:
+        from gm_shard import ShardPool
+        mgr.shards = ShardPool(mgr, workers)
+    kill_web_ui_port(web_port)
+    ui.run(title="GM Core 7.1", host="0.0.0.0", port=web_port, reload=False, favicon='💠')
+
+# not "__mp_main__": shard workers are spawned and re-import this file under that name (reload is off)
+if __name__ == "__main__":
+    run()
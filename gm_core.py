@@ -0,0 +1,2200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GM Console core - headless networking and protocol layer.
+ServerMgr, Client and the packet protocol without any UI dependency, so scripts and CI
+can drive devices directly. gm_console.py builds the NiceGUI front-end on top of this.
+
+  python gm_core.py serve --port 12581                 # headless console, logs to stdout
+  python gm_core.py exec "print(1)" --devices 2        # wait for 2 devices, run Lua, print JSON results
+  python gm_core.py batch steps.json --stop-on-error   # pipelined command list, one JSON line per step
+  python gm_core.py serve --record qa.gmrec            # capture a session; replay with `session info|ingest|send`
+  python gm_core.py serve --workers 4                  # device sockets read and parsed in 4 processes (gm_shard.py)
+  python gm_core.py library export team.json --folder team   # share custom GM scripts
+  python gm_core.py ui                                 # load the NiceGUI console (port 9529)
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import os
+import re
+import signal
+import sys
+import hashlib
+import heapq
+import itertools
+import marshal
+import threading
+import time
+import traceback
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Any, Optional, Set, Tuple
+
+# Windows asyncio exception handler
+def _windows_exception_handler(loop, context):
+    exception = context.get('exception')
+    if isinstance(exception, ConnectionResetError):
+        return
+    loop.default_exception_handler(context)
+
+def write_atomic(path, data):
+    """Replace `path` with `data` (str or bytes) via temp file + fsync + os.replace; readers see old or new, never half."""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data.encode('utf-8') if isinstance(data, str) else data); f.flush(); os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+# ============================================================================
+# I/O offload: nothing that touches disk or spawns processes runs on the loop thread
+# ============================================================================
+
+IO_WORKERS = 2            # threads in the shared I/O executor
+LOOP_LAG_TICK = 0.05      # seconds between loop heartbeats
+LOOP_LAG_WARN = 0.1       # a callback holding the loop longer than this is reported as a stall
+
+_io_pool: Optional[ThreadPoolExecutor] = None
+
+def io_pool() -> ThreadPoolExecutor:
+    global _io_pool
+    if _io_pool is None: _io_pool = ThreadPoolExecutor(IO_WORKERS, thread_name_prefix="gm-io")
+    return _io_pool
+
+async def run_io(fn, *args):
+    """Run blocking fn(*args) on the I/O executor (not the default one, which DNS and to_thread share)."""
+    return await asyncio.get_running_loop().run_in_executor(io_pool(), fn, *args)
+
+class FileWriter:
+    """Ordered file writes off the event loop. append() / replace() return at once; a task per
+    path hands queued jobs to the I/O executor in submission order, merging adjacent appends
+    into one write + fsync. Without a running loop (scripts, CLI) jobs are written through."""
+    def __init__(self, fsync=True):
+        self.fsync = fsync
+        self.queues: Dict[str, deque] = {}   # path -> jobs: bytes = append, list = [whole new content], None = delete
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.locks: Dict[str, threading.Lock] = {}
+        self.errors = 0
+
+    def append(self, path, data): self._put(path, data.encode('utf-8') if isinstance(data, str) else data)
+    def replace(self, path, data): self._put(path, [data])
+    def remove(self, path): self._put(path, None)
+
+    def pending(self, path=None) -> int:
+        return len(self.queues.get(path, ())) if path else sum(map(len, self.queues.values()))
+
+    def _put(self, path, job):
+        self.queues.setdefault(path, deque()).append(job)
+        try: loop = asyncio.get_running_loop()
+        except RuntimeError: self.write_now(path); return
+        t = self.tasks.get(path)
+        if not t or t.done(): self.tasks[path] = loop.create_task(self._drain(path))
+
+    async def _drain(self, path):
+        while self.queues.get(path): await run_io(self.write_now, path)
+
+    def write_now(self, path):
+        """Write everything queued for `path` on the calling thread."""
+        q = self.queues.get(path)
+        with self.locks.setdefault(path, threading.Lock()):
+            while q:
+                job = q.popleft()
+                try:
+                    if job is None:
+                        if os.path.exists(path): os.remove(path)
+                    elif isinstance(job, list): write_atomic(path, job[0])
+                    else:
+                        chunk = [job]
+                        while q and isinstance(q[0], bytes): chunk.append(q.popleft())
+                        with open(path, 'ab') as f:
+                            f.write(b"".join(chunk)); f.flush()
+                            if self.fsync: os.fsync(f.fileno())
+                except OSError as e:
+                    self.errors += 1
+                    print(f"write to {path} failed: {e}", file=sys.stderr)
+
+    async def flush(self):
+        """Wait until every queued job is on disk."""
+        while any(self.queues.values()):
+            for path, q in list(self.queues.items()):
+                t = self.tasks.get(path)
+                if t and not t.done(): await t
+                elif q: await run_io(self.write_now, path)
+
+file_writer = FileWriter()
+
+class LoopMonitor:
+    """Event-loop lag meter. A loop task ticks every LOOP_LAG_TICK and records how late each
+    tick fires. A watchdog thread notices when no tick has happened for LOOP_LAG_WARN and
+    grabs the loop thread's stack at that moment, which is the callback that blocks it. The
+    stall is reported through on_stall(ms, where) on the loop once the callback returns."""
+    def __init__(self, threshold=LOOP_LAG_WARN, interval=LOOP_LAG_TICK, on_stall=None):
+        self.threshold = threshold; self.interval = interval
+        self.on_stall: Optional[Callable[[float, str], None]] = on_stall
+        self.lag = LatencyStats()
+        self.stalls: deque = deque(maxlen=50)   # (epoch ts, ms, where)
+        self.stall_count = 0
+        self.beat = 0.0
+        self._where = None
+        self._thread_id = None
+        self._stop = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task: return
+        self._thread_id = threading.get_ident(); self.beat = time.monotonic()
+        self._stop = threading.Event()  # fresh per start, so a stopped watchdog can't be revived
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        threading.Thread(target=self._watch, args=(self._stop,), name="gm-loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task: self._task.cancel(); self._task = None
+
+    async def _tick(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.beat = now = time.monotonic()
+            ms = max(0.0, (now - start - self.interval) * 1000)
+            self.lag.add(ms)
+            if ms >= self.threshold * 1000:
+                where, self._where = self._where or "unknown (blocked between watchdog checks)", None
+                self.stalls.append((time.time(), ms, where)); self.stall_count += 1
+                if self.on_stall: self.on_stall(ms, where)
+
+    def _watch(self, stop):
+        while not stop.wait(self.threshold / 2):
+            if self._where or time.monotonic() - self.beat < self.threshold + self.interval: continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None: continue
+            stack = traceback.extract_stack(frame, limit=12)
+            own = [f for f in stack if os.path.basename(os.path.dirname(f.filename)) != "asyncio"] or stack
+            self._where = " <- ".join(f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in reversed(own[-3:]))
+
+    def report(self):
+        return {"lag_ms": self.lag.snapshot(), "stalls": [{"ts": ts, "ms": ms, "where": w} for ts, ms, w in self.stalls]}
+
+# ============================================================================
+# Logic Components (Backend)
+# ============================================================================
+
+class CustomGmManager:
+    """Custom script library stored as an append-only JSONL journal of put/del records
+    keyed by stable ids. Each edit appends one line; load replays the journal and skips a
+    torn last line. Once dead records outnumber live ones, the next edit queues a snapshot.
+    The snapshot is written to a temp file and swapped in with os.replace, so a crash never
+    leaves a half-written library. Disk work goes through the shared FileWriter."""
+    def __init__(self, path=None, writer=None):
+        self.file_path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "custom_gm.jsonl")
+        self.legacy_path = os.path.join(os.path.dirname(self.file_path), "custom_gm.json")  # pre-journal format
+        self.items: Dict[str, dict] = {}   # id -> {"id", "name", "cmd", "folder", "tags"}, in display order
+        self.lines = 0                     # records in the journal file, live or dead
+        self.writer: FileWriter = writer or file_writer
+        self.load()
+
+    @property
+    def commands(self) -> List[dict]: return list(self.items.values())
+
+    def load(self):
+        self.items.clear(); self.lines = 0
+        if not os.path.exists(self.file_path):
+            if os.path.exists(self.legacy_path):
+                try:
+                    with open(self.legacy_path, 'r', encoding='utf-8') as f: self.import_library(json.load(f))
+                except (OSError, ValueError) as e: print(f"custom_gm: cannot migrate {self.legacy_path}: {e}", file=sys.stderr)
+            return
+        line = ""
+        with open(self.file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: rec = json.loads(line)
+                except ValueError: continue  # torn tail of an interrupted append
+                self.lines += 1
+                if rec.get("op") == "del": self.items.pop(rec.get("id"), None)
+                elif rec.get("op") == "put": self.items[rec["id"]] = self._item(rec)
+        if line and not line.endswith("\n"):  # rewrite, or the next append would land on the torn line
+            self.writer.replace(self.file_path, "".join(self._snapshot())); self.lines = len(self.items)
+
+    @staticmethod
+    def _item(rec):
+        tags = rec.get("tags") or []
+        return {"id": rec["id"], "name": str(rec.get("name", "")), "cmd": str(rec.get("cmd", "")),
+                "folder": str(rec.get("folder") or ""), "tags": list(dict.fromkeys(str(t).strip() for t in tags if str(t).strip()))}
+
+    def _new_id(self):
+        while True:
+            cid = os.urandom(6).hex()
+            if cid not in self.items: return cid
+
+    # --- Journal ---
+    def _log(self, *recs):
+        self.lines += len(recs)
+        if self.lines > CUSTOM_COMPACT_MIN and self.lines > 2 * len(self.items):
+            self.writer.replace(self.file_path, "".join(self._snapshot()))
+            self.lines = len(self.items)
+        else: self.writer.append(self.file_path, "".join(json.dumps(rec, ensure_ascii=False) + "\n" for rec in recs))
+
+    def _snapshot(self) -> List[str]:
+        return [json.dumps({"op": "put", **it}, ensure_ascii=False) + "\n" for it in self.items.values()]
+
+    async def aclose(self):
+        await self.writer.flush()
+
+    # --- Edits (O(1) disk work each) ---
+    def add(self, name, cmd, folder="", tags=()) -> str:
+        item = self._item({"id": self._new_id(), "name": name, "cmd": cmd, "folder": folder, "tags": tags})
+        self.items[item["id"]] = item
+        self._log({"op": "put", **item})
+        return item["id"]
+
+    def edit(self, cid, name=None, cmd=None, folder=None, tags=None) -> bool:
+        old = self.items.get(cid)
+        if old is None: return False
+        changes = {k: v for k, v in (("name", name), ("cmd", cmd), ("folder", folder), ("tags", tags)) if v is not None}
+        item = self.items[cid] = self._item({**old, **changes})
+        self._log({"op": "put", **item})
+        return True
+
+    def delete(self, cid) -> bool:
+        if self.items.pop(cid, None) is None: return False
+        self._log({"op": "del", "id": cid})
+        return True
+
+    # --- Browsing ---
+    def folders(self) -> List[str]: return sorted({it["folder"] for it in self.items.values() if it["folder"]})
+    def tags(self) -> List[str]: return sorted({t for it in self.items.values() for t in it["tags"]})
+
+    def find(self, folder=None, tag=None) -> List[dict]:
+        """Items in `folder` (and its subfolders, "a/b" style) carrying `tag`."""
+        return [it for it in self.items.values()
+                if (folder is None or it["folder"] == folder or it["folder"].startswith(folder + "/"))
+                and (tag is None or tag in it["tags"])]
+
+    # --- Sharing ---
+    def export_library(self, ids=None) -> dict:
+        items = self.items.values() if ids is None else [self.items[i] for i in ids if i in self.items]
+        return {"format": "gm-library", "version": 1, "commands": [dict(it) for it in items]}
+
+    def import_library(self, data, folder=None) -> int:
+        """Merge a library (export_library output or the old bare custom_gm.json list). Entries
+        whose id already exists are updated in place; `folder` files every entry under it."""
+        entries = data.get("commands", []) if isinstance(data, dict) else data
+        recs = []
+        for e in entries:
+            if not isinstance(e, dict) or "cmd" not in e: continue
+            rec = {**e, "id": str(e.get("id") or self._new_id())}
+            if folder: rec["folder"] = f"{folder}/{rec['folder']}" if rec.get("folder") else folder
+            item = self.items[rec["id"]] = self._item(rec)
+            recs.append({"op": "put", **item})
+        if recs: self._log(*recs)
+        return len(recs)
+
+
+DEFAULT_PORT = 12581    # listener the game client connects to (adb reverse tcp:12581 tcp:12581)
+SEND_QUEUE_SIZE = 256   # max packets buffered per client before sends are rejected
+SEND_TIMEOUT = 3.0      # seconds a single client may take to accept one packet
+EXEC_TIMEOUT = 10.0     # seconds to wait for a RESULT before a command is considered lost
+LATENCY_WINDOW = 512    # round-trip samples kept per device / script
+LATENCY_SCRIPTS = 256   # distinct scripts tracked before new ones are ignored
+LOG_CAPACITY = 50000    # log records kept in memory; oldest are overwritten
+FRAME_LIMIT = 16 << 20  # largest accepted inbound frame (bytes); bigger ones are skipped, not fatal
+SEARCH_LIMIT = 300      # ranked GM search results returned per query
+EVENT_WINDOW = 0.05     # seconds events are collected before subscribers see them as one batch
+BATCH_WINDOW = 32       # commands run_batch keeps in flight per device
+CUSTOM_COMPACT_MIN = 256  # custom GM journal records before compaction is considered
+RECORD_BLOCK = 64 << 10   # uncompressed bytes per session-file block (the unit of random access)
+RECORD_FLUSH = 1.0        # seconds before a partly filled session block is written anyway
+HEARTBEAT_INTERVAL = 5.0  # seconds of silence before a heartbeat-capable device is PINGed
+HEARTBEAT_TIMEOUT = 20.0  # seconds of silence before a device is taken for half-open and dropped
+RESUME_TTL = 600.0        # seconds a disconnected device's GM tree and UI states wait for its resume
+COMPRESSION = ("zlib",)   # stream codecs the console accepts in HELLO, in order of preference
+COMPRESS_LEVEL = 1        # zlib level for the outbound stream: most of the ratio at a fraction of the CPU
+LOG_LEVELS = {"debug": 0, "verbose": 0, "info": 1, "log": 1, "warn": 2, "warning": 2, "error": 3, "exception": 3, "assert": 3, "fatal": 4}
+LOG_ROTATE_BYTES = 64 << 20  # exported log file size (on disk) that starts a new file
+LOG_EXPORT_KEEP = 20         # exported log files kept; older ones are deleted
+LOG_EXPORT_FLUSH = 1.0       # seconds between sync flushes of a compressed export
+LOG_NOTICE_EVERY = 5.0       # seconds between "lines dropped" notices per throttled device
+GM_CACHE_SIZE = 32        # distinct GM trees kept for reuse across devices and reconnects (LRU)
+_TREE_KEY = re.compile(r"[A-Za-z0-9_.\-]{1,128}")  # client tree hashes double as cache file names
+
+class ConnStats:
+    """Per-connection counters behind the Perf panel and /metrics."""
+    __slots__ = ("connected", "last_seen", "bytes_in", "bytes_out", "wire_in", "wire_out", "pkts_in", "pkts_out", "queue_peak", "drain", "reconnects")
+    def __init__(self):
+        self.connected = self.last_seen = time.time()
+        self.bytes_in = self.bytes_out = self.pkts_in = self.pkts_out = 0
+        self.wire_in = self.wire_out = 0  # socket bytes; below bytes_in / bytes_out once compressed
+        self.queue_peak = self.reconnects = 0
+        self.drain = LatencyStats()  # ms the writer waited in drain() per flush
+
+@dataclass
+class Client:
+    id: str                 # connection id (peer address), unique per socket
+    port: int
+    writer: asyncio.StreamWriter
+    uid: str = ""           # stable device identity from HELLO; the connection id until then
+    device: str = "Unknown"
+    platform: str = "Unknown"
+    gm_tree: List[Any] = field(default_factory=list) 
+    ui_states: Dict[str, Any] = field(default_factory=dict)
+    outbox: asyncio.Queue = field(default_factory=lambda: asyncio.Queue(SEND_QUEUE_SIZE))
+    sender: Optional[asyncio.Task] = None
+    framing: str = "line"   # "line" (newline-delimited JSON) or "len" (4-byte big-endian length prefix)
+    bad_frames: int = 0
+    gm_version: int = 0
+    gm_index: Dict[Any, Tuple[dict, Optional[dict]]] = field(default_factory=dict)  # node id -> (node, parent)
+    gm_resync: bool = False  # full GM_LIST requested; patches are ignored until it arrives
+    gm_search: Optional["GMSearchIndex"] = None  # built lazily, dropped whenever the tree changes
+    gm_shared: Optional["CachedTree"] = None  # gm_tree / gm_index belong to this cache entry: copy before patching
+    stats: ConnStats = field(default_factory=ConnStats)
+    heartbeat: bool = False  # device answers PING with PONG (offered in HELLO)
+    results: bool = False    # device answers EXEC / EXEC_GM with RESULT (HELLO "result": true); else a write is all we get
+    pinged: float = 0.0      # time.time() of the last PING sent
+    resume: str = ""         # resume token handed out in HELLO_ACK; "" when the device didn't ask
+    compress: str = ""       # "zlib" once negotiated: after HELLO_ACK both directions are one zlib stream
+    zout: Any = None         # outbound compressor, created by the writer task at the switch point
+
+class Log:
+    __slots__ = ("seq", "ts", "level", "device", "msg", "fields")
+    def __init__(self, seq, ts, level, device, msg, fields=None):
+        self.seq = seq; self.ts = ts; self.level = level; self.device = device; self.msg = msg
+        self.fields = fields  # structured extras from the LOG packet (see LogPipeline), or None
+    @property
+    def time(self): return datetime.fromtimestamp(self.ts)
+    def __repr__(self): return f"Log({self.seq}, {self.level}, {self.device}, {self.msg[:40]!r})"
+    def as_dict(self):
+        d = {"seq": self.seq, "ts": self.ts, "level": self.level, "device": self.device, "msg": self.msg}
+        if self.fields: d["fields"] = self.fields
+        return d
+
+def log_filter(level=None, device=None, text=None) -> Callable[[Log], bool]:
+    """Record predicate with LogStore.query semantics, for live streams."""
+    levels = {level} if isinstance(level, str) else set(level) if level else None
+    needle = text.lower() if text else None
+    return lambda r: (not levels or r.level in levels) and (device is None or r.device == device) and (not needle or needle in r.msg.lower())
+
+class LogStore:
+    """Fixed-capacity ring of Log records. Records are addressed by a global seq;
+    per-device and per-level deques hold the seqs still in the ring, oldest first."""
+    def __init__(self, cap=LOG_CAPACITY):
+        self.cap = cap
+        self.buf: List[Optional[Log]] = [None] * cap
+        self.next_seq = 0
+        self.floor = 0  # seqs below this were cleared; seqs keep counting so readers' cursors stay valid
+        self.by_device: Dict[str, deque] = {}
+        self.by_level: Dict[str, deque] = {}
+
+    @property
+    def first_seq(self): return max(self.floor, self.next_seq - self.cap)
+    def __len__(self): return self.next_seq - self.first_seq
+    def __iter__(self): return (self.buf[i % self.cap] for i in range(self.first_seq, self.next_seq))
+
+    def append(self, ts, level, device, msg, fields=None) -> Log:
+        seq = self.next_seq; slot = seq % self.cap
+        old = self.buf[slot]
+        if old is not None:
+            for idx, k in ((self.by_device, old.device), (self.by_level, old.level)):
+                d = idx[k]; d.popleft()
+                if not d: del idx[k]
+        rec = self.buf[slot] = Log(seq, ts, sys.intern(level), sys.intern(device), msg, fields)
+        self.by_device.setdefault(rec.device, deque()).append(seq)
+        self.by_level.setdefault(rec.level, deque()).append(seq)
+        self.next_seq += 1
+        return rec
+
+    def get(self, seq) -> Optional[Log]:
+        return self.buf[seq % self.cap] if self.first_seq <= seq < self.next_seq else None
+
+    def clear(self):
+        self.buf = [None] * self.cap; self.by_device.clear(); self.by_level.clear()
+        self.floor = self.next_seq
+
+    def query(self, level=None, device=None, text=None, since=None, until=None, before=None, limit=200) -> List[Log]:
+        """Newest-first page of matching records. `level` is a name or a set of names,
+        `since`/`until` are epoch seconds. Pass the last returned seq as `before` for the next page."""
+        levels = {level} if isinstance(level, str) else set(level) if level else None
+        def newest_first(seqs):
+            end = bisect_left(seqs, before) if before is not None else len(seqs)
+            return (seqs[i] for i in range(end-1, -1, -1))
+        # walk the smallest applicable index; the other filters are checked per record
+        src = [self.by_device.get(device, ())] if device is not None else None
+        if levels:
+            lv = [self.by_level.get(x, ()) for x in levels]
+            if src is None or sum(map(len, lv)) < len(src[0]): src = lv
+        if src is None:
+            top = min(self.next_seq, before) if before is not None else self.next_seq
+            it = range(top-1, self.first_seq-1, -1)
+        else:
+            it = heapq.merge(*map(newest_first, src), reverse=True) if len(src) > 1 else newest_first(src[0])
+        needle = text.lower() if text else None
+        out = []
+        for q in it:
+            r = self.buf[q % self.cap]
+            if since is not None and r.ts < since: break
+            if until is not None and r.ts > until: continue
+            if device is not None and r.device != device: continue
+            if levels and r.level not in levels: continue
+            if needle and needle not in r.msg.lower(): continue
+            out.append(r)
+            if len(out) >= limit: break
+        return out
+
+def log_fields(pkt) -> Optional[dict]:
+    """Structured extras of a LOG packet: every key besides type / level / msg."""
+    extra = {k: v for k, v in pkt.items() if k not in ("type", "level", "msg")}
+    return extra or None
+
+class LogExporter:
+    """Streams log records to rotating JSONL files in `directory` (gzip when `compress`) through
+    the shared FileWriter. A file is closed once it reaches `rotate_bytes` on disk and only the
+    newest `keep` files are kept. A compressed file is one gzip stream, sync-flushed by the first
+    record after each LOG_EXPORT_FLUSH seconds, so zcat reads an unfinished file up to that point.
+    The directory is only touched by prepare() (blocking: run it on the I/O pool) and the writer."""
+    def __init__(self, directory, compress=False, rotate_bytes=LOG_ROTATE_BYTES, keep=LOG_EXPORT_KEEP, writer=None):
+        self.directory, self.compress, self.rotate_bytes, self.keep = directory, compress, rotate_bytes, keep
+        self.writer: FileWriter = writer or file_writer
+        self.path: Optional[str] = None
+        self.size = 0; self.z = None; self.flushed = 0.0; self.records = 0; self.opened = 0
+        self.files: List[str] = []  # our files in the directory, oldest first
+
+    def prepare(self) -> "LogExporter":
+        """Create the directory and pick up files a previous run left there (they count toward `keep`)."""
+        os.makedirs(self.directory, exist_ok=True)
+        ext = ".jsonl.gz" if self.compress else ".jsonl"
+        found = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.startswith("gm-logs-") and f.endswith(ext)]
+        self.files = sorted(found, key=os.path.getmtime)
+        return self
+
+    def config(self):
+        return {"dir": self.directory, "compress": self.compress, "rotate_mb": self.rotate_bytes / (1 << 20), "keep": self.keep,
+                "file": self.path, "records": self.records}
+
+    def write(self, rec: dict):
+        if self.path is None: self._open()
+        data = (json.dumps(rec, ensure_ascii=False, default=str) + "\n").encode()
+        if self.z:
+            data = self.z.compress(data)
+            now = time.monotonic()
+            if now - self.flushed >= LOG_EXPORT_FLUSH: data += self.z.flush(zlib.Z_SYNC_FLUSH); self.flushed = now
+        self.records += 1
+        if not data: return
+        self.writer.append(self.path, data); self.size += len(data)
+        if self.size >= self.rotate_bytes: self.close()
+
+    def close(self):
+        """Finish the current file; the next record starts a new one."""
+        if self.path and self.z: self.writer.append(self.path, self.z.flush())
+        self.path = None; self.z = None
+
+    def _open(self):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S"); ext = ".jsonl.gz" if self.compress else ".jsonl"
+        while True:  # numbered: several files can start within one second
+            self.opened += 1; path = os.path.join(self.directory, f"gm-logs-{stamp}-{self.opened:03d}{ext}")
+            if path not in self.files: break
+        self.path, self.size, self.flushed = path, 0, time.monotonic()
+        if self.compress: self.z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip container
+        self.files.append(path)
+        for old in self.files[:-self.keep]: self.writer.remove(old)  # queued behind that file's last writes
+        del self.files[:-self.keep]
+
+class LogPipeline:
+    """Stage between LOG packets and the LogStore (and so the UI, API and WebSocket):
+
+      parse   -> structured fields from the packet, plus "tag" from a leading "[Tag]"
+      filter  -> level threshold, regex include / exclude on the message
+      export  -> every record that passed the filters, to rotating files (LogExporter)
+      limit   -> per-device token bucket (rate lines/s, burst)
+      sample  -> keep 1 in `sample` records below warn
+      store   -> LogStore.append
+
+    Exporting before the rate limit and sampling keeps a complete file for bug reports while a
+    noisy game cannot drown the console. Dropped lines are counted and reported per device as
+    a console notice. Everything is off by default: records pass straight through."""
+    def __init__(self, logs: LogStore):
+        self.logs = logs
+        self.min_level = ""; self.include = None; self.exclude = None
+        self.rate = 0.0; self.burst = 0; self.sample = 1
+        self.exporter: Optional[LogExporter] = None
+        self.devices: Dict[str, list] = {}  # uid -> [tokens, last ts, rate-limited, sampled, seen, last notice]
+        self.counts = {"in": 0, "filtered": 0, "exported": 0, "rate_limited": 0, "sampled": 0, "stored": 0}
+
+    def configure(self, **kw):
+        """Change settings by name (see config()); raises ValueError for bad values, changing nothing.
+        Blocks on the export directory: on a running loop use aconfigure()."""
+        new = self._settings(kw)
+        try:
+            if new.get("exporter"): new["exporter"].prepare()
+        except OSError as e: raise ValueError(f"export: {e!r}")
+        return self._apply(new)
+
+    async def aconfigure(self, **kw):
+        """configure() with the export directory set up on the I/O pool."""
+        new = self._settings(kw)
+        try:
+            if new.get("exporter"): await run_io(new["exporter"].prepare)
+        except OSError as e: raise ValueError(f"export: {e!r}")
+        return self._apply(new)
+
+    def _settings(self, kw) -> dict:
+        unknown = set(kw) - {"min_level", "include", "exclude", "rate", "burst", "sample", "export"}
+        if unknown: raise ValueError(f"unknown log pipeline setting(s): {', '.join(sorted(unknown))}")
+        new = {}
+        if "min_level" in kw:
+            lv = (kw["min_level"] or "").lower()
+            if lv and lv not in LOG_LEVELS: raise ValueError(f"unknown level {lv!r}")
+            new["min_level"] = lv
+        for k in ("include", "exclude"):
+            if k in kw:
+                try: new[k] = re.compile(kw[k]) if kw[k] else None
+                except re.error as e: raise ValueError(f"{k}: {e}")
+        try:
+            if "rate" in kw: new["rate"] = max(0.0, float(kw["rate"] or 0))
+            if "burst" in kw: new["burst"] = max(0, int(kw["burst"] or 0))
+            if "sample" in kw: new["sample"] = max(1, int(kw["sample"] or 1))
+        except (TypeError, ValueError) as e: raise ValueError(str(e))
+        if "export" in kw:
+            ex = kw["export"]
+            if ex and not isinstance(ex, dict): ex = {"dir": ex}
+            try: new["exporter"] = LogExporter(ex["dir"], bool(ex.get("compress")), int(float(ex.get("rotate_mb", LOG_ROTATE_BYTES >> 20)) * (1 << 20)),
+                                               int(ex.get("keep", LOG_EXPORT_KEEP))) if ex else None
+            except (KeyError, TypeError, ValueError) as e: raise ValueError(f"export: {e!r}")
+        return new
+
+    def _apply(self, new):
+        if "exporter" in new and self.exporter: self.exporter.close()
+        for k, v in new.items(): setattr(self, k, v)
+        if "rate" in new or "burst" in new: self.devices.clear()
+        return self.config()
+
+    def config(self):
+        return {"min_level": self.min_level, "include": self.include.pattern if self.include else "", "exclude": self.exclude.pattern if self.exclude else "",
+                "rate": self.rate, "burst": self.burst, "sample": self.sample, "export": self.exporter.config() if self.exporter else None,
+                "counts": dict(self.counts)}
+
+    def close(self):
+        if self.exporter: self.exporter.close()
+
+    def push(self, ts, level, device, msg, uid=None, fields=None) -> List[Log]:
+        """Run one LOG record through the stages; returns what was stored (a notice may precede it)."""
+        cnt = self.counts; cnt["in"] += 1
+        lv = LOG_LEVELS.get(level.lower(), 1)
+        if self.min_level and lv < LOG_LEVELS[self.min_level]: cnt["filtered"] += 1; return []
+        if (self.include and not self.include.search(msg)) or (self.exclude and self.exclude.search(msg)):
+            cnt["filtered"] += 1; return []
+        if msg.startswith("[") and not (fields and "tag" in fields):
+            end = msg.find("]", 1, 48)
+            if end > 1: fields = dict(fields or (), tag=msg[1:end])
+        if self.exporter:
+            rec = {"ts": ts, "level": level, "device": device, "uid": uid, "msg": msg}
+            if fields: rec["fields"] = fields
+            self.exporter.write(rec); cnt["exported"] += 1
+        if not self.rate and self.sample == 1:
+            cnt["stored"] += 1
+            return [self.logs.append(ts, level, device, msg, fields)]
+        d = self.devices.get(uid or device)
+        if d is None: d = self.devices[uid or device] = [float(self.burst or self.rate), ts, 0, 0, 0, ts]
+        out = []
+        keep = True
+        if self.rate:
+            d[0] = min(float(self.burst or self.rate), d[0] + (ts - d[1]) * self.rate); d[1] = ts
+            if d[0] >= 1: d[0] -= 1
+            else: keep = False; d[2] += 1; cnt["rate_limited"] += 1
+        if keep and self.sample > 1 and lv < LOG_LEVELS["warn"]:
+            d[4] += 1
+            if d[4] % self.sample: keep = False; d[3] += 1; cnt["sampled"] += 1
+        if (d[2] or d[3]) and ts - d[5] >= LOG_NOTICE_EVERY:  # at most one notice per device per period
+            parts = [f"{n} rate-limited" for n in (d[2],) if n] + [f"{n} sampled out" for n in (d[3],) if n]
+            out.append(self.logs.append(ts, "warn", "console", f"[logs] {device}: {', '.join(parts)} since {datetime.fromtimestamp(d[5]):%H:%M:%S}"))
+            d[2] = d[3] = 0; d[5] = ts
+        elif not (d[2] or d[3]): d[5] = ts
+        if keep:
+            cnt["stored"] += 1
+            out.append(self.logs.append(ts, level, device, msg, fields))
+        return out
+
+class GMSearchIndex:
+    """Flattened, lower-cased view of a GM tree with a trigram index for substring lookups."""
+    __slots__ = ("nodes", "names", "paths", "grams")
+    def __init__(self, tree):
+        self.nodes: List[dict] = []; self.names: List[str] = []; self.paths: List[tuple] = []
+        self.grams: Dict[str, List[int]] = {}
+        self._walk(tree, ())
+
+    def _walk(self, nodes, path):
+        for n in nodes:
+            i = len(self.nodes); name = str(n.get("name", "")).lower()
+            self.nodes.append(n); self.names.append(name); self.paths.append(path)
+            for g in {name[k:k+3] for k in range(len(name)-2)}: self.grams.setdefault(g, []).append(i)
+            if "children" in n: self._walk(n["children"], path + (n,))
+
+    @staticmethod
+    def _score(name, q, pos):
+        if name == q: return 0
+        if pos == 0: return 1
+        if not name[pos-1].isalnum(): return 2
+        return 3 + pos / 1000
+
+    def search(self, q, limit=SEARCH_LIMIT) -> List[Tuple[dict, tuple]]:
+        """Ranked (node, parents) matches, parents being the nodes from the root down: exact > prefix > word start > substring > fuzzy subsequence."""
+        q = q.strip().lower()
+        if not q: return []
+        if len(q) >= 3:
+            postings = sorted((self.grams.get(q[k:k+3], ()) for k in range(len(q)-2)), key=len)
+            cand = set(postings[0])
+            for p in postings[1:]:
+                if not cand: break
+                cand.intersection_update(p)
+            hits = [i for i in cand if q in self.names[i]]
+        else:
+            hits = [i for i, name in enumerate(self.names) if q in name]
+        scored = [(self._score(self.names[i], q, self.names[i].find(q)), i) for i in hits]
+        if len(scored) < limit and len(q) >= 2:
+            seen = set(hits); rx = re.compile(".*?".join(map(re.escape, q)))
+            for i, name in enumerate(self.names):
+                if i in seen: continue
+                m = rx.search(name)
+                if m: scored.append((10 + m.end() - m.start() - len(q), i))
+        scored.sort()
+        return [(self.nodes[i], self.paths[i]) for _, i in scored[:limit]]
+
+def tree_digest(tree) -> bytes:
+    """Digest of a parsed GM tree in one C-level dump. marshal is ~8x faster than json here; equal
+    trees parsed from JSON dump to equal bytes, other equal trees may differ (a cache miss, never a clash)."""
+    try: return hashlib.blake2b(marshal.dumps(tree), digest_size=16).digest()
+    except ValueError: return hashlib.blake2b(json.dumps(tree, default=str).encode(), digest_size=16).digest()
+
+def index_tree(index, nodes, parent):
+    """Fill `index` with node id -> (node, parent) for `nodes` and everything below them."""
+    for n in nodes:
+        if n.get("id") is not None: index[n["id"]] = (n, parent)
+        if "children" in n: index_tree(index, n["children"], n)
+
+@dataclass
+class GMVariant:
+    """One distinct GM tree (by structural hash) and the devices currently running it."""
+    roots: List[bytes]          # top-level shape hashes
+    nodes: List[dict]           # interned top-level nodes
+    keys: frozenset             # MergedGMTree keys of every node in the tree
+    devices: set = field(default_factory=set)
+    digests: set = field(default_factory=set)  # raw tree digests known to produce this variant
+
+class MergedGMTree:
+    """Union of many devices' GM trees, merged by node id, with per-node availability.
+    Subtrees are interned by structural hash (fields + child hashes), so identical subtrees
+    are stored once. A device whose tree is already known only joins that variant's device
+    set, and the union changes only when a variant appears or goes away. refresh() re-hashes
+    just the devices whose tree changed since the last call."""
+    def __init__(self):
+        self.shapes: Dict[bytes, list] = {}         # hash -> [interned node, refs, child hashes]
+        self.variants: Dict[bytes, GMVariant] = {}  # hash of the whole tree -> variant
+        self.digests: Dict[bytes, bytes] = {}       # digest of a tree's JSON -> variant hash, skips interning known trees
+        self.devices: Dict[str, Tuple[tuple, bytes]] = {}  # cid -> (tree stamp, variant hash)
+        self.tree: List[dict] = []                  # merged nodes: node fields, "children" for containers
+        self.index: Dict[Any, list] = {}            # key -> [merged node, sibling list it sits in, variants holding it]
+        self.key_of: Dict[int, Any] = {}            # id(merged node) -> key
+        self.version = 0                            # bumped whenever the union or a device set changes
+
+    @staticmethod
+    def _key(n, parent_key):
+        nid = n.get("id")
+        return nid if nid is not None else (parent_key, n.get("name"))  # id-less nodes merge by name under their parent
+
+    def refresh(self, clients) -> bool:
+        """Bring the union up to date with `clients`; returns whether anything changed."""
+        seen, changed = set(), False
+        for c in clients:
+            seen.add(c.id)
+            stamp = (id(c.gm_tree), c.gm_version, len(c.gm_index))  # GM_PATCH bumps gm_version in place
+            old = self.devices.get(c.id)
+            if old and old[0] == stamp: continue
+            if old: self._leave(c.id, old[1])
+            if c.gm_tree: self.devices[c.id] = (stamp, self._join(c.id, c.gm_tree))
+            else: self.devices.pop(c.id, None)
+            changed = True
+        for cid in [cid for cid in self.devices if cid not in seen]:
+            self._leave(cid, self.devices.pop(cid)[1]); changed = True
+        if changed: self.version += 1
+        return changed
+
+    # --- Availability ---
+    def weights(self, cids=None) -> List[Tuple[frozenset, int]]:
+        """(keys, devices) per variant, restricted to `cids`; feed to available()."""
+        return [(v.keys, len(v.devices if cids is None else v.devices & cids)) for v in self.variants.values()]
+
+    def available(self, node, weights) -> int:
+        key = self.key_of.get(id(node))
+        return sum(n for keys, n in weights if key in keys)
+
+    def missing(self, node, cids=None) -> List[str]:
+        """Connection ids (within `cids`) whose tree lacks `node`."""
+        key = self.key_of.get(id(node))
+        return [cid for v in self.variants.values() if key not in v.keys for cid in (v.devices if cids is None else v.devices & cids)]
+
+    def stats(self):
+        return {"devices": len(self.devices), "variants": len(self.variants), "shapes": len(self.shapes), "nodes": len(self.index)}
+
+    def export(self, cids=None):
+        """The merged tree as plain dicts with "available" / "devices" counts (for the API)."""
+        w = self.weights(cids); total = sum(n for _, n in w)
+        def walk(nodes):
+            out = []
+            for n in nodes:
+                k = self.available(n, w)
+                if not k: continue
+                d = {f: v for f, v in n.items() if f != "children"}
+                d["available"], d["devices"] = k, total
+                if "children" in n: d["children"] = walk(n["children"])
+                out.append(d)
+            return out
+        return walk(self.tree)
+
+    # --- Interning ---
+    def _intern(self, nodes) -> Tuple[List[bytes], List[dict]]:
+        hashes, out = [], []
+        for n in nodes:
+            kids = n.get("children")
+            kh, kn = self._intern(kids) if isinstance(kids, list) else (None, None)
+            h = hashlib.blake2b(json.dumps({k: v for k, v in n.items() if k != "children"}, sort_keys=True, ensure_ascii=False, default=str).encode()
+                                + (b"\x00" + b"".join(kh) if kh is not None else b""), digest_size=16).digest()
+            shape = self.shapes.get(h)
+            if shape is None:
+                node = {k: v for k, v in n.items() if k != "children"}
+                if kn is not None:
+                    node["children"] = kn
+                    for x in kh: self.shapes[x][1] += 1
+                shape = self.shapes[h] = [node, 0, kh or ()]
+            hashes.append(h); out.append(shape[0])
+        return hashes, out
+
+    def _unref(self, h):
+        shape = self.shapes[h]; shape[1] -= 1
+        if shape[1]: return
+        del self.shapes[h]
+        for x in shape[2]: self._unref(x)
+
+    def _join(self, cid, tree) -> bytes:
+        raw = tree_digest(tree)  # recognises a known build without walking it
+        vh = self.digests.get(raw)
+        if vh is None:
+            hashes, nodes = self._intern(tree)
+            vh = self.digests[raw] = hashlib.blake2b(b"".join(hashes), digest_size=16).digest()
+            v = self.variants.get(vh)
+            if v is None:
+                for h in hashes: self.shapes[h][1] += 1
+                keys = set(); self._collect(nodes, None, keys)
+                v = self.variants[vh] = GMVariant(hashes, nodes, frozenset(keys))
+                self._merge(nodes, None, self.tree)
+            v.digests.add(raw)
+        v = self.variants[vh]
+        v.devices.add(cid)
+        return vh
+
+    def _leave(self, cid, vh):
+        v = self.variants[vh]; v.devices.discard(cid)
+        if v.devices: return
+        del self.variants[vh]
+        for raw in v.digests: del self.digests[raw]
+        self._unmerge(v.nodes, None)
+        for h in v.roots: self._unref(h)
+
+    def _collect(self, nodes, parent_key, keys):
+        for n in nodes:
+            k = self._key(n, parent_key); keys.add(k)
+            if "children" in n: self._collect(n["children"], k, keys)
+
+    # --- Union by key ---
+    def _merge(self, nodes, parent_key, siblings):
+        for i, n in enumerate(nodes):
+            k = self._key(n, parent_key)
+            e = self.index.get(k)
+            if e is None:
+                m = {f: v for f, v in n.items() if f != "children"}
+                siblings.insert(min(i, len(siblings)), m)  # keep the first variant's order, slot newcomers near theirs
+                e = self.index[k] = [m, siblings, 0]; self.key_of[id(m)] = k
+            e[2] += 1
+            if "children" in n: self._merge(n["children"], k, e[0].setdefault("children", []))
+
+    def _unmerge(self, nodes, parent_key):
+        for n in nodes:
+            k = self._key(n, parent_key)
+            if "children" in n: self._unmerge(n["children"], k)
+            e = self.index[k]; e[2] -= 1
+            if e[2]: continue
+            del self.index[k]; del self.key_of[id(e[0])]
+            siblings = e[1]
+            del siblings[next(i for i, x in enumerate(siblings) if x is e[0])]
+
+@dataclass
+class CachedTree:
+    """One interned GM tree, shared read-only by every client running it (Client.gm_shared).
+    A client takes a private copy before its first GM_PATCH."""
+    key: str
+    digest: bytes
+    tree: List[Any]
+    version: int
+    index: Dict[Any, Tuple[dict, Optional[dict]]]
+    search: Optional[GMSearchIndex] = None  # built on first search, then shared too
+
+class GMTreeCache:
+    """Content-addressed GM trees, least recently used dropped first. Keys are the hash a client
+    sends with GM_LIST ("hash") and announces in HELLO ("gm_hash"), e.g. a build id; trees from
+    clients without one are keyed by their digest, which dedupes them in memory only. With `path`,
+    client-keyed trees are also written there (zlib JSON, one file per key) and survive restarts.
+    Eviction only forgets a tree: clients holding it keep it."""
+    def __init__(self, size=GM_CACHE_SIZE, path=None):
+        self.size, self.path = size, path
+        self.entries: "OrderedDict[str, CachedTree]" = OrderedDict()
+        self.hits = self.misses = 0
+        self.disk: Set[str] = set()  # keys with a file under `path`, listed once here; files are read off the loop by load()
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.disk = {f[:-7] for f in os.listdir(path) if f.endswith(".gmtree") and self.valid(f[:-7])}
+
+    @staticmethod
+    def valid(key) -> bool:
+        return isinstance(key, str) and bool(_TREE_KEY.fullmatch(key))
+
+    def get(self, key) -> Optional[CachedTree]:
+        """Memory lookup. None on a miss, and also when the tree is only on disk (see stored / load)."""
+        e = self.entries.get(key)
+        if e is None:
+            if key not in self.disk: self.misses += 1
+            return None
+        self.hits += 1; self._keep(e)
+        return e
+
+    def stored(self, key) -> bool:
+        return key not in self.entries and key in self.disk
+
+    async def load(self, key) -> Optional[CachedTree]:
+        """get() for a stored key: the file is read and parsed on the I/O pool."""
+        e = self.entries.get(key) or await run_io(self._load, key)
+        if e is None: self.misses += 1; self.disk.discard(key); return None
+        self.hits += 1; self._keep(e)
+        return e
+
+    def put(self, key, tree, version) -> CachedTree:
+        """Intern `tree`: an equal tree already cached under `key` is returned instead."""
+        digest = tree_digest(tree)
+        key = key if self.valid(key) else "~" + digest.hex()
+        e = self.entries.get(key)
+        if e is not None and e.digest == digest and e.version == version:
+            self.hits += 1; self._keep(e)
+            return e
+        self.misses += 1
+        e = CachedTree(key, digest, tree, version, {}); index_tree(e.index, tree, None)
+        self._keep(e)
+        if self.path and not key.startswith("~"):
+            self.disk.add(key)
+            file_writer.replace(self._file(key), zlib.compress(json.dumps({"version": version, "data": tree}, ensure_ascii=False).encode(), 6))
+        return e
+
+    def stats(self):
+        return {"trees": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def _keep(self, e: CachedTree):
+        self.entries[e.key] = e; self.entries.move_to_end(e.key)
+        while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+    def _file(self, key): return os.path.join(self.path, key + ".gmtree")
+
+    def _load(self, key) -> Optional[CachedTree]:
+        try:
+            with open(self._file(key), 'rb') as f: d = json.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error): return None
+        tree = d.get("data", [])
+        e = CachedTree(key, tree_digest(tree), tree, d.get("version", 0), {}); index_tree(e.index, tree, None)
+        return e
+
+class LatencyStats:
+    """Rolling window of round-trip times in ms, read out as percentiles."""
+    __slots__ = ("samples", "count")
+    def __init__(self, window=LATENCY_WINDOW):
+        self.samples = deque(maxlen=window); self.count = 0
+    def add(self, ms):
+        self.samples.append(ms); self.count += 1
+    def snapshot(self):
+        s = sorted(self.samples)
+        pick = lambda q: s[min(len(s)-1, int(q*len(s)))] if s else 0.0
+        return {"count": self.count, "p50": pick(.50), "p95": pick(.95), "p99": pick(.99), "max": s[-1] if s else 0.0}
+
+@dataclass
+class Pending:
+    fut: asyncio.Future
+    sent: float
+    script: str
+    timer: Optional[asyncio.TimerHandle] = None
+
+@dataclass
+class Control:
+    """Send state of one stateful GM control (Toggle / Input) on one device, see ServerMgr.set_gm."""
+    want: Any = None
+    waiters: List[asyncio.Future] = field(default_factory=list)  # callers the next send answers
+    task: Optional[asyncio.Task] = None
+
+@dataclass
+class Parked:
+    """State a disconnected device can take back with its resume token."""
+    uid: str
+    expires: float
+    gm_tree: List[Any]
+    gm_version: int
+    gm_index: Dict[Any, Tuple[dict, Optional[dict]]]
+    ui_states: Dict[str, Any]
+    gm_shared: Optional[CachedTree] = None
+
+@dataclass
+class Event:
+    kind: str       # listener | client_added | client_removed | client_meta | gm_tree_changed | log
+    cid: Optional[str] = None
+    data: Any = None
+
+class EventBus:
+    """Typed pub/sub for ServerMgr state changes. Events are queued and handed to each
+    subscriber as one batch per EVENT_WINDOW, so a burst of reconnects costs one redraw."""
+    def __init__(self, window=EVENT_WINDOW):
+        self.window = window
+        self.subs: List[Tuple[frozenset, Callable]] = []
+        self.queue: List[Event] = []
+        self._timer = None
+
+    def subscribe(self, kinds, fn) -> Callable[[], None]:
+        """Call fn(events) with batches of the given kinds. Returns an unsubscribe function."""
+        sub = (frozenset([kinds] if isinstance(kinds, str) else kinds), fn)
+        self.subs.append(sub)
+        def unsubscribe():
+            if sub in self.subs: self.subs.remove(sub)
+        return unsubscribe
+
+    def emit(self, kind, cid=None, data=None):
+        if not any(kind in kinds for kinds, _ in self.subs): return
+        self.queue.append(Event(kind, cid, data))
+        if self._timer: return
+        try: self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        except RuntimeError: self.flush()  # no loop (scripts/tests): deliver immediately
+
+    def flush(self):
+        batch, self.queue, self._timer = self.queue, [], None
+        for kinds, fn in list(self.subs):
+            mine = [e for e in batch if e.kind in kinds]
+            if not mine: continue
+            try: fn(mine)
+            except Exception as e:
+                try: asyncio.get_running_loop().call_exception_handler({"message": "event subscriber failed", "exception": e})
+                except RuntimeError: pass
+
+def _keepalive(sock, idle):
+    """Let the OS probe quiet sockets, so half-open peers without heartbeat support still go away."""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt, val in (("TCP_KEEPIDLE", idle), ("TCP_KEEPINTVL", 5), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, opt): sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), max(1, int(val)))
+    except OSError: pass
+
+def _consume(fut):
+    # fire-and-forget sends never await their future; keep asyncio from warning about it
+    if not fut.cancelled(): fut.exception()
+
+class ServerMgr:
+    def __init__(self):
+        self.listeners = {} 
+        self.clients = {}   
+        self.by_port: Dict[int, Dict[str, Client]] = {}   # port -> {cid: client}
+        self.by_device: Dict[str, Client] = {}            # uid -> client
+        self.logs = LogStore()
+        self.log_pipeline = LogPipeline(self.logs)   # LOG packets: filter / rate limit / sample / export, then self.logs
+        self.cmd_id = 1000
+        self._ids = itertools.count(self.cmd_id)
+        self.pending: Dict[Tuple[str, int], Pending] = {}
+        self.latency: Dict[str, LatencyStats] = {}          # by device uid
+        self.script_latency: Dict[str, LatencyStats] = {}   # by Lua snippet / GM id
+        self.events = EventBus()
+        self._tasks = set()
+        self.send_timeout = SEND_TIMEOUT
+        self.exec_timeout = EXEC_TIMEOUT
+        self.frame_limit = FRAME_LIMIT
+        self.frame_errors: Dict[str, int] = {}
+        self.loop_monitor = LoopMonitor(on_stall=self._loop_stall)
+        self.recorder: Optional["SessionRecorder"] = None
+        self.sessions: Dict[str, int] = {}  # uid -> connections seen, for reconnect counts
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.heartbeat_timeout = HEARTBEAT_TIMEOUT
+        self.resume_ttl = RESUME_TTL
+        self.parked: Dict[str, Parked] = {}  # resume token -> state of a device that went away
+        self._hb_task: Optional[asyncio.Task] = None
+        self.compression = COMPRESSION
+        self.compress_level = COMPRESS_LEVEL
+        self.controls: Dict[Tuple[str, Any], Control] = {}  # (cid, gm id) -> control with a command in flight
+        self.shards = None  # gm_shard.ShardPool: sockets are read and parsed in worker processes
+        self._merged = MergedGMTree()
+        self.gm_cache = GMTreeCache()  # set GMTreeCache(path=...) to keep client-keyed trees across restarts
+
+    def start_recording(self, path) -> str:
+        """Record all traffic to `path` (see SessionRecorder). Devices already connected get a
+        synthetic open + HELLO + GM_LIST so the session replays on its own."""
+        self.stop_recording()
+        rec = self.recorder = SessionRecorder(path)
+        for c in self.clients.values():
+            rec.add("open", c)
+            rec.add("in", c, self._encode({"type": "HELLO", "device": c.device, "device_id": c.uid, "platform": c.platform, "result": c.results}), "HELLO")
+            if c.gm_tree: rec.add("in", c, self._encode({"type": "GM_LIST", "version": c.gm_version, "data": c.gm_tree}), "GM_LIST")
+        return path
+
+    def stop_recording(self) -> Optional[str]:
+        rec, self.recorder = self.recorder, None
+        if not rec: return None
+        rec.close()
+        return rec.path
+    
+    def _loop_stall(self, ms, where):
+        rec = self.logs.append(time.time(), "warn", "console", f"[loop] blocked {ms:.0f} ms at {where}")
+        self.events.emit("log", None, rec)
+
+    async def add_listener(self, port):
+        if port in self.listeners: return False, f"Port {port} active"
+        self.loop_monitor.start()  # runs while anything is listening
+        if not self._hb_task: self._hb_task = asyncio.ensure_future(self._heartbeat())
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("0.0.0.0", port))
+            sock.close()
+        except Exception as e: return False, f"Bind Error: {e}"
+        
+        try:
+            if self.shards: srv = await self.shards.listen(port)
+            else: srv = await asyncio.start_server(lambda r,w: self._h(r,w,port), "0.0.0.0", port, reuse_address=True, limit=self.frame_limit)
+            self.listeners[port] = srv
+            self.events.emit("listener", data=port)
+            return True, "Success"
+        except Exception as e: return False, str(e)
+
+    async def remove_listener(self, port):
+        if port in self.listeners:
+            s = self.listeners.pop(port)
+            s.close()
+            try: await s.wait_closed()
+            except: pass
+        
+        for c in list(self.by_port.pop(port, {}).values()):
+            self._detach(c); self._drop(c)
+            try: await c.writer.wait_closed()
+            except: pass
+        
+        if not self.listeners:
+            self.loop_monitor.stop()
+            if self._hb_task: self._hb_task.cancel(); self._hb_task = None
+            if self.shards: self.shards.stop()
+        self.events.emit("listener", data=port)
+
+    async def _h(self, raw, w, port):
+        addr = w.get_extra_info("peername")
+        cid = f"{addr[0]}:{addr[1]}"
+        c = Client(id=cid, port=port, writer=w, uid=cid)
+        sock = w.get_extra_info("socket")
+        if sock is not None: _keepalive(sock, self.heartbeat_timeout)
+        self._open(c)
+        try: await self._read_loop(c, raw)
+        except OSError: pass
+        finally: self._close(c)
+
+    async def _read_loop(self, c: Client, raw):
+        """Frame, count and parse what the device sends until EOF; each packet goes to _dispatch.
+        Shared with shard workers, which only override _dispatch."""
+        r = raw
+        while True:
+            frame = await self._read_frame(r, c)
+            if frame is None: return
+            st = c.stats; st.last_seen = time.time(); st.pkts_in += 1
+            n = len(frame) + (4 if c.framing == "len" else 0)  # a line frame keeps its newline
+            st.bytes_in += n
+            if r is raw: st.wire_in += n
+            if not frame.strip(): continue
+            try: pkt = json.loads(frame)
+            except ValueError as e: self._bad_frame(c, "malformed", str(e)); continue
+            if not isinstance(pkt, dict): self._bad_frame(c, "malformed", "not an object"); continue
+            wait = self._dispatch(c, pkt, frame)
+            if wait is not None: await wait  # HELLO_ACK still pending: the next frame may depend on it
+            if c.compress and r is raw: r = self._inflate(raw, c)  # the device compresses everything after HELLO
+
+    def _dispatch(self, c: Client, pkt, frame) -> Optional[asyncio.Future]:
+        return self._handle(c, pkt, frame)
+
+    # --- Connection lifecycle, shared by _h and shard proxies (gm_shard) ---
+    def _open(self, c: Client):
+        self._attach(c)
+        c.sender = asyncio.create_task(self._pump(c))
+        self.events.emit("client_added", c.id)
+        if self.recorder: self.recorder.add("open", c)
+
+    def _handle(self, c: Client, pkt, frame=None) -> Optional[asyncio.Future]:
+        """Process one packet. Returns a future when the HELLO_ACK will follow later (see _process)."""
+        try: wait = self._process(c.id, pkt)
+        except Exception as e: self._bad_frame(c, "rejected", f"{pkt.get('type')}: {e!r}"); wait = None
+        if self.recorder: self.recorder.add("in", c, frame or self._encode(pkt), pkt.get("type"))  # after HELLO so uid is known
+        return wait
+
+    def _close(self, c: Client):
+        if self.recorder: self.recorder.add("close", c)
+        if c.resume and self.by_device.get(c.uid) is c: self._park(c)
+        self._detach(c)
+        self._drop(c)
+        self.events.emit("client_removed", c.id)
+
+    # --- Client registry: by connection, by port and by device identity ---
+    def _attach(self, c: Client):
+        self.clients[c.id] = c
+        self.by_port.setdefault(c.port, {})[c.id] = c
+        self.by_device[c.uid] = c
+
+    def _detach(self, c: Client):
+        if self.clients.get(c.id) is c: del self.clients[c.id]
+        group = self.by_port.get(c.port, {})
+        if group.get(c.id) is c: del group[c.id]
+        if self.by_device.get(c.uid) is c: del self.by_device[c.uid]
+
+    def _identify(self, c: Client, pkt):
+        """An explicit HELLO device_id is the uid, and a second socket claiming it is that device
+        reconnecting. Without one the connection id stays the uid: over adb reverse every phone
+        is 127.0.0.1, so two of the same model must not be taken for one device."""
+        if not pkt.get("device_id"): return
+        uid = str(pkt["device_id"])
+        if uid == c.uid: return
+        old = self.by_device.get(uid)
+        if old is not None and old is not c:  # same device reconnected: retire the stale socket
+            if old.resume: self._park(old)
+            self._detach(old); self._drop(old)
+        if self.by_device.get(c.uid) is c: del self.by_device[c.uid]
+        c.uid = uid; self.by_device[uid] = c
+        c.stats.reconnects = self.sessions.get(uid, 0)
+        self.sessions[uid] = c.stats.reconnects + 1
+
+    # --- Heartbeat and resume ---
+    async def _heartbeat(self):
+        """PING heartbeat-capable devices that went quiet and drop the ones silent past
+        heartbeat_timeout: a half-open socket never errors on its own. Other devices are
+        left to TCP keepalive."""
+        while True:
+            await asyncio.sleep(min(1.0, self.heartbeat_interval))
+            now = time.time()
+            for c in list(self.clients.values()):
+                if not c.heartbeat: continue
+                idle = now - c.stats.last_seen
+                if idle > self.heartbeat_timeout:
+                    l = self.logs.append(now, "warn", c.device, f"[heartbeat] silent for {idle:.1f}s, closing the connection")
+                    self.events.emit("log", c.id, l)
+                    self._drop(c)  # the reader sees EOF and runs the normal disconnect path
+                elif idle >= self.heartbeat_interval and now - c.pinged >= self.heartbeat_interval:
+                    c.pinged = now; self._post(c, {"type": "PING", "t": now})
+
+    def _park(self, c: Client):
+        self.parked[c.resume] = Parked(c.uid, time.time() + self.resume_ttl, c.gm_tree, c.gm_version, c.gm_index, c.ui_states, c.gm_shared)
+
+    def _resume(self, c: Client, pkt):
+        """HELLO carrying "resume" (a token, or "" to get one) opts into resume. A known token
+        for the same uid (or any token, for devices without a device_id) brings back the UI
+        states and, when HELLO's gm_version is absent or still matches, the GM tree, so the
+        device can skip its GM_LIST."""
+        if "resume" not in pkt or c.resume: return
+        now = time.time()
+        for tok in [t for t, p in self.parked.items() if p.expires < now]: del self.parked[tok]
+        tok = str(pkt.get("resume") or "")
+        p = self.parked.get(tok)
+        if p is None or (p.uid != c.uid and pkt.get("device_id")):
+            c.resume = os.urandom(8).hex(); return
+        del self.parked[tok]
+        c.resume = tok
+        c.ui_states.update(p.ui_states)
+        if p.gm_tree and pkt.get("gm_version") in (None, p.gm_version):
+            c.gm_tree, c.gm_version, c.gm_index, c.gm_shared = p.gm_tree, p.gm_version, p.gm_index, p.gm_shared
+            self.events.emit("gm_tree_changed", c.id)
+
+    def _recall_tree(self, c: Client, pkt) -> bool:
+        """HELLO "gm_hash" names the tree the device is about to push; when the cache holds it the
+        device gets it back in HELLO_ACK and can skip GM_LIST. False when the tree is only on disk:
+        _recall_stored() then reads it off the loop and sends the HELLO_ACK."""
+        if c.gm_tree or not GMTreeCache.valid(pkt.get("gm_hash")): return True  # resume already restored one
+        if self.gm_cache.stored(pkt["gm_hash"]): return False
+        e = self.gm_cache.get(pkt["gm_hash"])
+        if e is not None:
+            self._share_tree(c, e)
+            self.events.emit("gm_tree_changed", c.id)
+        return True
+
+    async def _recall_stored(self, c: Client, pkt):
+        e = await self.gm_cache.load(pkt["gm_hash"])
+        if self.clients.get(c.id) is not c: return
+        if e is not None and not c.gm_tree:
+            self._share_tree(c, e)
+            self.events.emit("gm_tree_changed", c.id)
+        self._negotiate(c, pkt)
+
+    def _share_tree(self, c: Client, e: CachedTree):
+        c.gm_tree, c.gm_version, c.gm_index, c.gm_shared = e.tree, e.version, e.index, e
+        c.gm_resync = False; c.gm_search = e.search
+
+    def _own_tree(self, c: Client):
+        """Swap a shared cached tree for a private copy so a GM_PATCH can edit it in place."""
+        c.gm_tree = json.loads(json.dumps(c.gm_tree)); c.gm_shared = None
+        c.gm_index = {}; self._index_nodes(c, c.gm_tree, None); c.gm_search = None
+
+    def resolve(self, target) -> List[Client]:
+        """Clients addressed by `target`: None = all, int = every device on that port,
+        str = one device uid, or a list/tuple/set mixing those (a group)."""
+        if target is None: return list(self.clients.values())
+        if isinstance(target, int): return list(self.by_port.get(target, {}).values())
+        if isinstance(target, str):
+            c = self.by_device.get(target) or self.clients.get(target)
+            return [c] if c else []
+        seen = {}
+        for t in target:
+            for c in self.resolve(t): seen[c.id] = c
+        return list(seen.values())
+
+    # --- Inbound framing ---
+    async def _read_frame(self, r, c: Client) -> Optional[bytes]:
+        """Next raw payload in the client's framing mode: None at EOF, b"" when an oversize frame was skipped."""
+        try:
+            if c.framing == "len":
+                n = int.from_bytes(await r.readexactly(4), "big")
+                if n <= self.frame_limit: return await r.readexactly(n)
+                left = n
+                while left:  # stream past the payload instead of buffering it
+                    chunk = await r.read(min(left, 1 << 16))
+                    if not chunk: return None
+                    left -= len(chunk)
+                self._bad_frame(c, "oversize", f"{n} bytes")
+                return b""
+            try: return await r.readuntil(b"\n")
+            except asyncio.LimitOverrunError:
+                while True:  # drop the rest of the line without buffering it
+                    try: await r.readuntil(b"\n"); break
+                    except asyncio.LimitOverrunError as e: await r.readexactly(e.consumed)
+                self._bad_frame(c, "oversize", f"line > {self.frame_limit} bytes")
+                return b""
+        except asyncio.IncompleteReadError as e:
+            return e.partial if c.framing == "line" and e.partial else None
+
+    def _inflate(self, raw: asyncio.StreamReader, c: Client) -> asyncio.StreamReader:
+        """Reader over the decompressed inbound stream of a client that negotiated "zlib".
+        Output is fed in 64 KiB steps with a yield in between, so the frame reader keeps up
+        and a small compressed frame can't balloon in memory past frame_limit."""
+        out = asyncio.StreamReader(limit=self.frame_limit)
+        async def pump():
+            z = zlib.decompressobj()
+            try:
+                while True:
+                    data = await raw.read(1 << 16)
+                    if not data: break
+                    c.stats.wire_in += len(data)
+                    while data:
+                        out.feed_data(z.decompress(data, 1 << 16)); data = z.unconsumed_tail
+                        await asyncio.sleep(0)
+            except zlib.error as e: self._bad_frame(c, "malformed", f"zlib stream: {e}")  # unrecoverable: end the connection
+            except OSError: pass
+            finally: out.feed_eof()
+        self._spawn(pump())
+        return out
+
+    def _bad_frame(self, c: Client, kind, detail):
+        c.bad_frames += 1
+        self.frame_errors[kind] = self.frame_errors.get(kind, 0) + 1
+        self.logs.append(time.time(), "warn", c.device, f"[framing] dropped {kind} frame: {detail[:160]}")
+
+    def _negotiate(self, c: Client, pkt):
+        ack = self._hello_ack(c, pkt)
+        hook = getattr(c.writer, "negotiate", None)
+        if hook: hook(ack); return  # the socket lives in a shard worker, which applies the ack itself
+        if ack: self._send_ack(c, ack)
+
+    def _hello_ack(self, c: Client, pkt) -> Optional[dict]:
+        # HELLO_ACK goes only to clients that offered something ("len" framing, compression, heartbeat,
+        # resume). It is sent as a plain line; a client switches framing / compression only after reading it.
+        offered = pkt.get("framing") or []
+        if isinstance(offered, str): offered = [offered]
+        codecs = pkt.get("compress") or []
+        if isinstance(codecs, str): codecs = [codecs]
+        codec = "" if c.compress else next((x for x in self.compression if x in codecs), "")
+        ack = {"type": "HELLO_ACK", "framing": "len" if "len" in offered else "line", "max_frame": self.frame_limit}
+        if codec: ack["compress"] = codec
+        if pkt.get("heartbeat"):
+            c.heartbeat = True
+            ack.update(heartbeat=self.heartbeat_interval, timeout=self.heartbeat_timeout)
+        if c.resume: ack.update(resume=c.resume, gm_version=c.gm_version if c.gm_tree else 0)
+        if "gm_hash" in pkt: ack["gm_hash"] = c.gm_shared.key if c.gm_shared and c.gm_shared.key == pkt["gm_hash"] else ""
+        if ack["framing"] == "line" and not codec and not c.heartbeat and not c.resume and "gm_hash" not in ack: return None
+        return ack
+
+    def _send_ack(self, c: Client, ack):
+        if c.outbox.maxsize - c.outbox.qsize() < 2: return  # the ack and the compression switch go in together
+        self._post(c, ack, "line"); c.framing = ack["framing"]
+        if ack.get("compress"):
+            c.compress = ack["compress"]
+            fut = asyncio.get_running_loop().create_future(); fut.add_done_callback(_consume)
+            c.outbox.put_nowait((None, fut))  # tells the writer to start compressing right after the ack
+
+    def _process(self, cid, pkt) -> Optional[asyncio.Future]:
+        """Act on one packet. A HELLO whose GM tree must first be read from disk returns the task
+        that sends its HELLO_ACK; the reader holds further frames until it is done."""
+        t = pkt.get("type")
+        c = self.clients.get(cid)
+        if not c: return
+
+        if t == "HELLO":
+            c.device = pkt.get("device","Unknown")
+            c.platform = pkt.get("platform","Unknown")
+            c.results = bool(pkt.get("result"))
+            self._identify(c, pkt)
+            self._resume(c, pkt)
+            wait = None
+            if self._recall_tree(c, pkt): self._negotiate(c, pkt)
+            else: wait = self._spawn(self._recall_stored(c, pkt))  # HELLO_ACK once the stored tree is read
+            self.events.emit("client_meta", cid)
+            return wait
+        elif t == "LOG":
+            for l in self.log_pipeline.push(time.time(), str(pkt.get("level","info")), c.device, str(pkt.get("msg","")), c.uid, log_fields(pkt)):
+                self.events.emit("log", cid, l)
+        elif t == "GM_LIST":
+            # identical trees (same build on many devices, or a reconnect) end up as one shared object
+            self._share_tree(c, self.gm_cache.put(pkt.get("hash"), pkt.get("data", []), pkt.get("version", 0)))
+            self.events.emit("gm_tree_changed", cid)
+        elif t == "GM_PATCH":
+            if c.gm_resync: return
+            copied = c.gm_shared is not None and pkt.get("base") == c.gm_version
+            if copied: self._own_tree(c)
+            changed = self._apply_gm_patch(c, pkt)
+            if changed is None:
+                c.gm_resync = True
+                self._spawn(self._request(c, *self._exec_pkt("RuntimeGMClient.ReloadGM(true)")))
+            else: self.events.emit("gm_tree_changed", cid, None if copied else changed)  # views hold nodes of the shared tree
+        elif t == "RESULT":
+            self._resolve(c, pkt)
+        elif t == "PING":
+            self._post(c, {"type": "PONG", "t": pkt.get("t")})
+        # PONG needs no handling: any inbound frame already refreshed stats.last_seen
+
+    # --- Incremental GM tree ---
+    def _index_nodes(self, c: Client, nodes, parent): index_tree(c.gm_index, nodes, parent)
+
+    def _unindex_nodes(self, c: Client, nodes):
+        for n in nodes:
+            c.gm_index.pop(n.get("id"), None)
+            if "children" in n: self._unindex_nodes(c, n["children"])
+
+    def _apply_gm_patch(self, c: Client, pkt):
+        """Apply GM_PATCH ops ({"op": "add"|"remove"|"update", ...}) in place.
+        Returns [(op, node, parent)] or None when the patch doesn't fit the tree we hold."""
+        if pkt.get("base") != c.gm_version: return None
+        changed = []
+        try:
+            for op in pkt.get("ops", []):
+                kind = op.get("op")
+                if kind == "add":
+                    node, pid = op["node"], op.get("parent")
+                    parent = c.gm_index[pid][0] if pid is not None else None
+                    siblings = parent.setdefault("children", []) if parent else c.gm_tree
+                    siblings.insert(op.get("index", len(siblings)), node)
+                    self._index_nodes(c, [node], parent)
+                elif kind == "remove":
+                    node, parent = c.gm_index[op["id"]]
+                    siblings = parent["children"] if parent else c.gm_tree
+                    del siblings[next(i for i, x in enumerate(siblings) if x is node)]
+                    self._unindex_nodes(c, [node])
+                elif kind == "update":
+                    node, parent = c.gm_index[op["id"]]
+                    fields = {k: v for k, v in op.get("fields", {}).items() if k != "id"}
+                    if "children" in fields: self._unindex_nodes(c, node.get("children", []))
+                    node.update(fields)
+                    if "children" in fields: self._index_nodes(c, node["children"], node)
+                else: return None
+                changed.append((kind, node, parent))
+        except (KeyError, StopIteration, TypeError, AttributeError): return None
+        c.gm_version = pkt.get("version", c.gm_version + 1); c.gm_search = None
+        return changed
+
+    def search_index(self, c: Client) -> GMSearchIndex:
+        if c.gm_search is None:
+            e = c.gm_shared
+            if e is None: c.gm_search = GMSearchIndex(c.gm_tree)
+            else:
+                if e.search is None: e.search = GMSearchIndex(e.tree)
+                c.gm_search = e.search
+        return c.gm_search
+
+    def merged_gm(self) -> MergedGMTree:
+        """The union of every connected device's GM tree, brought up to date on access."""
+        self._merged.refresh(self.clients.values())
+        return self._merged
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task); task.add_done_callback(self._tasks.discard)
+        return task
+
+    # --- Request/response correlation ---
+    def _next_id(self):
+        self.cmd_id = next(self._ids)
+        return self.cmd_id
+
+    @staticmethod
+    def _script_key(cmd):
+        line = next((l.strip() for l in str(cmd).splitlines() if l.strip()), "")
+        return line[:48]
+
+    def _track(self, c: Client, seq, script, timeout=None) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future(); fut.add_done_callback(_consume)
+        key = (c.id, seq)
+        p = self.pending[key] = Pending(fut, loop.time(), script)
+        p.timer = loop.call_later(timeout or self.exec_timeout, self._settle, key, asyncio.TimeoutError())
+        return fut
+
+    def _settle(self, key, result):
+        p = self.pending.pop(key, None)
+        if not p: return
+        if p.timer: p.timer.cancel()
+        if p.fut.done(): return
+        if isinstance(result, BaseException): p.fut.set_exception(result)
+        else: p.fut.set_result(result)
+
+    def _resolve(self, c: Client, pkt):
+        key = (c.id, pkt.get("seq", pkt.get("id")))
+        p = self.pending.get(key)
+        if not p: return
+        ms = (asyncio.get_running_loop().time() - p.sent) * 1000
+        self.latency.setdefault(c.uid, LatencyStats()).add(ms)
+        if p.script in self.script_latency or len(self.script_latency) < LATENCY_SCRIPTS:
+            self.script_latency.setdefault(p.script, LatencyStats()).add(ms)
+        self._settle(key, pkt)
+
+    def metrics(self) -> List[dict]:
+        """One row of connection counters per client (Perf panel, /api/metrics, /metrics)."""
+        now = time.time()
+        pending: Dict[str, int] = {}
+        for cid, _ in self.pending: pending[cid] = pending.get(cid, 0) + 1
+        rows = []
+        for c in self.clients.values():
+            st = c.stats; drain = st.drain.snapshot()
+            rtt = self.latency[c.uid].snapshot() if c.uid in self.latency else LatencyStats().snapshot()
+            rows.append({"uid": c.uid, "cid": c.id, "device": c.device, "platform": c.platform, "port": c.port, "framing": c.framing,
+                         "connected_s": now - st.connected, "last_seen_s": now - st.last_seen,
+                         "bytes_in": st.bytes_in, "bytes_out": st.bytes_out, "pkts_in": st.pkts_in, "pkts_out": st.pkts_out,
+                         "compress": c.compress, "wire_in": st.wire_in, "wire_out": st.wire_out,
+                         "parse_errors": c.bad_frames, "queue": c.outbox.qsize(), "queue_peak": st.queue_peak,
+                         "drain_p50_ms": drain["p50"], "drain_p95_ms": drain["p95"], "drain_max_ms": drain["max"],
+                         "rtt_p50_ms": rtt["p50"], "rtt_p95_ms": rtt["p95"], "rtt_p99_ms": rtt["p99"], "pending": pending.get(c.id, 0),
+                         "reconnects": st.reconnects})
+        return rows
+
+    def latency_report(self):
+        return {"devices": {k: v.snapshot() for k, v in self.latency.items()},
+                "scripts": {k: v.snapshot() for k, v in self.script_latency.items()}}
+
+    async def _request(self, c: Client, pkt, script, timeout=None):
+        """Queue a correlated command (pkt must carry seq). Returns (ok, msg, fut) where fut resolves to the RESULT packet,
+        or, for a device without RESULT support, to a stand-in one as soon as the command is written."""
+        if not c.results:
+            ok, msg = await self._deliver(c, self._encode(pkt))
+            fut = asyncio.get_running_loop().create_future(); fut.set_result({"ok": ok, "result": msg})
+            return ok, msg, fut
+        key = (c.id, pkt["seq"])
+        fut = self._track(c, pkt["seq"], script, timeout)
+        ok, msg = await self._deliver(c, self._encode(pkt))
+        if not ok: self._settle(key, ConnectionError(msg))
+        return ok, msg, fut
+
+    def _exec_pkt(self, cmd):
+        seq = self._next_id()
+        return {"type":"EXEC","id":seq,"seq":seq,"cmd":cmd}, self._script_key(cmd)
+
+    def _gm_pkt(self, gm_id, val):
+        return {"type":"EXEC_GM","id":gm_id,"value":val,"seq":self._next_id()}, f"GM:{gm_id}"
+
+    async def exec(self, target, cmd, timeout=None):
+        """Run Lua on one device and wait for its RESULT. Returns (ok, result or error text)."""
+        found = self.resolve(target)
+        if len(found) != 1: return False, f"{self.describe(target)} matches {len(found)} devices" if found else f"No device for {self.describe(target)}"
+        client = found[0]
+        ok, msg, fut = await self._request(client, *self._exec_pkt(cmd), timeout)
+        if not ok: return False, msg
+        return await self._outcome(client, fut, timeout)
+
+    async def _outcome(self, c: Client, fut, timeout=None):
+        try: res = await fut
+        except asyncio.TimeoutError: return False, f"{c.device}: no result within {timeout or self.exec_timeout}s"
+        except Exception as e: return False, f"{c.device}: {e}"
+        return bool(res.get("ok", True)), res.get("result", res.get("msg"))
+
+    def _step_pkt(self, c: Client, step):
+        """A batch step is Lua source, or {"gm": id, "value": v} for EXEC_GM."""
+        if not isinstance(step, dict): return self._exec_pkt(step)
+        if "gm" not in step: return self._exec_pkt(step["lua"])
+        return self._gm_pkt(step["gm"], step.get("value"))
+
+    @staticmethod
+    def _acked(c: Client, pkt, res):
+        # ui_states mirror what the device confirmed (or, without RESULT support, what was written)
+        if res[0] and pkt["type"] == "EXEC_GM" and pkt.get("value") is not None: c.ui_states[pkt["id"]] = pkt["value"]
+
+    def _ack_hook(self, c: Client, pkt):
+        def done(f):
+            if not f.cancelled() and not f.exception(): self._acked(c, pkt, (bool(f.result().get("ok", True)),))
+        return done
+
+    async def _run_steps(self, c: Client, steps, window, stop_on_error, timeout):
+        results: List[Optional[Tuple[bool, Any]]] = [None] * len(steps)
+        slots = asyncio.Semaphore(window)
+        failed = False
+        async def run(i, pkt, script):
+            nonlocal failed
+            try:
+                if c.results:
+                    fut = self._track(c, pkt["seq"], script, timeout)
+                    self._enqueue(c, self._encode(pkt), (c.id, pkt["seq"]))
+                    results[i] = await self._outcome(c, fut, timeout)
+                else: results[i] = await self._deliver(c, self._encode(pkt))  # no RESULT will come: written is done
+                self._acked(c, pkt, results[i])
+                failed = failed or not results[i][0]
+            finally: slots.release()
+        tasks = []
+        for i, step in enumerate(steps):
+            await slots.acquire()
+            if failed and stop_on_error: break
+            tasks.append(asyncio.ensure_future(run(i, *self._step_pkt(c, step))))
+        await asyncio.gather(*tasks)
+        return [r or (False, "skipped after earlier failure") for r in results]
+
+    async def run_batch(self, steps, target=None, window=BATCH_WINDOW, stop_on_error=False, timeout=None) -> Dict[str, List[Tuple[bool, Any]]]:
+        """Run a command sequence on every device `target` resolves to. Steps are pipelined:
+        up to `window` per device are queued ahead of their RESULTs, so a device still runs
+        them in order but the console never waits a round trip between two. With
+        stop_on_error a device stops being fed after its first failure (steps already in
+        flight still finish; use window=1 for strict stop). Returns {uid: [(ok, result), ...]}
+        in step order."""
+        steps = list(steps)
+        clients = self.resolve(target)
+        res = await asyncio.gather(*(self._run_steps(c, steps, min(max(1, window), SEND_QUEUE_SIZE), stop_on_error, timeout) for c in clients))
+        return {c.uid: r for c, r in zip(clients, res)}
+
+    # --- Outbound path: every packet goes through the client's own queue + writer task ---
+    def _encode(self, pkt) -> bytes:
+        return json.dumps(pkt, ensure_ascii=False).encode()
+
+    @staticmethod
+    def _frame(mode, body, cache=None) -> bytes:
+        if cache is not None and mode in cache: return cache[mode]
+        data = len(body).to_bytes(4, "big") + body if mode == "len" else body + b"\n"
+        if cache is not None: cache[mode] = data
+        return data
+
+    async def _pump(self, c: Client):
+        while True:
+            batch = [await c.outbox.get()]
+            while not c.outbox.empty(): batch.append(c.outbox.get_nowait())  # one drain for everything queued
+            batch = [(data, fut) for data, fut in batch if not fut.done()]  # skip callers that already gave up
+            if not batch: continue
+            try:
+                chunks = []
+                for data, _ in batch:
+                    if data is None: c.zout = zlib.compressobj(self.compress_level); continue
+                    chunks.append(c.zout.compress(data) if c.zout else data)
+                if c.zout: chunks.append(c.zout.flush(zlib.Z_SYNC_FLUSH))  # the device can decode everything written so far
+                c.writer.writelines(chunks)
+                st = c.stats; st.pkts_out += sum(1 for data, _ in batch if data is not None)
+                st.bytes_out += sum(len(data) for data, _ in batch if data is not None); st.wire_out += sum(map(len, chunks))
+                t = time.perf_counter()
+                await asyncio.wait_for(c.writer.drain(), self.send_timeout)
+                st.drain.add((time.perf_counter() - t) * 1000)
+                for _, fut in batch:
+                    if not fut.done(): fut.set_result(True)
+            except asyncio.TimeoutError:
+                # the peer stopped reading: writing more would only grow the transport buffer
+                err = ConnectionError(f"send timed out after {self.send_timeout}s, connection dropped")
+                for _, fut in batch:
+                    if not fut.done(): fut.set_exception(err)
+                l = self.logs.append(time.time(), "warn", c.device, f"[send] not drained in {self.send_timeout}s, closing the connection")
+                self.events.emit("log", c.id, l)
+                self._drop(c)  # the reader sees the abort and runs the normal disconnect path
+                return
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done(): fut.set_exception(e)
+
+    def _drop(self, c: Client):
+        if c.sender: c.sender.cancel()
+        while not c.outbox.empty():
+            _, fut = c.outbox.get_nowait()
+            if not fut.done(): fut.set_exception(ConnectionError("client disconnected"))
+        for key in [k for k in self.pending if k[0] == c.id]:
+            self._settle(key, ConnectionError("client disconnected"))
+        # abort, not close: a stalled peer would otherwise keep the unsent buffer (and wait_closed) alive
+        try: c.writer.transport.abort()
+        except: pass
+
+    def _post(self, c: Client, pkt, framing=None) -> bool:
+        """Queue an uncorrelated packet (HELLO_ACK, PING, PONG, or an encoded body); nobody waits for the write."""
+        body = pkt if isinstance(pkt, bytes) else self._encode(pkt)
+        if self.recorder: self.recorder.add("out", c, body)
+        fut = asyncio.get_running_loop().create_future(); fut.add_done_callback(_consume)
+        try: c.outbox.put_nowait((self._frame(framing or c.framing, body), fut))
+        except asyncio.QueueFull: return False
+        return True
+
+    def _enqueue(self, c: Client, body: bytes, key):
+        """Queue a correlated packet without waiting for the write; a failed write settles pending `key`."""
+        if self.recorder: self.recorder.add("out", c, body)
+        fut = asyncio.get_running_loop().create_future()
+        def written(f):
+            if not f.cancelled() and f.exception(): self._settle(key, ConnectionError(f"write failed: {f.exception() or type(f.exception()).__name__}"))
+        try: c.outbox.put_nowait((self._frame(c.framing, body), fut))
+        except asyncio.QueueFull: self._settle(key, ConnectionError("send queue full")); return
+        c.stats.queue_peak = max(c.stats.queue_peak, c.outbox.qsize())
+        fut.add_done_callback(written)
+
+    async def _deliver(self, c: Client, body: bytes, framed=None) -> Tuple[bool, str]:
+        if self.recorder: self.recorder.add("out", c, body)
+        fut = asyncio.get_running_loop().create_future()
+        try: c.outbox.put_nowait((self._frame(c.framing, body, framed), fut))
+        except asyncio.QueueFull: return False, f"{c.device}: send queue full"
+        c.stats.queue_peak = max(c.stats.queue_peak, c.outbox.qsize())
+        try:
+            await asyncio.wait_for(fut, self.send_timeout)
+            return True, f"Sent to {c.device}"
+        except asyncio.TimeoutError: return False, f"{c.device}: timed out"
+        except Exception as e: return False, f"{c.device}: {e or type(e).__name__}"
+
+    async def _fanout(self, pkt, script=None, targets=None) -> Dict[str, Tuple[bool, str]]:
+        """Encode once, deliver to every client (or `targets`) concurrently. Returns {cid: (ok, msg)}."""
+        body, framed = self._encode(pkt), {}
+        targets = list(self.clients.values()) if targets is None else targets
+        if "seq" in pkt:
+            for c in targets:
+                if not c.results: continue  # nothing to correlate: the write below is the outcome
+                fut = self._track(c, pkt["seq"], script)
+                if pkt["type"] == "EXEC_GM": fut.add_done_callback(self._ack_hook(c, pkt))
+        res = await asyncio.gather(*(self._deliver(c, body, framed) for c in targets))
+        for c, (ok, msg) in zip(targets, res):
+            if "seq" not in pkt: continue
+            if c.results:
+                if not ok: self._settle((c.id, pkt["seq"]), ConnectionError(msg))
+            elif pkt["type"] == "EXEC_GM": self._acked(c, pkt, (ok,))
+        return {c.id: r for c, r in zip(targets, res)}
+
+    @staticmethod
+    def _summary(report, label):
+        failed = [m for ok, m in report.values() if not ok]
+        if failed: return False, f"{label} {len(report)-len(failed)}/{len(report)}: " + "; ".join(failed)
+        return True, f"{label} Sent ({len(report)})"
+
+    @staticmethod
+    def describe(target):
+        if target is None: return "all devices"
+        if isinstance(target, int): return f"Port {target}"
+        if isinstance(target, str): return target
+        return f"group of {len(target)}"
+
+    def _report(self, target, report, label):
+        if not report: return (True, f"{label} Sent (0)") if target is None else (False, f"No device for {self.describe(target)}")
+        if len(report) == 1 and target is not None: return next(iter(report.values()))
+        return self._summary(report, label)
+
+    async def send(self, target, cmd):
+        """EXEC on every device `target` resolves to (see resolve). Returns (ok, summary)."""
+        return self._report(target, await self.broadcast(cmd, target), "Broadcast")
+
+    async def send_gm(self, target, gm_id, val=None):
+        return self._report(target, await self.broadcast_gm(gm_id, val, target), "Broadcast GM")
+
+    async def send_to_port(self, port, cmd): return await self.send(port, cmd)
+    async def send_gm_to_port(self, port, gm_id, val=None): return await self.send_gm(port, gm_id, val)
+
+    async def broadcast(self, cmd, target=None):
+        return await self._fanout(*self._exec_pkt(cmd), self.resolve(target))
+
+    async def broadcast_gm(self, gm_id, val=None, target=None):
+        return await self._fanout(*self._gm_pkt(gm_id, val), self.resolve(target))
+
+    # --- Stateful controls: coalesced EXEC_GM ---
+    async def set_gm(self, target, gm_id, val, timeout=None) -> Dict[str, Tuple[bool, Any]]:
+        """Set a Toggle / Input value on every device `target` resolves to and wait for the
+        RESULTs. Per (device, control) at most one EXEC_GM is in flight; values set meanwhile
+        collapse into the newest (last write wins), which goes out once the device answers.
+        A caller whose value was superseded gets the outcome of the value that replaced it.
+        Returns {cid: (ok, result or error text)}."""
+        clients = self.resolve(target)
+        res = await asyncio.gather(*(self._set_one(c, gm_id, val, timeout) for c in clients))
+        return {c.id: r for c, r in zip(clients, res)}
+
+    def _set_one(self, c: Client, gm_id, val, timeout=None) -> asyncio.Future:
+        key = (c.id, gm_id)
+        ctl = self.controls.get(key) or self.controls.setdefault(key, Control())
+        ctl.want = val
+        fut = asyncio.get_running_loop().create_future(); ctl.waiters.append(fut)
+        if ctl.task is None: ctl.task = self._spawn(self._drive(c, gm_id, ctl, timeout))
+        return fut
+
+    async def _drive(self, c: Client, gm_id, ctl: Control, timeout):
+        res: Tuple[bool, Any] = (False, f"{c.device}: control not sent")
+        try:
+            while ctl.waiters:
+                val, waiters, ctl.waiters = ctl.want, ctl.waiters, []
+                pkt, script = self._gm_pkt(gm_id, val)
+                ok, msg, fut = await self._request(c, pkt, script, timeout)
+                res = await self._outcome(c, fut, timeout) if ok else (False, msg)
+                self._acked(c, pkt, res)
+                if res[0] and ctl.want == val: waiters += ctl.waiters; ctl.waiters = []  # flipped back meanwhile: already there
+                for w in waiters:
+                    if not w.done(): w.set_result(res)
+        finally:
+            for w in ctl.waiters:
+                if not w.done(): w.set_result(res)
+            if self.controls.get((c.id, gm_id)) is ctl: del self.controls[(c.id, gm_id)]
+
+
+def _prom_label(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheus_text(mgr: ServerMgr) -> str:
+    """Prometheus text exposition (format 0.0.4) of mgr.metrics() plus console-wide gauges."""
+    out: List[str] = []
+    def family(name, kind, text, samples):
+        out.append(f"# HELP gm_{name} {text}"); out.append(f"# TYPE gm_{name} {kind}")
+        out.extend(f"gm_{name}{{{labels}}} {value}" if labels else f"gm_{name} {value}" for labels, value in samples)
+    rows = mgr.metrics()
+    dev = {r["cid"]: f'uid="{_prom_label(r["uid"])}",device="{_prom_label(r["device"])}",port="{r["port"]}"' for r in rows}
+    per = lambda key: [(dev[r["cid"]], r[key]) for r in rows]
+    quant = lambda *keys: [(f'{dev[r["cid"]]},quantile="{q}"', r[k]) for r in rows for q, k in zip(("0.5", "0.95", "0.99"), keys)]
+    family("bytes_received_total", "counter", "Frame bytes received from the device, after decompression.", per("bytes_in"))
+    family("bytes_sent_total", "counter", "Frame bytes sent to the device, before compression.", per("bytes_out"))
+    family("wire_bytes_received_total", "counter", "Bytes read from the socket (compressed size when negotiated).", per("wire_in"))
+    family("wire_bytes_sent_total", "counter", "Bytes written to the socket (compressed size when negotiated).", per("wire_out"))
+    family("packets_received_total", "counter", "Frames received from the device.", per("pkts_in"))
+    family("packets_sent_total", "counter", "Packets written to the device.", per("pkts_out"))
+    family("parse_errors_total", "counter", "Malformed, oversize or rejected frames.", per("parse_errors"))
+    family("send_queue_depth", "gauge", "Packets waiting in the send queue.", per("queue"))
+    family("send_queue_peak", "gauge", "Deepest the send queue has been.", per("queue_peak"))
+    family("drain_wait_ms", "gauge", "Writer time spent in drain() per flush.", quant("drain_p50_ms", "drain_p95_ms"))
+    family("exec_rtt_ms", "gauge", "EXEC / EXEC_GM round-trip time.", quant("rtt_p50_ms", "rtt_p95_ms", "rtt_p99_ms"))
+    scripts = mgr.latency_report()["scripts"]
+    family("script_rtt_ms", "gauge", "Round-trip time per Lua snippet / GM id, over all devices.",
+           [(f'script="{_prom_label(k)}",quantile="{q}"', v[p]) for k, v in scripts.items() for q, p in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99"))])
+    family("pending_requests", "gauge", "Commands waiting for a RESULT.", per("pending"))
+    family("reconnects_total", "counter", "Earlier connections seen from the same device id.", per("reconnects"))
+    family("last_seen_seconds", "gauge", "Seconds since the last frame from the device.", [(l, f"{v:.3f}") for l, v in per("last_seen_s")])
+    family("clients", "gauge", "Connected clients.", [("", len(rows))])
+    family("listeners", "gauge", "Open listener ports.", [("", len(mgr.listeners))])
+    family("log_records_total", "counter", "LOG records ingested.", [("", mgr.logs.next_seq)])
+    family("log_pipeline_records_total", "counter", "Device LOG records by log pipeline stage.", [(f'stage="{k}"', v) for k, v in mgr.log_pipeline.counts.items()])
+    family("frame_errors_total", "counter", "Bad frames by kind.", [(f'kind="{k}"', v) for k, v in mgr.frame_errors.items()])
+    gc = mgr.gm_cache.stats()
+    family("tree_cache_lookups_total", "counter", "GM tree cache lookups (GM_LIST and HELLO gm_hash).", [('result="hit"', gc["hits"]), ('result="miss"', gc["misses"])])
+    family("tree_cache_trees", "gauge", "Distinct GM trees held by the cache.", [("", gc["trees"])])
+    lag = mgr.loop_monitor.lag.snapshot()
+    family("loop_lag_ms", "gauge", "Event-loop scheduling lag.", [(f'quantile="{q}"', f"{lag[k]:.3f}") for q, k in (("0.5", "p50"), ("0.99", "p99"))])
+    family("loop_stalls_total", "counter", "Callbacks that blocked the loop past the threshold.", [("", mgr.loop_monitor.stall_count)])
+    return "\n".join(out) + "\n"
+
+# ============================================================================
+# Session recording / replay
+# ============================================================================
+
+SESSION_MAGIC = b"GMREC1\n"
+INDEX_MAGIC = b"GMIX"
+_TYPE_RE = re.compile(rb'"type"\s*:\s*"(\w+)"')
+
+class SessionRecorder:
+    """Writes every packet in both directions to a compact session file:
+
+        b"GMREC1\\n" | blocks: [4-byte len][zlib(JSON lines)] ... | index: zlib(JSON) [4-byte len] b"GMIX"
+
+    A record is [t, dir, cid, uid, port, packet]: t in seconds since start, dir one of
+    open / in / out / close, and the packet spliced in as the raw JSON the wire carried
+    (never re-encoded). The index holds each block's offset, time span and devices plus a
+    per-device summary, so readers can jump to one device; a file cut short by a crash has
+    no index and is scanned instead. Blocks are compressed on the loop (zlib level 1, ~1 ms
+    per block) and written through the FileWriter."""
+    def __init__(self, path, writer=None):
+        self.path = path
+        self.writer: FileWriter = writer or file_writer
+        self.t0 = time.monotonic(); self.started = time.time()
+        self.buf: List[bytes] = []; self.size = 0
+        self.offset = len(SESSION_MAGIC)
+        self.blocks: List[dict] = []
+        self.devices: Dict[str, dict] = {}
+        self.block_devs: set = set(); self.block_t0 = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.writer.replace(path, SESSION_MAGIC)
+
+    def add(self, direction, c: Client, body: bytes = b"null", ptype=None):
+        t = time.monotonic() - self.t0
+        if b"\n" in body: body = body.replace(b"\n", b" ")  # only whitespace can hold raw newlines in JSON
+        self.buf.append(b'[%.4f,"%s",%s,%s,%d,%s]\n' % (t, direction.encode(), json.dumps(c.id).encode(), json.dumps(c.uid).encode(), c.port, body))
+        self.size += len(self.buf[-1])
+        if ptype is None and direction in ("in", "out"):
+            m = _TYPE_RE.search(body, 0, 64)
+            ptype = m.group(1).decode() if m else "?"
+        if c.uid != c.id or direction != "open":  # a connection has no device summary until HELLO names it
+            d = self.devices.get(c.uid)
+            if d is None: d = self.devices[c.uid] = {"device": c.device, "platform": c.platform, "first": t, "packets": {}}
+            d["device"] = c.device; d["platform"] = c.platform; d["last"] = t
+            key = f"{direction}:{ptype}" if ptype else direction
+            d["packets"][key] = d["packets"].get(key, 0) + 1
+        if self.block_t0 is None: self.block_t0 = t
+        self.block_devs.add(c.uid)
+        if self.size >= RECORD_BLOCK: self.flush()
+        elif not self._timer:
+            try: self._timer = asyncio.get_running_loop().call_later(RECORD_FLUSH, self.flush)
+            except RuntimeError: pass
+
+    def flush(self):
+        if self._timer: self._timer.cancel(); self._timer = None
+        if not self.buf: return
+        raw = b"".join(self.buf)
+        data = zlib.compress(raw, 1)
+        self.blocks.append({"offset": self.offset, "size": len(data), "t0": self.block_t0,
+                            "t1": time.monotonic() - self.t0, "n": len(self.buf), "devices": sorted(self.block_devs)})
+        self.writer.append(self.path, len(data).to_bytes(4, "big") + data)
+        self.offset += 4 + len(data)
+        self.buf = []; self.size = 0; self.block_devs = set(); self.block_t0 = None
+
+    def close(self):
+        self.flush()
+        index = zlib.compress(json.dumps({"started": self.started, "duration": time.monotonic() - self.t0,
+                                          "blocks": self.blocks, "devices": self.devices}).encode(), 6)
+        self.writer.append(self.path, index + len(index).to_bytes(4, "big") + INDEX_MAGIC)
+
+class SessionReader:
+    """Random access to a session file: index (or a scan when it is missing), per-device
+    timelines, and record iteration that only inflates the blocks a query needs."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(SESSION_MAGIC)) != SESSION_MAGIC: raise ValueError(f"{path}: not a session file")
+            f.seek(0, os.SEEK_END); end = f.tell()
+            self.index = None
+            if end >= len(SESSION_MAGIC) + 8:
+                f.seek(end - 8); tail = f.read(8)
+                if tail[4:] == INDEX_MAGIC:
+                    n = int.from_bytes(tail[:4], "big")
+                    f.seek(end - 8 - n)
+                    try: self.index = json.loads(zlib.decompress(f.read(n)))
+                    except (zlib.error, ValueError): self.index = None
+        self.complete = self.index is not None
+        if not self.complete: self.index = self._scan()
+        self.blocks: List[dict] = self.index["blocks"]
+        self.devices: Dict[str, dict] = self.index["devices"]
+
+    def _scan(self):
+        """Rebuild the index of a recording that was never closed."""
+        blocks, devices = [], {}
+        with open(self.path, 'rb') as f:
+            off = len(SESSION_MAGIC); f.seek(off)
+            while True:
+                head = f.read(4)
+                if len(head) < 4: break
+                n = int.from_bytes(head, "big"); data = f.read(n)
+                try: recs = [json.loads(l) for l in zlib.decompress(data).splitlines()]
+                except (zlib.error, ValueError): break  # torn last block
+                for t, d, cid, uid, port, pkt in recs:
+                    if d == "open" and uid == cid: continue
+                    dev = devices.setdefault(uid, {"device": "Unknown", "platform": "Unknown", "first": t, "packets": {}})
+                    dev["last"] = t
+                    key = f"{d}:{pkt.get('type')}" if isinstance(pkt, dict) else d
+                    dev["packets"][key] = dev["packets"].get(key, 0) + 1
+                    if isinstance(pkt, dict) and pkt.get("type") == "HELLO":
+                        dev["device"] = pkt.get("device", dev["device"]); dev["platform"] = pkt.get("platform", dev["platform"])
+                blocks.append({"offset": off, "size": n, "t0": recs[0][0] if recs else 0, "t1": recs[-1][0] if recs else 0,
+                               "n": len(recs), "devices": sorted({r[3] for r in recs})})
+                off += 4 + n
+        return {"started": None, "duration": blocks[-1]["t1"] if blocks else 0, "blocks": blocks, "devices": devices}
+
+    def records(self, uid=None, since=None, until=None):
+        """Yield (t, dir, cid, uid, port, packet) in recorded order."""
+        with open(self.path, 'rb') as f:
+            for b in self.blocks:
+                if uid is not None and uid not in b["devices"]: continue
+                if since is not None and b["t1"] < since: continue
+                if until is not None and b["t0"] > until: break
+                f.seek(b["offset"] + 4)
+                for line in zlib.decompress(f.read(b["size"])).splitlines():
+                    r = json.loads(line)
+                    if uid is not None and r[3] != uid: continue
+                    if since is not None and r[0] < since: continue
+                    if until is not None and r[0] > until: return
+                    yield tuple(r)
+
+    def timeline(self, uid) -> List[Tuple[float, str, str]]:
+        """(t, dir, packet type) for every record of one device."""
+        return [(t, d, pkt.get("type", "?") if isinstance(pkt, dict) else "") for t, d, _, _, _, pkt in self.records(uid)]
+
+class _NullWriter:
+    """Stands in for a socket writer while replaying recorded clients."""
+    transport = property(lambda self: self)
+    def write(self, data): pass
+    def writelines(self, data): pass
+    async def drain(self): pass
+    def close(self): pass
+    def abort(self): pass
+    async def wait_closed(self): pass
+    def get_extra_info(self, name, default=None): return default
+
+async def replay_ingest(mgr: ServerMgr, path, speed=0.0, uid=None) -> Dict[str, float]:
+    """Feed a recording's inbound packets through mgr._process as if its devices were
+    connected: 0 = as fast as possible, 1 = recorded pace. Devices still connected when the
+    recording ended stay attached, so mgr ends in the recorded state. Meant for a fresh
+    ServerMgr, since replayed HELLOs claim the recorded device ids."""
+    reader = SessionReader(path)
+    live: Dict[str, Client] = {}
+    def close(c):
+        mgr._detach(c); mgr._drop(c); mgr.events.emit("client_removed", c.id)
+    n = 0; start = time.monotonic()
+    for t, d, cid, _, port, pkt in reader.records(uid):
+        if speed:
+            wait = start + t / speed - time.monotonic()
+            if wait > 0: await asyncio.sleep(wait)
+        c = live.get(cid)
+        if d == "close":
+            if c: close(live.pop(cid))
+            continue
+        if d == "out": continue
+        if c is None:
+            c = live[cid] = Client(id=f"replay:{cid}", port=port, writer=_NullWriter(), uid=f"replay:{cid}")
+            mgr._attach(c); c.sender = asyncio.ensure_future(mgr._pump(c))
+            mgr.events.emit("client_added", c.id)
+        if d == "in" and isinstance(pkt, dict):
+            try: mgr._process(c.id, pkt)
+            except Exception as e: mgr._bad_frame(c, "rejected", f"{pkt.get('type')}: {e!r}")
+            n += 1
+            if not speed and n % 1000 == 0: await asyncio.sleep(0)  # let sockets and timers run
+    elapsed = time.monotonic() - start
+    return {"packets": n, "seconds": elapsed, "packets_per_s": n / elapsed if elapsed else 0.0}
+
+async def replay_commands(mgr: ServerMgr, path, source=None, target=None, speed=1.0, timeout=None) -> Dict[str, int]:
+    """Re-send the recorded EXEC / EXEC_GM commands to live devices. Each command goes to the
+    uid it was recorded for, or to `target` (a broadcast is then sent once, not per device).
+    `source` keeps only one recorded device's commands."""
+    reader = SessionReader(path)
+    tasks, seen = [], set()
+    start = time.monotonic()
+    for t, d, _, uid, _, pkt in reader.records(source):
+        if d != "out" or not isinstance(pkt, dict) or pkt.get("type") not in ("EXEC", "EXEC_GM"): continue
+        if target is not None:
+            if pkt.get("seq") in seen: continue
+            seen.add(pkt.get("seq"))
+        if speed:
+            wait = start + t / speed - time.monotonic()
+            if wait > 0: await asyncio.sleep(wait)
+        step = pkt.get("cmd", "") if pkt["type"] == "EXEC" else {"gm": pkt.get("id"), "value": pkt.get("value")}
+        tasks.append(asyncio.ensure_future(mgr.run_batch([step], uid if target is None else target, timeout=timeout)))
+    res = {"commands": len(tasks), "ok": 0, "failed": 0}
+    for rep in await asyncio.gather(*tasks):
+        if not rep: res["failed"] += 1  # its device is gone
+        for steps in rep.values():
+            for good, _ in steps: res["ok" if good else "failed"] += 1
+    return res
+
+# ============================================================================
+# Headless CLI
+# ============================================================================
+
+def parse_target(text):
+    """CLI target syntax: "all", a port number, a device uid, or a comma-separated group of those."""
+    if text in (None, "", "all"): return None
+    parts = [p.strip() for p in text.split(",") if p.strip()]
+    conv = [int(p) if p.isdigit() else p for p in parts]
+    return conv[0] if len(conv) == 1 else conv
+
+async def wait_devices(mgr: ServerMgr, count, timeout):
+    """Wait until `count` devices have identified themselves with HELLO."""
+    end = time.monotonic() + timeout
+    while sum(1 for c in mgr.clients.values() if c.uid != c.id) < count:
+        if time.monotonic() > end: return False
+        await asyncio.sleep(0.05)
+    return True
+
+async def _start(ports, workers=None, **settings) -> Optional[ServerMgr]:
+    if sys.platform == 'win32': asyncio.get_running_loop().set_exception_handler(_windows_exception_handler)
+    mgr = ServerMgr()
+    for k, v in settings.items(): setattr(mgr, k, v)  # before listening: shard workers copy them at start
+    if workers is not None:
+        from gm_shard import ShardPool
+        mgr.shards = ShardPool(mgr, workers)
+    for p in ports:
+        ok, msg = await mgr.add_listener(p)
+        if not ok:
+            print(f"listener {p}: {msg}", file=sys.stderr)
+            return None
+    return mgr
+
+def log_settings(args) -> dict:
+    """LogPipeline.configure() keywords from the --log-* options of serve / ui."""
+    export = {"dir": args.log_export, "compress": args.log_export_gz, "rotate_mb": args.log_rotate_mb} if args.log_export else None
+    return {"min_level": args.log_level, "include": args.log_include, "exclude": args.log_exclude,
+            "rate": args.log_rate, "burst": args.log_burst, "sample": args.log_sample, "export": export}
+
+async def _serve(args):
+    mgr = await _start(args.port, args.workers, heartbeat_interval=args.heartbeat, heartbeat_timeout=args.idle_timeout,
+                       compression=() if args.no_compress else COMPRESSION, gm_cache=GMTreeCache(path=args.gm_cache))
+    if not mgr: return 1
+    try: await mgr.log_pipeline.aconfigure(**log_settings(args))
+    except ValueError as e:
+        print(f"log pipeline: {e}", file=sys.stderr)
+        for p in list(mgr.listeners): await mgr.remove_listener(p)
+        return 1
+    def on_registry(events):
+        for e in events:
+            c = mgr.clients.get(e.cid)
+            if e.kind == "client_removed": print(f"- {e.cid}", flush=True)
+            elif c and e.kind == "client_meta": print(f"= {c.uid} {c.device} ({c.platform}) on :{c.port}", flush=True)
+            elif c: print(f"+ {e.cid} on :{c.port}", flush=True)
+    def on_log(events):
+        for e in events:
+            l = e.data
+            print(f"{l.time:%H:%M:%S} {l.level.upper():<5} {l.device}: {l.msg}", flush=True)
+    mgr.events.subscribe(("client_added", "client_removed", "client_meta"), on_registry)
+    if not args.quiet: mgr.events.subscribe("log", on_log)
+    if args.record: print(f"recording to {mgr.start_recording(args.record)}", flush=True)
+    print(f"listening on {', '.join(map(str, args.port))}", flush=True)
+    stop = asyncio.Event()
+    try: asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)  # so a recording gets its index
+    except (NotImplementedError, AttributeError): pass  # Windows: Ctrl+C only
+    try: await stop.wait()
+    finally:
+        mgr.stop_recording()
+        for p in list(mgr.listeners): await mgr.remove_listener(p)
+        mgr.log_pipeline.close()
+        await file_writer.flush()
+
+async def _exec(args):
+    mgr = await _start(args.port)
+    if not mgr: return 1
+    try:
+        if not await wait_devices(mgr, args.devices, args.wait):
+            print(f"only {len(mgr.clients)}/{args.devices} devices connected after {args.wait}s", file=sys.stderr)
+            if not mgr.clients: return 1
+        target = parse_target(args.target)
+        if args.mode == "exec":
+            code = sys.stdin.read() if args.lua == "-" else args.lua
+            clients = mgr.resolve(target)
+            results = await asyncio.gather(*(mgr.exec(c.uid, code, args.timeout) for c in clients))
+            rows = [({"uid": c.uid, "device": c.device}, ok, res) for c, (ok, res) in zip(clients, results)]
+        else:
+            src = sys.stdin.read() if args.steps == "-" else open(args.steps, encoding="utf-8").read()
+            report = await mgr.run_batch(json.loads(src), target, args.window, args.stop_on_error, args.timeout)
+            rows = [({"uid": uid, "step": i}, ok, res) for uid, steps in report.items() for i, (ok, res) in enumerate(steps)]
+        for head, ok, res in rows:
+            print(json.dumps({**head, "ok": ok, "result": res}, ensure_ascii=False, default=str))
+        return 0 if rows and all(ok for _, ok, _ in rows) else 1
+    finally:
+        for p in list(mgr.listeners): await mgr.remove_listener(p)
+
+async def _session(args):
+    if args.action == "info":
+        r = SessionReader(args.file)
+        print(f"{args.file}: {sum(b['n'] for b in r.blocks)} records in {len(r.blocks)} blocks, "
+              f"{r.index['duration']:.1f}s{'' if r.complete else ' (no index: recording was not closed)'}")
+        for uid, d in r.devices.items():
+            print(f"  {uid:<24} {d['device']} ({d['platform']})  {d['first']:.1f}s-{d.get('last', d['first']):.1f}s  "
+                  + " ".join(f"{k}={v}" for k, v in sorted(d["packets"].items())))
+        if args.source:
+            for t, d, ptype in r.timeline(args.source): print(f"  {t:10.3f} {d:<5} {ptype}")
+        return 0
+    if args.action == "ingest":
+        mgr = ServerMgr()
+        res = await replay_ingest(mgr, args.file, args.speed, args.source)
+        res.update(logs=len(mgr.logs), frame_errors=sum(mgr.frame_errors.values()))
+        print(json.dumps(res))
+        return 0
+    mgr = await _start(args.port)
+    if not mgr: return 1
+    try:
+        if not await wait_devices(mgr, args.devices, args.wait):
+            print(f"only {len(mgr.clients)}/{args.devices} devices connected after {args.wait}s", file=sys.stderr)
+        res = await replay_commands(mgr, args.file, args.source, parse_target(args.target) if args.target else None, args.speed, args.timeout)
+        print(json.dumps(res))
+        return 0 if res["commands"] and not res["failed"] else 1
+    finally:
+        for p in list(mgr.listeners): await mgr.remove_listener(p)
+
+def _library(args):
+    lib = CustomGmManager()
+    if args.action == "export":
+        text = json.dumps(lib.export_library([it["id"] for it in lib.find(args.folder, args.tag)]), ensure_ascii=False, indent=2)
+        if args.file == "-": print(text)
+        else: write_atomic(args.file, text)
+        return 0
+    src = sys.stdin.read() if args.file == "-" else open(args.file, encoding="utf-8").read()
+    print(f"imported {lib.import_library(json.loads(src), args.folder)} scripts into {lib.file_path}")
+    return 0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="GM Console core")
+    sub = ap.add_subparsers(dest="mode", required=True)
+    serve = sub.add_parser("serve", help="run the console headless and print device traffic")
+    serve.add_argument("--port", type=int, action="append", help=f"listener port (repeatable, default {DEFAULT_PORT})")
+    serve.add_argument("-q", "--quiet", action="store_true", help="don't print LOG packets")
+    serve.add_argument("--record", metavar="FILE", help="record all traffic to a session file")
+    serve.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL, help="seconds of silence before a device is PINGed")
+    serve.add_argument("--idle-timeout", type=float, default=HEARTBEAT_TIMEOUT, help="seconds of silence before a device is dropped")
+    serve.add_argument("--no-compress", action="store_true", help="refuse stream compression offered in HELLO")
+    ex = sub.add_parser("exec", help="wait for devices, run one Lua snippet and print each RESULT as JSON")
+    ex.add_argument("lua", help='Lua source, or "-" to read it from stdin')
+    ba = sub.add_parser("batch", help="wait for devices, run a list of steps pipelined and print one JSON line per step")
+    ba.add_argument("steps", help='JSON file holding a list of Lua strings / {"gm": id, "value": v}, or "-" for stdin')
+    ba.add_argument("--window", type=int, default=BATCH_WINDOW, help="steps in flight per device")
+    ba.add_argument("--stop-on-error", action="store_true", help="stop feeding a device after its first failure")
+    for p in (ex, ba):
+        p.add_argument("--port", type=int, action="append", help=f"listener port (repeatable, default {DEFAULT_PORT})")
+        p.add_argument("--devices", type=int, default=1, help="devices to wait for before running")
+        p.add_argument("--wait", type=float, default=30.0, help="seconds to wait for devices")
+        p.add_argument("--target", default="all", help='"all", a port, a device uid, or a comma-separated group')
+        p.add_argument("--timeout", type=float, default=EXEC_TIMEOUT, help="seconds to wait for each RESULT")
+    ses = sub.add_parser("session", help="inspect or replay a recorded session file")
+    ses.add_argument("action", choices=("info", "ingest", "send"),
+                     help="info: per-device summary; ingest: feed inbound traffic to an offline ServerMgr; send: re-send commands to live devices")
+    ses.add_argument("file")
+    ses.add_argument("--speed", type=float, default=0.0, help="1 = recorded pace, 0 = as fast as possible")
+    ses.add_argument("--source", help="only this recorded device uid (info: print its timeline)")
+    ses.add_argument("--target", help="send: deliver every command here instead of to its recorded device")
+    ses.add_argument("--port", type=int, action="append", help=f"send: listener port (repeatable, default {DEFAULT_PORT})")
+    ses.add_argument("--devices", type=int, default=1, help="send: devices to wait for first")
+    ses.add_argument("--wait", type=float, default=30.0)
+    ses.add_argument("--timeout", type=float, default=EXEC_TIMEOUT)
+    lib = sub.add_parser("library", help="export / import the custom GM script library")
+    lib.add_argument("action", choices=("export", "import"))
+    lib.add_argument("file", help='library JSON, or "-" for stdout / stdin')
+    lib.add_argument("--folder", help="export only this folder / import everything into it")
+    lib.add_argument("--tag", help="export only scripts carrying this tag")
+    gui = sub.add_parser("ui", help="start the NiceGUI console")
+    gui.add_argument("--port", type=int, action="append", help=f"listener port (repeatable, default {DEFAULT_PORT})")
+    gui.add_argument("--web-port", type=int, default=9529)
+    for p in (serve, gui):
+        p.add_argument("--workers", type=int, metavar="N", help="read and parse device sockets in N worker processes (0 = one per spare core)")
+        p.add_argument("--gm-cache", metavar="DIR", help="keep GM trees announced by hash in DIR, so devices skip GM_LIST after a restart")
+        lg = p.add_argument_group("log pipeline (applied to device LOG packets before they are stored or shown)")
+        lg.add_argument("--log-level", choices=("debug", "info", "warn", "error", "fatal"), help="drop records below this level")
+        lg.add_argument("--log-include", metavar="REGEX", help="keep only messages matching REGEX")
+        lg.add_argument("--log-exclude", metavar="REGEX", help="drop messages matching REGEX")
+        lg.add_argument("--log-rate", type=float, default=0.0, metavar="N", help="at most N lines/s per device shown (0 = unlimited); export is not limited")
+        lg.add_argument("--log-burst", type=int, default=0, metavar="N", help="lines a device may send at once above --log-rate (default: one second's worth)")
+        lg.add_argument("--log-sample", type=int, default=1, metavar="N", help="show 1 in N debug/info lines per device")
+        lg.add_argument("--log-export", metavar="DIR", help="write every record passing level/regex filters to rotating JSONL files in DIR")
+        lg.add_argument("--log-export-gz", action="store_true", help="gzip the exported files")
+        lg.add_argument("--log-rotate-mb", type=float, default=LOG_ROTATE_BYTES >> 20, metavar="MB", help="start a new export file at this size")
+    args = ap.parse_args(argv)
+    if args.mode == "library": return _library(args)
+    args.port = args.port or [DEFAULT_PORT]
+    if args.mode == "ui":
+        import gm_console  # NiceGUI is only imported when the UI is actually requested
+        gm_console.run(web_port=args.web_port, listen=args.port, workers=args.workers, gm_cache=args.gm_cache, logs=log_settings(args))
+        return 0
+    try: return asyncio.run(_serve(args) if args.mode == "serve" else _session(args) if args.mode == "session" else _exec(args))
+    except KeyboardInterrupt: return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+GM Console shard workers - multi-process ingest for large device farms.
+The console process still accepts every device connection, then hands the socket to one of N
+worker processes (the least loaded). The worker owns it from there: it reads and parses frames,
+applies the HELLO_ACK the console decided (framing, compression), answers PING and batches LOG
+records. The console keeps a proxy Client per connection, so ServerMgr, the UI and the API work
+unchanged while JSON parsing and socket I/O happen on other cores.
+
+  python gm_core.py serve --workers 4
+  python gm_core.py ui --workers 4
+
+  worker -> console   [("pkt", cid, pkt) | ("log", cid, ts, level, msg, fields) | ("note", cid, ts, level, msg) | ("close", cid) | ("stats", rows, frame_errors)]
+  console -> worker   ("sock", socket, cid, port) | ("hello", cid, ack) | ("send", cid, [body, ...]) | ("close", cid) | ("stop",)
+
+Messages are pickles over multiprocessing pipes; sockets cross with multiprocessing's own
+reduction, so this works on Windows and POSIX alike. Workers run on uvloop when it is installed.
+"""
+
+import asyncio
+import multiprocessing
+import os
+import pickle
+import socket
+import threading
+import time
+from multiprocessing.reduction import ForkingPickler
+from typing import Dict, List, Optional, Set
+
+from gm_core import Client, ServerMgr, _keepalive, log_fields
+
+SHARD_FLUSH = 0.02    # seconds a worker batches LOG records before forwarding them
+SHARD_BATCH = 2000    # queued events that force an early forward
+SHARD_STATS = 1.0     # seconds between connection counter updates (shorter for tight heartbeat timeouts)
+HELLO_WAIT = 5.0      # seconds a worker waits for the console's HELLO_ACK decision
+
+# ============================================================================
+# Worker process
+# ============================================================================
+
+class ShardWorker(ServerMgr):
+    """Worker side. Reuses ServerMgr's framing, inflate and writer code for the sockets it
+    owns; everything above the transport is forwarded to the console."""
+    def __init__(self, conn, cfg):
+        super().__init__()
+        self.conn = conn
+        self.frame_limit, self.send_timeout, self.compress_level, self.heartbeat_timeout = cfg
+        self.out: List[tuple] = []
+        self.hellos: Dict[str, asyncio.Future] = {}
+
+    def _forward(self, ev, now=False):
+        self.out.append(ev)
+        if now or len(self.out) >= SHARD_BATCH: self.flush()
+
+    def flush(self):
+        if not self.out: return
+        out, self.out = self.out, []
+        try: self.conn.send_bytes(pickle.dumps(out, pickle.HIGHEST_PROTOCOL))
+        except OSError: pass  # console is gone; the reader thread ends the worker
+
+    def _bad_frame(self, c: Client, kind, detail):
+        super()._bad_frame(c, kind, detail)
+        l = self.logs.get(self.logs.next_seq - 1)
+        self._forward(("note", c.id, l.ts, l.level, l.msg))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        def recv():
+            try:
+                while True: loop.call_soon_threadsafe(self._command, ForkingPickler.loads(self.conn.recv_bytes()), stop)
+            except (EOFError, OSError): loop.call_soon_threadsafe(lambda: stop.done() or stop.set_result(None))
+        threading.Thread(target=recv, name="gm-shard-recv", daemon=True).start()
+        ticker = asyncio.ensure_future(self._tick())
+        await stop
+        ticker.cancel()
+        for c in list(self.clients.values()): self._drop(c)
+        await asyncio.sleep(0.05)  # let readers see EOF and queue their "close"
+        self.flush()
+
+    async def _tick(self):
+        # the console's heartbeat sees last_seen through these rows: refresh well inside its timeout
+        period = min(SHARD_STATS, self.heartbeat_timeout / 4)
+        due = time.monotonic() + period
+        while True:
+            await asyncio.sleep(SHARD_FLUSH)
+            if time.monotonic() >= due:
+                due += period
+                rows = [(c.id, c.stats.last_seen, c.stats.bytes_in, c.stats.wire_in, c.stats.pkts_in,
+                         c.stats.bytes_out, c.stats.wire_out, c.stats.pkts_out, c.bad_frames) for c in self.clients.values()]
+                self._forward(("stats", rows, self.frame_errors)); self.frame_errors = {}
+            self.flush()
+
+    def _command(self, msg, stop):
+        kind = msg[0]
+        if kind == "stop":
+            if not stop.done(): stop.set_result(None)
+            return
+        if kind == "sock":
+            self._spawn(self._serve(*msg[1:])); return
+        c = self.clients.get(msg[1])
+        if c is None: return
+        if kind == "hello":
+            fut = self.hellos.pop(c.id, None)
+            if fut and not fut.done(): fut.set_result(msg[2])
+        elif kind == "send":
+            for body in msg[2]:
+                if not self._post(c, body): self._forward(("note", c.id, time.time(), "warn", "[shard] send queue full, packet dropped"))
+        elif kind == "close": self._drop(c)
+
+    async def _serve(self, sock, cid, port):
+        """ServerMgr._h for a handed-over socket."""
+        _keepalive(sock, self.heartbeat_timeout)
+        try: raw, w = await asyncio.open_connection(sock=sock, limit=self.frame_limit)
+        except OSError:
+            sock.close(); self._forward(("close", cid), True); return
+        c = self.clients[cid] = Client(id=cid, port=port, writer=w, uid=cid)
+        c.sender = asyncio.ensure_future(self._pump(c))
+        try: await self._read_loop(c, raw)
+        except OSError: pass
+        finally:
+            self.clients.pop(cid, None); self.hellos.pop(cid, None)
+            self._drop(c)
+            self._forward(("close", cid), True)
+
+    def _dispatch(self, c, pkt, frame):
+        t = pkt.get("type")
+        if t == "LOG": self._forward(("log", c.id, c.stats.last_seen, str(pkt.get("level", "info")), str(pkt.get("msg", "")), log_fields(pkt)))
+        elif t == "PING": self._post(c, {"type": "PONG", "t": pkt.get("t")})
+        elif t != "PONG":  # PONG only refreshes last_seen
+            self._forward(("pkt", c.id, pkt), True)
+            if t == "HELLO": return self._await_ack(c)
+        return None
+
+    async def _await_ack(self, c):
+        # nothing may be read until the ack decision is known: the next frame may already use it
+        fut = self.hellos[c.id] = asyncio.get_running_loop().create_future()
+        try: ack = await asyncio.wait_for(fut, HELLO_WAIT)
+        except asyncio.TimeoutError: ack = None
+        if ack: self._send_ack(c, ack)
+
+def worker_main(conn, cfg):
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError: pass
+    try: asyncio.run(ShardWorker(conn, cfg).run())
+    except KeyboardInterrupt: pass
+
+# ============================================================================
+# Console side
+# ============================================================================
+
+class _ShardWriter:
+    """Stands in for the StreamWriter of a connection a worker owns. ServerMgr's writer task
+    hands it line-framed packets (proxies never leave "line"), which go to the worker unframed."""
+    def __init__(self, shard: "_Shard", cid, peer):
+        self.shard, self.cid, self.peer = shard, cid, peer
+        self.transport = self  # ServerMgr._drop aborts c.writer.transport
+    def write(self, data): self.writelines([data])
+    def writelines(self, chunks): self.shard.send(("send", self.cid, [bytes(x[:-1]) for x in chunks]))
+    async def drain(self): pass
+    def negotiate(self, ack):
+        c = self.shard.pool.mgr.clients.get(self.cid)
+        if c and ack: c.compress = ack.get("compress", "")  # for metrics; the worker does the compressing
+        self.shard.send(("hello", self.cid, ack))
+    def abort(self): self.shard.send(("close", self.cid))
+    def close(self): self.abort()
+    async def wait_closed(self): pass
+    def get_extra_info(self, name, default=None): return self.peer if name == "peername" else default
+
+class _Shard:
+    """Console-side handle on one worker process."""
+    def __init__(self, pool: "ShardPool", idx, cfg):
+        ctx = multiprocessing.get_context("spawn")
+        self.pool, self.idx = pool, idx
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=worker_main, args=(child, cfg), name=f"gm-shard-{idx}", daemon=True)
+        self.proc.start(); child.close()
+        self.cids: Set[str] = set()
+        self.alive = True
+        threading.Thread(target=self._recv, args=(asyncio.get_running_loop(),), name=f"gm-shard-{idx}", daemon=True).start()
+
+    def send(self, msg):
+        if not self.alive: return
+        try: self.conn.send_bytes(ForkingPickler.dumps(msg))
+        except OSError: self.alive = False
+
+    def _recv(self, loop):
+        try:
+            while True: loop.call_soon_threadsafe(self.pool._events, self, pickle.loads(self.conn.recv_bytes()))
+        except (EOFError, OSError): pass
+        try: loop.call_soon_threadsafe(self.pool._lost, self)
+        except RuntimeError: pass  # loop already closed
+
+    def stop(self):
+        self.send(("stop",)); self.alive = False
+        self.proc.join(1.0)
+        if self.proc.is_alive(): self.proc.terminate()
+
+class _Acceptor:
+    """asyncio.Server stand-in kept in ServerMgr.listeners: accepts and hands sockets to the pool."""
+    def __init__(self, pool: "ShardPool", port):
+        self.sock = socket.create_server(("0.0.0.0", port), backlog=512)
+        self.sock.setblocking(False)
+        self.task = asyncio.ensure_future(self._accept(pool, port))
+    async def _accept(self, pool, port):
+        loop = asyncio.get_running_loop()
+        while True:
+            try: sock, addr = await loop.sock_accept(self.sock)
+            except OSError:
+                if self.sock.fileno() < 0: return
+                await asyncio.sleep(0.1); continue  # e.g. out of file descriptors
+            pool.hand(sock, addr, port)
+    def close(self): self.task.cancel(); self.sock.close()
+    async def wait_closed(self): pass
+
+class ShardPool:
+    """Spreads device connections over `workers` processes (default: one per spare core).
+    Set as ServerMgr.shards before the first add_listener."""
+    def __init__(self, mgr: ServerMgr, workers=0):
+        self.mgr = mgr
+        self.size = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.shards: List[_Shard] = []
+
+    async def listen(self, port) -> _Acceptor:
+        if not self.shards:
+            cfg = (self.mgr.frame_limit, self.mgr.send_timeout, self.mgr.compress_level, self.mgr.heartbeat_timeout)
+            self.shards = [_Shard(self, i, cfg) for i in range(self.size)]
+        return _Acceptor(self, port)
+
+    def stop(self):
+        shards, self.shards = self.shards, []
+        for sh in shards: sh.stop()
+
+    def hand(self, sock, addr, port):
+        live = [sh for sh in self.shards if sh.alive]
+        if not live: sock.close(); return
+        sh = min(live, key=lambda s: len(s.cids))
+        cid = f"{addr[0]}:{addr[1]}"
+        sh.cids.add(cid)
+        self.mgr._open(Client(id=cid, port=port, writer=_ShardWriter(sh, cid, addr), uid=cid))
+        sh.send(("sock", sock, cid, port))
+        sock.close()  # pickling duplicated it for the worker
+
+    def _proxy(self, sh: _Shard, cid) -> Optional[Client]:
+        c = self.mgr.clients.get(cid)
+        return c if c is not None and getattr(c.writer, "shard", None) is sh else None
+
+    def _events(self, sh: _Shard, events):
+        mgr, rec = self.mgr, self.mgr.recorder
+        for ev in events:
+            kind = ev[0]
+            if kind == "stats": self._stats(sh, ev[1], ev[2]); continue
+            c = self._proxy(sh, ev[1])
+            if kind == "close":
+                sh.cids.discard(ev[1])
+                if c: mgr._close(c)
+            elif c is None: continue
+            elif kind == "log":  # device LOG packets go through the pipeline like in-process ones
+                _, cid, ts, level, msg, fields = ev
+                c.stats.last_seen = ts
+                for l in mgr.log_pipeline.push(ts, level, c.device, msg, c.uid, fields): mgr.events.emit("log", cid, l)
+                if rec: rec.add("in", c, mgr._encode(dict(fields or (), type="LOG", level=level, msg=msg)), "LOG")
+            elif kind == "note":  # the worker's own diagnostics: stored as-is
+                _, cid, ts, level, msg = ev
+                mgr.events.emit("log", cid, mgr.logs.append(ts, level, c.device, msg))
+            elif kind == "pkt":
+                c.stats.last_seen = time.time()
+                mgr._handle(c, ev[2])
+
+    def _stats(self, sh: _Shard, rows, errors):
+        for cid, last_seen, b_in, w_in, p_in, b_out, w_out, p_out, bad in rows:
+            c = self._proxy(sh, cid)
+            if c is None: continue
+            st = c.stats; st.last_seen = max(st.last_seen, last_seen)
+            st.bytes_in, st.wire_in, st.pkts_in, st.bytes_out, st.wire_out, st.pkts_out = b_in, w_in, p_in, b_out, w_out, p_out
+            c.bad_frames = bad
+        for kind, n in errors.items(): self.mgr.frame_errors[kind] = self.mgr.frame_errors.get(kind, 0) + n
+
+    def _lost(self, sh: _Shard):
+        sh.alive = False
+        if sh not in self.shards: return  # stopped on purpose
+        l = self.mgr.logs.append(time.time(), "error", "console", f"[shard] worker {sh.idx} exited; its {len(sh.cids)} devices were disconnected")
+        self.mgr.events.emit("log", None, l)
+        for cid in list(sh.cids):
+            c = self._proxy(sh, cid)
+            if c: self.mgr._close(c)
+        sh.cids.clear()